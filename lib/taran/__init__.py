@@ -6,7 +6,6 @@ attributes that all types of workers and foreman instances may use."""
 from __future__ import (absolute_import, print_function, unicode_literals)
 
 import inspect
-import json
 import logging
 import os
 import time
@@ -16,7 +15,9 @@ from contracts import contract
 
 from taran.helpers.aws import get_account_id
 from taran.helpers.aws.clients import get_swf_client
-from taran.helpers.aws.swf import get_activity_history
+from taran.helpers.aws.ratelimit import LIMITED_CLIENT_CONFIG, RateLimitedClient, get_rate_limiter
+from taran.helpers.aws.swf import WorkflowHistory, get_activity_history
+from taran.utils.cache import LRUCache
 from taran.utils.host import get_hostname
 
 __title__ = 'taran'
@@ -47,6 +48,8 @@ class Taran(object):
         domain_name: (unicode): The domain the workflow exists in.
         swf_client: (SWF): An instance of the SWF client.
         activity_task (unicode): Name of the activity task.
+        indexed_history (WorkflowHistory): An index of the current workflow history.
+        execution_info_cache (LRUCache): Recently described workflow executions, keyed by (workflowId, runId).
     """
 
     __metaclass__ = ABCMeta
@@ -60,15 +63,17 @@ class Taran(object):
             configuration (module): The workflow configuration.
         """
         self.aws_region = configuration.AWS_REGION if hasattr(configuration, 'AWS_REGION') else None
-        self.swf_client = get_swf_client(region=self.aws_region)
         self.configuration = configuration
+        self.swf_client = self.get_rate_limited_swf_client()
         if hasattr(configuration, 'AWS_ACCOUNT_ID'):
-            if configuration.AWS_ACCOUNT_ID != get_account_id():
+            account_id_ttl = getattr(configuration, 'ACCOUNT_ID_CACHE_TTL', 3600)
+            if configuration.AWS_ACCOUNT_ID != get_account_id(ttl=account_id_ttl):
                 exit('Your configuration prevents this running outside of AWS account: {0}'.format(
                     configuration.AWS_ACCOUNT_ID))
         self.processor = None
         self.hostname = get_hostname()
         self.workflow_history = None
+        self.indexed_history = None
         self.task_list = None
         self.identity = None
         self.workflow_id = None
@@ -81,9 +86,32 @@ class Taran(object):
         self.activity_list = configuration.ACTIVITY_LIST if hasattr(configuration, 'ACTIVITY_LIST') else None
         self.decision_task = None
         self.task_token = None
+        self.execution_info_cache = LRUCache(
+            max_entries=configuration.EXECUTION_INFO_CACHE_SIZE if hasattr(configuration,
+                                                                           'EXECUTION_INFO_CACHE_SIZE') else 1000,
+            ttl=configuration.EXECUTION_INFO_CACHE_TTL if hasattr(configuration,
+                                                                  'EXECUTION_INFO_CACHE_TTL') else 3600)
         self.log_level = self.get_log_level()
         self.logger = self.get_logger()
 
+    def get_rate_limited_swf_client(self, max_pool_connections=None):
+        """Return an SWF client whose calls share the process-wide budgets set by SWF_RATE_LIMITS.
+
+        SWF_RATE_LIMITS may override the (calls per second, burst) budget of the 'poll', 'respond', 'history',
+        'describe' and 'default' categories of call, or be set to None to disable rate limiting.
+
+        Args:
+            max_pool_connections (Optional[int]): The number of connections the client keeps.
+        """
+        budgets = self.configuration.SWF_RATE_LIMITS if hasattr(self.configuration, 'SWF_RATE_LIMITS') else dict()
+        if budgets is None:
+            return get_swf_client(region=self.aws_region, max_pool_connections=max_pool_connections)
+        # Only the limiter retries, so its retries do not multiply with botocore's
+        swf_client = get_swf_client(region=self.aws_region, max_pool_connections=max_pool_connections,
+                                    **LIMITED_CLIENT_CONFIG)
+        return RateLimitedClient(client=swf_client,
+                                 limiter=get_rate_limiter(name='swf:{0}'.format(self.aws_region), budgets=budgets))
+
     def get_log_level(self):
         """Return a log level depending on specified LOG_LEVEL in configuration or default to INFO"""
         levels = {'NOTSET': 0, 'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'CRITICAL': 50}
@@ -110,6 +138,41 @@ class Taran(object):
         return get_activity_history(workflow_history=workflow_history, scheduled_ids=scheduled_ids,
                                     activity_type=activity_type)
 
+    def describe_workflow_execution(self, workflow_id=None, run_id=None):
+        """Get the execution info of a workflow execution, describing it only if it is not already cached.
+
+        Args:
+            workflow_id (unicode): The id of the workflow execution.
+            run_id (unicode): The run id of the workflow execution.
+
+        Returns:
+            execution_info (dict): The execution info of the workflow execution.
+        """
+        execution_key = (workflow_id, run_id)
+        execution_info = self.execution_info_cache.get(execution_key)
+        if execution_info is None:
+            execution_info = self.swf_client.describe_workflow_execution(domain=self.domain_name,
+                                                                         execution={
+                                                                             'workflowId': workflow_id,
+                                                                             'runId': run_id
+                                                                         }
+                                                                         )['executionInfo']
+            self.execution_info_cache.put(execution_key, execution_info)
+        return execution_info
+
+    def set_workflow_type(self, workflow_type=None):
+        """Set the name and version of the current workflow execution's type.
+
+        Args:
+            workflow_type (Optional[dict]): The workflow type, if already known, e.g. from a decision task.
+                Otherwise it is taken from the (cached) execution info.
+        """
+        if not workflow_type:
+            workflow_type = self.describe_workflow_execution(workflow_id=self.workflow_id,
+                                                             run_id=self.run_id)['workflowType']
+        self.workflow_name = workflow_type['name']
+        self.workflow_version = workflow_type['version']
+
     @contract(reason='unicode', domain_name='unicode|None', details='unicode',
               child_policy='unicode|None')
     def terminate_workflow(self, reason=None, domain_name=None,
@@ -141,16 +204,24 @@ class Taran(object):
         except Exception:
             raise
 
+    def get_indexed_history(self):
+        """Return an index of the current workflow history, re-indexing only when the history has changed.
+
+        Returns:
+            history (WorkflowHistory): The indexed workflow history.
+        """
+        events = self.workflow_history.get('events') if self.workflow_history else None
+        if self.indexed_history is None or not self.indexed_history.is_index_of(events=events):
+            self.indexed_history = WorkflowHistory(events=events)
+        return self.indexed_history
+
     def get_workflow_input(self):
         """Get the input specified when the workflow execution was started"""
-        for event in self.workflow_history.get('events'):
-            if event.get('eventType') == 'WorkflowExecutionStarted':
-                return json.loads(event['workflowExecutionStartedEventAttributes']['input'])
+        return self.get_indexed_history().get_workflow_input()
 
     def get_activity_status(self, activity=None):
         """Retrieve the activity history and a count of each status recorded"""
-        activity_history = self.get_activity_history(workflow_history=self.workflow_history,
-                                                     activity_type=activity)
+        activity_history = self.get_indexed_history().get_activity_history(activity_type=activity)
 
         activity_list = list()
         if activity_history:
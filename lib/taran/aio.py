@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module provides asyncio variants of the Foreman and Worker (Python 3.5+).
+
+SWF calls, including long polls, are run on a dedicated thread pool sized to the number of calls that may be in
+progress at once, so an event loop can hold many long polls open across task lists without blocking.
+"""
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import asyncio
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from taran.foreman import Foreman
+from taran.worker import Worker
+
+
+class AsyncProcessor(object):
+    """A mixin providing coroutine versions of the SWF operations common to all processors.
+
+    Attributes:
+        max_concurrency (int): The maximum number of SWF calls in progress at once.
+        executor (ThreadPoolExecutor): The pool SWF calls are run on.
+    """
+
+    def __init__(self, configuration=None, executor=None):
+        """Initialise state that applies to all asyncio processors.
+
+        Args:
+            configuration (module): The workflow configuration.
+            executor (Optional[ThreadPoolExecutor]): The pool to run SWF calls on, e.g. to share one between
+                processors. Defaults to a new pool of ASYNC_MAX_CONCURRENCY (or 100) threads.
+        """
+        super(AsyncProcessor, self).__init__(configuration=configuration)
+        self.max_concurrency = configuration.ASYNC_MAX_CONCURRENCY if hasattr(configuration,
+                                                                              'ASYNC_MAX_CONCURRENCY') else 100
+        self.swf_client = self.get_rate_limited_swf_client(max_pool_connections=self.max_concurrency)
+        self.executor = executor or ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+    async def run_in_executor(self, func, *args, **kwargs):
+        """Run a blocking function on the executor and return its result."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def terminate_workflow(self, **kwargs):
+        """Coroutine version of Taran.terminate_workflow."""
+        return await self.run_in_executor(super(AsyncProcessor, self).terminate_workflow, **kwargs)
+
+
+class AsyncForeman(AsyncProcessor, Foreman):
+    """A foreman whose SWF operations are coroutines.
+
+    A foreman holds the state of one decision task at a time; use spawn() to process decision tasks concurrently.
+    """
+
+    def spawn(self, task_list=None):
+        """Return a foreman sharing this foreman's client, caches and executor, with its own decision state.
+
+        Args:
+            task_list (Optional[unicode]): The task list the new foreman polls. Defaults to this foreman's.
+        """
+        foreman = copy.copy(self)
+        foreman.task_list = task_list or self.task_list
+        foreman.decision_task = None
+        foreman.workflow_history = None
+        foreman.indexed_history = None
+        foreman.workflow_id = None
+        foreman.run_id = None
+        foreman.task_token = None
+        return foreman
+
+    async def poll_for_decision_task(self):
+        """Coroutine version of Foreman.poll_for_decision_task."""
+        return await self.run_in_executor(super(AsyncForeman, self).poll_for_decision_task)
+
+    async def get_workflow_history(self):
+        """Coroutine version of Foreman.get_workflow_history."""
+        return await self.run_in_executor(super(AsyncForeman, self).get_workflow_history)
+
+    async def schedule_activity_tasks(self, decisions=None):
+        """Coroutine version of Foreman.schedule_activity_tasks."""
+        return await self.run_in_executor(super(AsyncForeman, self).schedule_activity_tasks, decisions=decisions)
+
+
+class AsyncWorker(AsyncProcessor, Worker):
+    """A worker whose SWF operations are coroutines.
+
+    poll_for_task returns a context for each task, so a single worker can hold many polls open at once.
+    """
+
+    async def poll_for_task(self, task_list=None):
+        """Coroutine version of Worker.poll_for_task."""
+        return await self.run_in_executor(super(AsyncWorker, self).poll_for_task, task_list=task_list)
+
+    async def poll_for_activity_task(self):
+        """Coroutine version of Worker.poll_for_activity_task."""
+        activity_task = await self.poll_for_task()
+        if activity_task:
+            self.set_activity_task(activity_task=activity_task)
+
+    async def complete_activity_task(self, result='Undefined', task_token=None):
+        """Coroutine version of Worker.complete_activity_task."""
+        return await self.run_in_executor(super(AsyncWorker, self).complete_activity_task,
+                                          result=result, task_token=task_token)
+
+    async def activity_task_failed(self, reason=None, details=None, task_token=None):
+        """Coroutine version of Worker.activity_task_failed."""
+        return await self.run_in_executor(super(AsyncWorker, self).activity_task_failed,
+                                          reason=reason, details=details, task_token=task_token)
@@ -39,3 +39,21 @@ class TaranAWSPermissionsError(TaranError):
 
     def __repr__(self):
         return self.message
+
+
+class TaranTransferError(TaranError):
+    """Class for errors transferring objects to or from S3.
+
+    Attributes:
+        results (dict): The results of the transfer, including those of the items that failed.
+    """
+
+    def __init__(self, message=None, results=None):
+        self.message = message
+        self.results = results
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return self.message
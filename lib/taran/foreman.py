@@ -4,24 +4,76 @@
 from __future__ import (absolute_import, print_function, unicode_literals)
 
 import json
-import uuid
 from collections import namedtuple
+from operator import itemgetter
 
 from botocore.exceptions import ClientError
 from contracts import contract
 
 from taran import Taran
-from taran.helpers.aws.swf import (get_activity_version)
+from taran.helpers.aws.swf import (MAX_DECISIONS, DecisionBuilder, WorkflowHistory, get_activity_versions,
+                                   is_overflow_timer, iter_history_events, iter_history_pages)
+from taran.utils.cache import LRUCache
 
 Decision = namedtuple('Decision', ['name', 'type', 'schedule_to_start_timeout', 'start_to_close_timeout',
                                    'schedule_to_close_timeout', 'task_list', 'input'])
 
+CHILD_RUNNING_STATUSES = ('initiated', 'started')
+DEFAULT_SHARD_SIZE = 100
+
+
+def get_shards(items=None, shard_size=DEFAULT_SHARD_SIZE):
+    """Split a work list into consecutive shards of at most shard_size items."""
+    return [items[index:index + shard_size] for index in range(0, len(items), shard_size)]
+
+
+def get_shard_workflow_id(workflow_id=None, shard=None):
+    """Return the workflow id of the child workflow processing a shard of a parent workflow's work list."""
+    return '{0}-shard-{1}'.format(workflow_id, shard)
+
+
+@contract(shard_count='int,>=0', statuses='dict', max_attempts='int,>0')
+def plan_fan_out(shard_count=None, statuses=None, max_in_flight=None, max_attempts=1, max_scheduled=MAX_DECISIONS):
+    """Decide which shards' child workflows to start, given the status of those started so far.
+
+    Args:
+        shard_count (int): The number of shards.
+        statuses (dict): Child workflow status records, as returned by get_child_workflow_statuses, keyed by shard.
+        max_in_flight (Optional[int]): The maximum number of child workflows running at once. Defaults to no limit.
+        max_attempts (int): The number of times a shard is started before its failure is final.
+        max_scheduled (int): The maximum number of child workflows to start in one decision.
+    Returns:
+        a dict containing the shards to 'start', the shards 'succeeded' and 'failed', the number of child workflows
+        'running' and whether the fan-out is 'complete'.
+    """
+    candidates, succeeded, failed = list(), list(), list()
+    running = 0
+    for shard in range(shard_count):
+        status = statuses.get(shard)
+        if status is None:
+            candidates.append(shard)
+        elif status['status'] in CHILD_RUNNING_STATUSES:
+            running += 1
+        elif status['status'] == 'completed':
+            succeeded.append(shard)
+        elif status.get('attempts', 1) < max_attempts:
+            candidates.append(shard)
+        else:
+            failed.append(shard)
+    capacity = max_scheduled if max_in_flight is None else min(max_scheduled, max_in_flight - running)
+    start = candidates[:max(0, capacity)]
+    return dict(start=start, succeeded=succeeded, failed=failed, running=running,
+                complete=len(succeeded) + len(failed) == shard_count)
+
 
 class Foreman(Taran):
     """A template for all decision processors.
 
     Attributes:
         configuration (module): The configuration a foreman needs in order to participate in the workflow.
+        history_cache (LRUCache): Workflow histories of recently decided executions, keyed by (workflowId, runId).
+        history_prefetch (bool): Request the next page of workflow history whilst the current page is processed.
+        activity_versions (dict): The version of each activity in the activity list, keyed by name.
     """
 
     @contract(configuration='*')
@@ -34,33 +86,40 @@ class Foreman(Taran):
         super(Foreman, self).__init__(configuration=configuration)
         self.task_list = configuration.FOREMAN_TASK_LIST if hasattr(configuration,
                                                                     'FOREMAN_TASK_LIST') else 'default'
+        self.history_cache = LRUCache(
+            max_entries=configuration.HISTORY_CACHE_SIZE if hasattr(configuration, 'HISTORY_CACHE_SIZE') else 100,
+            max_weight=configuration.HISTORY_CACHE_MAX_EVENTS if hasattr(configuration,
+                                                                         'HISTORY_CACHE_MAX_EVENTS') else 100000,
+            weigher=len)
+        self.history_prefetch = configuration.HISTORY_PREFETCH if hasattr(configuration,
+                                                                          'HISTORY_PREFETCH') else False
+        self.activity_versions = get_activity_versions(activity_list=self.activity_list)
 
     def poll_for_decision_task(self):
         """Poll for an decision task from SWF and return if a task token has been provided.
 
+        Events are requested newest first and merged into the cached history of the workflow execution, so only
+        events since the last decision for the execution are retrieved.
+
         Returns:
             task (dict): Details of the assigned task.
         """
         try:
             task = self.swf_client.poll_for_decision_task(domain=self.domain_name,
                                                           identity=self.identity,
-                                                          taskList={'name': self.task_list})
+                                                          taskList={'name': self.task_list},
+                                                          reverseOrder=True)
             if task and 'taskToken' in task:
                 self.decision_task = task
                 self.workflow_id = task['workflowExecution']['workflowId']
                 self.run_id = task['workflowExecution']['runId']
                 self.task_token = task['taskToken']
-                # SET WORKFLOW NAME AND VERSION
-                workflow_execution = self.swf_client.describe_workflow_execution(domain=self.domain_name,
-                                                                                 execution={
-                                                                                     'workflowId': self.workflow_id,
-                                                                                     'runId': self.run_id
-                                                                                 }
-                                                                                 )
-                self.workflow_name = workflow_execution['executionInfo']['workflowType']['name']
-                self.workflow_version = workflow_execution['executionInfo']['workflowType']['version']
-                self.workflow_history = dict(events=task['events'], next_page_token=task.get('nextPageToken'),
-                                             previous_started_event_id=task.get('previousStartedEventId'))
+                # Decision tasks include the workflow type, so no describe call is needed
+                self.set_workflow_type(workflow_type=task.get('workflowType'))
+                self.merge_workflow_history(pages=iter_history_pages(get_page=self.poll_for_decision_task_page,
+                                                                     first_page=task,
+                                                                     prefetch=self.history_prefetch),
+                                            previous_started_event_id=task.get('previousStartedEventId'))
             return True
         except ClientError as ce:
             if 'AccessDeniedException' in ce.response['Error']['Code']:
@@ -69,93 +128,199 @@ class Foreman(Taran):
         except:
             raise
 
+    def poll_for_decision_task_page(self, next_page_token=None):
+        """Get a further page of events, newest first, for the current decision task.
+
+        Args:
+            next_page_token (unicode): The token returned with the previous page.
+        Returns:
+            a dict containing the page of events.
+        """
+        return self.swf_client.poll_for_decision_task(domain=self.domain_name,
+                                                      identity=self.identity,
+                                                      taskList={'name': self.task_list},
+                                                      nextPageToken=next_page_token,
+                                                      reverseOrder=True)
+
+    def get_workflow_execution_history_page(self, next_page_token=None):
+        """Get a page of events, newest first, for the current workflow execution.
+
+        Args:
+            next_page_token (Optional[unicode]): The token returned with the previous page.
+        Returns:
+            a dict containing the page of events.
+        """
+        kwargs = dict(nextPageToken=next_page_token) if next_page_token else dict()
+        return self.swf_client.get_workflow_execution_history(
+            domain=self.domain_name,
+            execution={
+                'workflowId': self.workflow_id,
+                'runId': self.run_id
+            },
+            maximumPageSize=1000,
+            reverseOrder=True,
+            **kwargs
+        )
+
+    def merge_workflow_history(self, pages=None, previous_started_event_id=None):
+        """Merge pages of events, newest first, with the events cached for the workflow execution.
+
+        Pages are consumed only until they reach the events already cached, so a long running execution only
+        pays for the events added since its previous decision.
+
+        Args:
+            pages (iterable): Pages of workflow history in reverse order, e.g. from iter_history_pages.
+            previous_started_event_id (int): The id of the DecisionTaskStarted event of the previous decision.
+        """
+        history_key = (self.workflow_id, self.run_id)
+        history = self.history_cache.get(history_key) or WorkflowHistory()
+        new_events = list()
+        for page in pages:
+            events = page.get('events') or list()
+            new_events.extend(event for event in events if event['eventId'] > history.last_event_id)
+            if min([event['eventId'] for event in events] or [0]) <= history.last_event_id + 1:
+                break
+        history.add_events(events=sorted(new_events, key=itemgetter('eventId')))
+        self.history_cache.put(history_key, history)
+        self.indexed_history = history
+        self.workflow_history = dict(events=history.events, next_page_token=None,
+                                     previous_started_event_id=previous_started_event_id)
+
     def get_workflow_history(self):
         """Get entire workflow history.
 
         Returns:
             a dict containing the entire workflow execution history
         """
-        events = list()
-        next_page_token = None
-        while True:
-            if not next_page_token:
-                if not self.workflow_history:
-                    self.workflow_history = self.swf_client.get_workflow_execution_history(
-                        domain=self.domain_name,
-                        execution={
-                            'workflowId': self.workflow_id,
-                            'runId': self.run_id
-                        },
-                        maximumPageSize=1000,
-                        reverseOrder=True
-                    )
-                else:
-                    events.extend(self.workflow_history.get('events'))
-                if self.workflow_history.get('nextPageToken'):
-                    next_page_token = self.workflow_history.get('nextPageToken')
-                else:
-                    self.workflow_history['events'] = events
-                    break
-            else:
-                workflow_history = self.swf_client.get_workflow_execution_history(
-                    domain=self.domain_name,
-                    execution={
-                        'workflowId': self.workflow_id,
-                        'runId': self.run_id
-                    },
-                    nextPageToken=next_page_token,
-                    maximumPageSize=1000,
-                    reverseOrder=True
-                )
-                if workflow_history:
-                    events.extend(workflow_history.get('events'))
-                else:
-                    exit('No response')
-                if workflow_history.get('nextPageToken'):
-                    next_page_token = workflow_history.get('nextPageToken')
-                else:
-                    self.workflow_history['events'] = events
-                    break
+        if not self.workflow_history or self.workflow_history.get('next_page_token'):
+            self.merge_workflow_history(pages=iter_history_pages(get_page=self.get_workflow_execution_history_page,
+                                                                 prefetch=self.history_prefetch))
+        return self.workflow_history
+
+    def iter_workflow_history(self):
+        """Iterate over the workflow history, newest event first, retrieving pages only as they are reached.
+
+        Decision logic can stop iterating once it has found what it needs, avoiding requests for older pages.
+
+        Yields:
+            each event of the workflow history, newest first.
+        """
+        if self.workflow_history and not self.workflow_history.get('next_page_token'):
+            for event in sorted(self.workflow_history.get('events'), key=itemgetter('eventId'), reverse=True):
+                yield event
+            return
+        for event in iter_history_events(pages=iter_history_pages(
+                get_page=self.get_workflow_execution_history_page, prefetch=self.history_prefetch)):
+            yield event
+
+    def get_decision_builder(self):
+        """Return a builder for the decisions of the current decision task.
+
+        Generated ids are prefixed with the id of the task's DecisionTaskStarted event, which is unique within the
+        execution.
+        """
+        started_event_id = (self.decision_task or dict()).get('startedEventId')
+        return DecisionBuilder(activity_versions=self.activity_versions,
+                               id_prefix='{0}'.format(started_event_id) if started_event_id else None)
+
+    def respond_decisions(self, builder=None, execution_context=None):
+        """Complete the current decision task with a builder's decisions.
+
+        Decisions deferred from the execution's previous decision task are restored from the history and made
+        first. If there are more than SWF accepts in one response, the rest are deferred to the next decision task,
+        stored in the control data of zero second timers (see DecisionBuilder.take_batch), so any foreman can make
+        them.
+
+        Args:
+            builder (Optional[DecisionBuilder]): The decisions to make.
+            execution_context (Optional[unicode]): Context to record with the decision task.
+        Returns:
+            the number of decisions deferred to the next decision task.
+        """
+        pending = self.get_decision_builder()
+        pending.decisions = self.get_indexed_history().get_deferred_decisions(
+            after_event_id=(self.decision_task or dict()).get('previousStartedEventId') or 0)
+        if builder is not None:
+            pending.extend(builder)
+        decision_count = len(pending)
+        decisions = pending.take_batch()
+        kwargs = dict(taskToken=self.task_token, decisions=decisions)
+        if execution_context is not None:
+            kwargs['executionContext'] = execution_context
+        self.swf_client.respond_decision_task_completed(**kwargs)
+        return decision_count - sum(1 for decision in decisions if not is_overflow_timer(decision=decision))
 
     @contract(decisions='list')
     def schedule_activity_tasks(self, decisions=None):
-        """Retrieve the workflow history.
+        """Complete the current decision task by scheduling activities.
 
         Args:
-            decisions (List): A list of dictionaries containing details of the activities to schedule.
+            decisions (List): Decision tuples describing the activities to schedule.
         """
-        decisions_to_schedule = list()
+        builder = self.get_decision_builder()
         for decision_to_schedule in decisions:
-            decisions_to_schedule.append(
-                {'decisionType': 'ScheduleActivityTask',
-                 'scheduleActivityTaskDecisionAttributes': {
-                     'activityType': {
-                         'name': decision_to_schedule.name,
-                         'version': get_activity_version(activity_type=decision_to_schedule.type,
-                                                         activity_list=self.activity_list),
-                     },
-                     'scheduleToStartTimeout': decision_to_schedule.schedule_to_start_timeout,
-                     'startToCloseTimeout': decision_to_schedule.start_to_close_timeout,
-                     'scheduleToCloseTimeout': decision_to_schedule.schedule_to_close_timeout,
-                     'activityId': str(uuid.uuid1()),
-                     'taskList': {'name': decision_to_schedule.task_list},
-                     'input': decision_to_schedule.input
-                 }
-                 }
-            )
-        try:
-            self.swf_client.respond_decision_task_completed(taskToken=self.task_token,
-                                                            decisions=decisions_to_schedule)
-            return True
-        except ClientError:
-            raise
-        except:
-            raise
+            builder.schedule_activity(name=decision_to_schedule.name,
+                                      version=self.activity_versions.get(decision_to_schedule.type),
+                                      task_list=decision_to_schedule.task_list, input=decision_to_schedule.input,
+                                      schedule_to_start_timeout=decision_to_schedule.schedule_to_start_timeout,
+                                      start_to_close_timeout=decision_to_schedule.start_to_close_timeout,
+                                      schedule_to_close_timeout=decision_to_schedule.schedule_to_close_timeout)
+        self.respond_decisions(builder=builder)
+        return True
+
+    def fan_out(self, builder, items=None, name=None, version=None, shard_size=DEFAULT_SHARD_SIZE,
+                max_in_flight=None, max_attempts=1, task_list=None, child_policy='TERMINATE',
+                execution_start_to_close_timeout=None, task_start_to_close_timeout=None):
+        """Process a work list in child workflows, one per shard, and gather their results.
+
+        Each child's events add a handful of events to this execution's history, however much work the child does,
+        so a large job neither nears the history limit nor makes each decision replay a long history. Call this on
+        every decision task with the same items: children are started under ids derived from this workflow's id
+        and the shard number, so shards already started are recognised from the history and not started again.
+
+        Args:
+            builder (DecisionBuilder): The builder to add the decisions starting child workflows to (required), e.g.
+                from get_decision_builder, to then respond with using respond_decisions.
+            items (list): The work list. Each child's input is a JSON object of its shard's 'items' and 'shard'
+                number, which must fit within SWF's input size limit.
+            name (unicode): The name of the child workflow type.
+            version (unicode): The version of the child workflow type.
+            shard_size (int): The maximum number of items per child workflow.
+            max_in_flight (Optional[int]): The maximum number of child workflows running at once.
+            max_attempts (int): The number of times a shard's child is started before its failure is final.
+            task_list (Optional[unicode]): The decision task list of the child workflows.
+            child_policy (unicode): What happens to the children if this execution closes first.
+            execution_start_to_close_timeout (Optional[unicode]): The children's execution timeout.
+            task_start_to_close_timeout (Optional[unicode]): The children's decision task timeout.
+        Returns:
+            the plan, as returned by plan_fan_out, with the 'results' of the children, decoded from JSON, in shard
+            order (None for shards not completed).
+        """
+        shards = get_shards(items=items, shard_size=shard_size)
+        workflow_ids = [get_shard_workflow_id(workflow_id=self.workflow_id, shard=shard)
+                        for shard in range(len(shards))]
+        child_statuses = self.get_indexed_history().get_child_workflow_statuses(workflow_type=name)
+        statuses = dict((shard, child_statuses[workflow_id]) for shard, workflow_id in enumerate(workflow_ids)
+                        if workflow_id in child_statuses)
+        # Leave room for a decision closing the workflow, so no child is deferred and then planned again
+        plan = plan_fan_out(shard_count=len(shards), statuses=statuses, max_in_flight=max_in_flight,
+                            max_attempts=max_attempts, max_scheduled=MAX_DECISIONS - 1 - len(builder))
+        for shard in plan['start']:
+            builder.start_child_workflow(name=name, version=version, workflow_id=workflow_ids[shard],
+                                         input=dict(items=shards[shard], shard=shard), task_list=task_list,
+                                         child_policy=child_policy, control='{0}'.format(shard),
+                                         execution_start_to_close_timeout=execution_start_to_close_timeout,
+                                         task_start_to_close_timeout=task_start_to_close_timeout)
+        succeeded = set(plan['succeeded'])
+        plan['results'] = [json.loads(statuses[shard]['result']) if shard in succeeded and statuses[shard].get(
+            'result') else None for shard in range(len(shards))]
+        self.msg(message='Starting {0} child workflows with {1} running, {2} shards succeeded and {3} failed'.format(
+            len(plan['start']), plan['running'], len(plan['succeeded']), len(plan['failed'])))
+        return plan
 
     def get_activity_results(self, activity=None):
         """Get the result returned when the activity became completed."""
-        activity_history = self.get_activity_history(workflow_history=self.workflow_history,
-                                                     activity_type=activity)
+        activity_history = self.get_indexed_history().get_activity_history(activity_type=activity)
         results_list = list()
         if activity_history:
             for activity_event in activity_history:
@@ -3,19 +3,111 @@
 """This module provides common AWS functionality."""
 from __future__ import (absolute_import, print_function, unicode_literals)
 
+import hashlib
+import io
 import json
+import os
+import tempfile
+import time
 
-from botocore.exceptions import ClientError, NoCredentialsError
+from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
 from requests import get
 from requests.exceptions import RequestException
+from six import text_type
 
 from taran.errors import TaranAWSCredentialsError, TaranAWSPermissionsError, TaranError
-from taran.helpers.aws.clients import get_iam_client
+from taran.helpers.aws.clients import get_iam_client, get_session, get_sts_client
+from taran.utils.files import PRIVATE_CACHE_DIR, get_private_dir
 
+ACCOUNT_ID_CACHE_PATH = os.path.join(PRIVATE_CACHE_DIR, 'account-ids.json')
 
-def get_account_id():
+_account_ids = dict()
+
+
+def get_account_id(ttl=3600, cache_path=None):
     """Return the AWS Account id number associated with the current Boto3 session.
-    If not available, try and get it from the instance meta-data (assuming this is an EC2 instance.)"""
+
+    Account ids are cached per set of credentials, both in the process and in a file shared by all of the current
+    user's processes on the host, so short-lived processors do not each need to look it up.
+
+    Args:
+        ttl (int): the number of seconds a cached account id remains valid for. 0 disables caching.
+        cache_path (Optional[unicode]): the file to cache account ids in, in a directory private to the current user.
+            Defaults to ACCOUNT_ID_CACHE_PATH.
+    Returns:
+        the account id.
+    """
+    if not ttl:
+        return lookup_account_id()
+    cache_path = cache_path or ACCOUNT_ID_CACHE_PATH
+    credentials_key = get_credentials_key()
+    account_id, expires = _account_ids.get(credentials_key, (None, 0))
+    if account_id and expires > time.time():
+        return account_id
+    cached_account_ids = read_account_id_cache(cache_path=cache_path)
+    cached = cached_account_ids.get(credentials_key)
+    if cached and cached['expires'] > time.time():
+        _account_ids[credentials_key] = (cached['account_id'], cached['expires'])
+        return cached['account_id']
+    account_id = lookup_account_id()
+    expires = time.time() + ttl
+    _account_ids[credentials_key] = (account_id, expires)
+    cached_account_ids[credentials_key] = dict(account_id=account_id, expires=expires)
+    write_account_id_cache(cache_path=cache_path, account_ids=cached_account_ids)
+    return account_id
+
+
+def get_credentials_key():
+    """Return a key identifying the current credentials, without revealing them."""
+    credentials = get_session().get_credentials()
+    access_key = credentials.access_key if credentials else ''
+    return text_type(hashlib.sha256(access_key.encode('utf-8')).hexdigest())
+
+
+def read_account_id_cache(cache_path=None):
+    """Read unexpired account ids from the cache file, returning an empty dict if it is missing or invalid.
+
+    The file is only trusted if it, and the directory containing it, belong to the current user and no other user can
+    change them.
+    """
+    try:
+        get_private_dir(dir_path=os.path.dirname(cache_path))
+        with io.open(cache_path, 'r', encoding='utf-8') as cache_file:
+            cache_stat = os.fstat(cache_file.fileno())
+            if hasattr(os, 'getuid') and (cache_stat.st_uid != os.getuid() or cache_stat.st_mode & 0o022):
+                return dict()
+            account_ids = json.load(cache_file)
+        return dict((key, value) for key, value in account_ids.items() if value['expires'] > time.time())
+    except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError, TaranError):
+        return dict()
+
+
+def write_account_id_cache(cache_path=None, account_ids=None):
+    """Atomically replace the cache file, in a directory private to the current user. Failures are ignored."""
+    temp_path = None
+    try:
+        cache_dir = get_private_dir(dir_path=os.path.dirname(cache_path))
+        # mkstemp creates a new file, readable only by the current user, and never follows an existing link
+        file_descriptor, temp_path = tempfile.mkstemp(prefix='.account-ids-', dir=cache_dir)
+        with io.open(file_descriptor, 'w', encoding='utf-8') as cache_file:
+            cache_file.write(text_type(json.dumps(account_ids)))
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError, TaranError):
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def lookup_account_id():
+    """Return the AWS Account id number associated with the current Boto3 session.
+    Try STS first, then IAM and if neither is available, try and get it from the instance meta-data (assuming this
+    is an EC2 instance.)"""
+    # Attempt to retrieve account number via STS, which requires no permissions
+    try:
+        return get_sts_client().get_caller_identity()['Account']
+    except NoCredentialsError:
+        raise TaranAWSCredentialsError('AWS credentials could not be found when retrieving AWS account id.')
+    except (BotoCoreError, ClientError):
+        pass
     # Attempt to retrieve account number via API credentials
     try:
         iam_client = get_iam_client()
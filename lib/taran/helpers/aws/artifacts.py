@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module provides a host-local cache of S3 objects, shared by every process the current user runs on the host.
+
+Objects are stored by bucket, key and ETag, so a cached copy is only used for the version of the object it was
+downloaded from. Copies are reflinked into place where the filesystem supports it (sharing extents copy-on-write) and
+copied otherwise, so fetching an object already on the host costs no bandwidth, and changes made to a fetched file
+never reach the cache. The cache is kept in a directory only the current user can access.
+"""
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import errno
+import hashlib
+import io
+import os
+import shutil
+import stat
+from contextlib import contextmanager
+
+from six import text_type
+
+from taran.utils.files import PRIVATE_CACHE_DIR, get_private_dir
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+ARTIFACT_CACHE_DIR = os.path.join(PRIVATE_CACHE_DIR, 'artifacts')
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+# The Linux ioctl request to share the extents of one file with another (copy-on-write)
+FICLONE = 0x40049409
+
+
+@contextmanager
+def file_lock(lock_path=None, blocking=True):
+    """Hold an exclusive lock on a lock file, shared with every thread and process on the host.
+
+    A lock file may be removed by its holder (see ArtifactCache.evict), so a lock taken on a file that has since
+    been removed is released and taken again on the file now at lock_path.
+
+    Yields:
+        True if the lock is held, or False if it was not available and blocking is False.
+    """
+    if fcntl is None:
+        with open(lock_path, 'a'):
+            yield True
+        return
+    flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+    while True:
+        lock_file = open(lock_path, 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), flags)
+        except (IOError, OSError) as exc:
+            lock_file.close()
+            if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_path)):
+                break
+        except OSError:
+            pass
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+    try:
+        yield True
+    finally:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def clone_file(source_path=None, target_path=None):
+    """Reflink a file into place, falling back to a copy. Either way, the target does not share the source's inode.
+
+    Returns:
+        'reflink' or 'copy', depending on how the file was placed.
+    """
+    temp_path = '{0}.{1}.part'.format(target_path, os.getpid())
+    method = 'copy'
+    with open(source_path, 'rb') as source_file, open(temp_path, 'wb') as target_file:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+                method = 'reflink'
+            except (IOError, OSError):
+                pass
+        if method == 'copy':
+            shutil.copyfileobj(source_file, target_file, 1024 * 1024)
+    try:
+        os.rename(temp_path, target_path)
+    except OSError:
+        # Windows does not replace existing files
+        os.remove(target_path)
+        os.rename(temp_path, target_path)
+    return method
+
+
+class ArtifactCache(object):
+    """A content-addressed, size limited cache of S3 objects.
+
+    Each entry is locked whilst it is downloaded, so concurrent fetches of the same object, from any process on the
+    host, download it once. Entries are evicted least recently used first once the cache exceeds max_bytes.
+
+    Attributes:
+        cache_dir (unicode): The directory the cache is stored in, which must be private to the current user.
+        max_bytes (int): The size the cache is reduced to after each entry is added.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = get_private_dir(dir_path=cache_dir or ARTIFACT_CACHE_DIR)
+        self.max_bytes = max_bytes if max_bytes is not None else DEFAULT_MAX_BYTES
+        self.objects_dir = os.path.join(self.cache_dir, 'objects')
+        if not os.path.isdir(self.objects_dir):
+            try:
+                os.makedirs(self.objects_dir, 0o700)
+            except OSError:
+                if not os.path.isdir(self.objects_dir):
+                    raise
+
+    def get_entry_path(self, bucket=None, s3_path=None, etag=None):
+        """Return the path of the entry for a version of an object."""
+        entry_key = '\0'.join((bucket, s3_path.lstrip('/'), etag.strip('"')))
+        digest = hashlib.sha256(entry_key.encode('utf-8')).hexdigest()
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def fetch(self, bucket=None, s3_path=None, etag=None, local_path=None, download=None):
+        """Place a version of an object at local_path, downloading it into the cache first if it is not cached.
+
+        Args:
+            bucket (unicode): the bucket containing the object.
+            s3_path (unicode): the key of the object.
+            etag (unicode): the ETag of the version of the object.
+            local_path (unicode): the path to place the object at.
+            download (callable): called with a path to download the object to, returning the MD5 of its content.
+        Returns:
+            the MD5 of the object's content and whether it was already cached.
+        """
+        entry_path = self.get_entry_path(bucket=bucket, s3_path=s3_path, etag=etag)
+        entry_dir = os.path.dirname(entry_path)
+        if not os.path.isdir(entry_dir):
+            try:
+                os.makedirs(entry_dir, 0o700)
+            except OSError:
+                if not os.path.isdir(entry_dir):
+                    raise
+        with file_lock(lock_path='{0}.lock'.format(entry_path)):
+            cached = os.path.exists(entry_path) and os.path.exists('{0}.md5'.format(entry_path))
+            if cached:
+                # The modification time of an entry's MD5 file records when the entry was last used
+                os.utime('{0}.md5'.format(entry_path), None)
+            else:
+                md5 = download(entry_path)
+                os.chmod(entry_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                with io.open('{0}.md5'.format(entry_path), 'w', encoding='utf-8') as md5_file:
+                    md5_file.write(text_type(md5))
+            with io.open('{0}.md5'.format(entry_path), 'r', encoding='utf-8') as md5_file:
+                md5 = md5_file.read()
+            clone_file(source_path=entry_path, target_path=local_path)
+        if not cached:
+            self.evict()
+        return md5, cached
+
+    def get_entries(self):
+        """Return the path, size and last use of each complete entry, least recently used first."""
+        entries = list()
+        for entry_dir, _, file_names in os.walk(self.objects_dir):
+            for file_name in file_names:
+                if '.' in file_name or '{0}.md5'.format(file_name) not in file_names:
+                    continue
+                entry_path = os.path.join(entry_dir, file_name)
+                try:
+                    entries.append((os.path.getmtime('{0}.md5'.format(entry_path)), os.path.getsize(entry_path),
+                                    entry_path))
+                except OSError:
+                    continue
+        return sorted(entries)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is no larger than max_bytes.
+
+        Entries locked by a fetch in progress are skipped. The lock files of removed entries, and of fetches that
+        failed, are removed too.
+
+        Returns:
+            the number of entries removed.
+        """
+        with file_lock(lock_path=os.path.join(self.cache_dir, 'evict.lock'), blocking=False) as locked:
+            if not locked:
+                return 0
+            entries = self.get_entries()
+            total_bytes = sum(size for _, size, _ in entries)
+            removed = 0
+            for _, size, entry_path in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                with file_lock(lock_path='{0}.lock'.format(entry_path), blocking=False) as entry_locked:
+                    if not entry_locked:
+                        continue
+                    for path in ('{0}.md5'.format(entry_path), entry_path, '{0}.lock'.format(entry_path)):
+                        if os.path.exists(path):
+                            os.remove(path)
+                total_bytes -= size
+                removed += 1
+            for entry_dir, _, file_names in os.walk(self.objects_dir):
+                for file_name in file_names:
+                    if not file_name.endswith('.lock'):
+                        continue
+                    entry_path = os.path.join(entry_dir, file_name[:-len('.lock')])
+                    if os.path.exists(entry_path):
+                        continue
+                    with file_lock(lock_path='{0}.lock'.format(entry_path), blocking=False) as entry_locked:
+                        if entry_locked and not os.path.exists(entry_path):
+                            os.remove('{0}.lock'.format(entry_path))
+            return removed
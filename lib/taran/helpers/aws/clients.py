@@ -1,29 +1,88 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-"""This module provides functions to return boto3 (Python AWS SDK) low-level clients."""
+"""This module provides functions to return boto3 (Python AWS SDK) low-level clients.
+
+Sessions and clients are created once per process and shared, so their connection pools (and HTTP keep-alive
+connections) are reused by every processor and helper. Clients are thread-safe; sessions and clients are never
+shared with forked child processes.
+"""
 from __future__ import (absolute_import, print_function, unicode_literals)
 
+import os
+import threading
+
 from boto3.session import Session
 from botocore.client import Config
 from botocore.exceptions import NoRegionError, NoCredentialsError
 from taran.errors import TaranAWSCredentialsError
 
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+_sessions = dict()
+_clients = dict()
+_lock = threading.Lock()
+
+
+def get_session(region=None):
+    """Get the shared session for a region.
+
+    Args:
+        region (unicode): the region to connect to.
+    Returns:
+        a boto3 session.
+    """
+    session_key = (os.getpid(), region)
+    with _lock:
+        if session_key not in _sessions:
+            _sessions[session_key] = Session(region_name=region) if region else Session()
+        return _sessions[session_key]
+
 
-def get_swf_client(region=None):
+def get_client(service=None, region=None, max_pool_connections=None, **config_options):
+    """Get the shared client for a service, region and configuration, creating it on first use.
+
+    Args:
+        service (unicode): the name of the service, e.g. 's3'.
+        region (unicode): the region to connect to.
+        max_pool_connections (int): the number of connections to keep, which limits the number of concurrent calls.
+        config_options: further botocore client configuration, e.g. read_timeout.
+    Returns:
+        a client for the service.
+    """
+    config_options['max_pool_connections'] = max_pool_connections or DEFAULT_MAX_POOL_CONNECTIONS
+    client_key = (os.getpid(), service, region, repr(sorted(config_options.items())))
+    client = _clients.get(client_key)
+    if client is None:
+        session = get_session(region=region)
+        with _lock:
+            client = _clients.get(client_key)
+            if client is None:
+                client = session.client(service, config=Config(**config_options))
+                _clients[client_key] = client
+    return client
+
+
+def reset_clients():
+    """Discard all shared sessions and clients, e.g. after credentials have changed."""
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
+
+
+def get_swf_client(region=None, max_pool_connections=None, **config_options):
     """Get a simple workflow client.
 
     Args:
         region (unicode): the region to connect to.
+        max_pool_connections (int): the number of connections to keep, which limits the number of concurrent calls.
+        config_options: further botocore client configuration, e.g. retries.
     Returns:
         an swf client.
     """
-    session_config = Config(connect_timeout=70, read_timeout=70)
-    if region:
-        session = Session(region_name=region)
-    else:
-        session = Session()
+    config_options.setdefault('connect_timeout', 70)
+    config_options.setdefault('read_timeout', 70)
     try:
-        return session.client('swf', config=session_config)
+        return get_client(service='swf', region=region, max_pool_connections=max_pool_connections, **config_options)
     except (ValueError, NoRegionError) as exc:
         if 'invalid endpoint' in exc.message.lower():
             raise TaranAWSCredentialsError('Invalid endpoint when creating SWF client. Missing/invalid AWS Region?')
@@ -31,20 +90,17 @@ def get_swf_client(region=None):
         raise TaranAWSCredentialsError('Unable to find AWS credentials when creating SWF client.')
 
 
-def get_iam_client(region=None):
+def get_iam_client(region=None, max_pool_connections=None):
     """Get an iam client.
 
     Args:
         region (unicode): the region to connect to.
+        max_pool_connections (int): the number of connections to keep, which limits the number of concurrent calls.
     Returns:
         an iam client.
     """
-    if region:
-        session = Session(region_name=region)
-    else:
-        session = Session()
     try:
-        return session.client('iam')
+        return get_client(service='iam', region=region, max_pool_connections=max_pool_connections)
     except (ValueError, NoRegionError) as exc:
         if 'invalid endpoint' in exc.message.lower():
             raise TaranAWSCredentialsError('Invalid endpoint when creating IAM client. Missing/invalid AWS Region?')
@@ -52,80 +108,86 @@ def get_iam_client(region=None):
         raise TaranAWSCredentialsError('Unable to find AWS credentials when creating IAM client.')
 
 
-def get_ec2_client(region=None):
+def get_sts_client(region=None, max_pool_connections=None):
+    """Get an sts client.
+
+    Args:
+        region (unicode): the region to connect to.
+        max_pool_connections (int): the number of connections to keep, which limits the number of concurrent calls.
+    Returns:
+        an sts client.
+    """
+    try:
+        return get_client(service='sts', region=region, max_pool_connections=max_pool_connections)
+    except (ValueError, NoRegionError) as exc:
+        if 'invalid endpoint' in exc.message.lower():
+            raise TaranAWSCredentialsError('Invalid endpoint when creating STS client. Missing/invalid AWS Region?')
+    except NoCredentialsError:
+        raise TaranAWSCredentialsError('Unable to find AWS credentials when creating STS client.')
+
+
+def get_ec2_client(region=None, max_pool_connections=None):
     """Get an ec2 client.
 
     Args:
         region (unicode): the region to connect to.
+        max_pool_connections (int): the number of connections to keep, which limits the number of concurrent calls.
     Returns:
         an ec2 client.
     """
-    if region:
-        session = Session(region_name=region)
-    else:
-        session = Session()
     try:
-        return session.client('ec2')
+        return get_client(service='ec2', region=region, max_pool_connections=max_pool_connections)
     except NoRegionError:
         print('AWS region could not be determined when creating ec2 client')
     except:
         raise
 
 
-def get_elb_client(region=None):
+def get_elb_client(region=None, max_pool_connections=None):
     """Get an elb client.
 
     Args:
         region (unicode): the region to connect to.
+        max_pool_connections (int): the number of connections to keep, which limits the number of concurrent calls.
     Returns:
         an elb client.
     """
-    if region:
-        session = Session(region_name=region)
-    else:
-        session = Session()
     try:
-        return session.client('elb')
+        return get_client(service='elb', region=region, max_pool_connections=max_pool_connections)
     except NoRegionError:
         print('AWS region could not be determined when creating elb client')
     except:
         raise
 
 
-def get_asg_client(region=None):
+def get_asg_client(region=None, max_pool_connections=None):
     """Get an asg client.
 
     Args:
         region (unicode): the region to connect to.
+        max_pool_connections (int): the number of connections to keep, which limits the number of concurrent calls.
     Returns:
         an asg client.
     """
-    if region:
-        session = Session(region_name=region)
-    else:
-        session = Session()
     try:
-        return session.client('autoscaling')
+        return get_client(service='autoscaling', region=region, max_pool_connections=max_pool_connections)
     except NoRegionError:
         print('AWS region could not be determined when creating asg client')
     except:
         raise
 
 
-def get_s3_client(region=None):
+def get_s3_client(region=None, max_pool_connections=None):
     """Get an s3 client.
 
     Args:
         region (unicode): the region to connect to.
+        max_pool_connections (int): the number of connections to keep, which limits the number of concurrent calls.
     Returns:
         an s3 client.
     """
-    if region:
-        session = Session(region_name=region)
-    else:
-        session = Session()
     try:
-        return session.client('s3')
+        return get_client(service='s3', region=region, max_pool_connections=max_pool_connections)
     except (ValueError, NoRegionError):
         exit('No region specified')
     except:
@@ -3,7 +3,9 @@
 """This module provides utilities to simplify working with Amazon EC2 services."""
 from __future__ import (absolute_import, print_function, unicode_literals)
 
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from requests import get
 from requests.exceptions import RequestException
@@ -22,46 +24,117 @@ def get_ec2_instance_id():
         raise
 
 
-def elb_deregister_instances(elb_name=None, instance_ids=None, region=None):
-    """De-Register EC2 instances on ELB."""
-    instances_input = [{'InstanceId': inst_id} for inst_id in instance_ids]
-    elb_client = get_elb_client(region=region)
-    elb_client.deregister_instances_from_load_balancer(
-        LoadBalancerName=elb_name,
-        Instances=instances_input
-    )
-    while True:
-        elb_state = elb_client.describe_load_balancers(
-            LoadBalancerNames=[
-                elb_name,
-            ],
-        )
-        instances = elb_state['LoadBalancerDescriptions'][0]['Instances']
-        for instance in instances:
-            if instance.get('InstanceId') in instance_ids:
-                time.sleep(5)
-                continue
-        break
-    return True
-
-
-def elb_register_instances(elb_name=None, instance_ids=None, region=None):
-    """Register EC2 instances on an ELB."""
-    # TODO: Implement timeout
-    instances_input = [{'InstanceId': inst_id} for inst_id in instance_ids]
-    elb_client = get_elb_client(region=region)
-    elb_client.register_instances_with_load_balancer(
-        LoadBalancerName=elb_name,
-        Instances=instances_input
-    )
+# describe_load_balancers accepts up to 20 load balancer names per call
+ELB_DESCRIBE_BATCH_SIZE = 20
+DEFAULT_ELB_TIMEOUT = 600
+
+
+def wait_with_backoff(check=None, timeout=None, initial_delay=0.5, max_delay=10):
+    """Call a function until it returns True, waiting exponentially longer, with jitter, between calls.
+
+    Args:
+        check (callable): Returns True once the condition being waited for is met.
+        timeout (float): The number of seconds after which to stop waiting.
+        initial_delay (float): The maximum delay before the second call.
+        max_delay (float): The maximum delay between calls.
+    Returns:
+        True if the condition was met, or False if the timeout passed first.
+    """
+    deadline = time.time() + timeout
+    delay = initial_delay
     while True:
-        instances_health = elb_client.describe_instance_health(
-            LoadBalancerName=elb_name,
-            Instances=instances_input,
-        )
-        if instances_health and instances_health.get('InstanceStates'):
-            for instance_state in instances_health.get('InstanceStates'):
-                if not instance_state.get('State') == 'InService':
-                    time.sleep(8)
-                    break
+        if check():
             return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+        delay = min(max_delay, delay * 2)
+
+
+def get_elb_instance_ids(elb_client=None, elb_names=None):
+    """Return the ids of the instances registered with each ELB, describing many ELBs per call.
+
+    Returns:
+        a dict of sets of instance ids, keyed by ELB name.
+    """
+    elb_names = list(elb_names)
+    instance_ids = dict()
+    for start in range(0, len(elb_names), ELB_DESCRIBE_BATCH_SIZE):
+        response = elb_client.describe_load_balancers(
+            LoadBalancerNames=elb_names[start:start + ELB_DESCRIBE_BATCH_SIZE])
+        for description in response['LoadBalancerDescriptions']:
+            instance_ids[description['LoadBalancerName']] = set(
+                instance['InstanceId'] for instance in description.get('Instances', ()))
+    return instance_ids
+
+
+def get_elb_instance_states(elb_client=None, elb_name=None, instance_ids=None):
+    """Return the state (e.g. 'InService') of each of an ELB's instances, keyed by instance id."""
+    response = elb_client.describe_instance_health(
+        LoadBalancerName=elb_name, Instances=[{'InstanceId': instance_id} for instance_id in instance_ids])
+    return dict((state['InstanceId'], state.get('State')) for state in response.get('InstanceStates', ()))
+
+
+def elb_rotate(register=None, deregister=None, region=None, timeout=DEFAULT_ELB_TIMEOUT, max_concurrency=10):
+    """Register and deregister instances on many ELBs at once, waiting until every change has taken effect.
+
+    Changes are requested for all ELBs concurrently. Registrations are complete once every instance is in service
+    and deregistrations once no instance is listed. ELBs are polled with exponential backoff, with the listings
+    of all ELBs still deregistering fetched in batches.
+
+    Args:
+        register (Optional[dict]): Lists of instance ids to register, keyed by ELB name.
+        deregister (Optional[dict]): Lists of instance ids to deregister, keyed by ELB name.
+        region (Optional[unicode]): The region of the ELBs.
+        timeout (float): The number of seconds to wait for the changes to take effect.
+        max_concurrency (int): The maximum number of ELB calls in progress at once.
+    Returns:
+        a dict of booleans, keyed by ELB name, indicating whether all of its changes took effect before the timeout.
+    """
+    register = dict((elb_name, list(ids)) for elb_name, ids in (register or dict()).items() if ids)
+    deregister = dict((elb_name, list(ids)) for elb_name, ids in (deregister or dict()).items() if ids)
+    elb_client = get_elb_client(region=region, max_pool_connections=max_concurrency)
+    pending_register = dict((elb_name, set(ids)) for elb_name, ids in register.items())
+    pending_deregister = dict((elb_name, set(ids)) for elb_name, ids in deregister.items())
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        changes = [executor.submit(elb_client.deregister_instances_from_load_balancer, LoadBalancerName=elb_name,
+                                   Instances=[{'InstanceId': instance_id} for instance_id in ids])
+                   for elb_name, ids in deregister.items()]
+        changes.extend(executor.submit(elb_client.register_instances_with_load_balancer, LoadBalancerName=elb_name,
+                                       Instances=[{'InstanceId': instance_id} for instance_id in ids])
+                       for elb_name, ids in register.items())
+        for change in changes:
+            change.result()
+
+        def check():
+            if pending_deregister:
+                registered = get_elb_instance_ids(elb_client=elb_client, elb_names=pending_deregister)
+                for elb_name, instance_ids in list(pending_deregister.items()):
+                    if not instance_ids & registered.get(elb_name, set()):
+                        del pending_deregister[elb_name]
+            if pending_register:
+                elb_names = list(pending_register)
+                states = executor.map(lambda elb_name: get_elb_instance_states(
+                    elb_client=elb_client, elb_name=elb_name, instance_ids=pending_register[elb_name]), elb_names)
+                for elb_name, instance_states in zip(elb_names, list(states)):
+                    in_service = set(instance_id for instance_id, state in instance_states.items()
+                                     if state == 'InService')
+                    pending_register[elb_name] -= in_service
+                    if not pending_register[elb_name]:
+                        del pending_register[elb_name]
+            return not pending_register and not pending_deregister
+
+        wait_with_backoff(check=check, timeout=timeout)
+    return dict((elb_name, elb_name not in pending_register and elb_name not in pending_deregister)
+                for elb_name in set(register) | set(deregister))
+
+
+def elb_deregister_instances(elb_name=None, instance_ids=None, region=None, timeout=DEFAULT_ELB_TIMEOUT):
+    """De-Register EC2 instances on ELB, returning False if they are still registered after the timeout."""
+    return elb_rotate(deregister={elb_name: instance_ids}, region=region, timeout=timeout).get(elb_name, True)
+
+
+def elb_register_instances(elb_name=None, instance_ids=None, region=None, timeout=DEFAULT_ELB_TIMEOUT):
+    """Register EC2 instances on an ELB, returning False if they are not all in service after the timeout."""
+    return elb_rotate(register={elb_name: instance_ids}, region=region, timeout=timeout).get(elb_name, True)
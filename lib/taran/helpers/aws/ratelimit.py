@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module provides client-side rate limiting of AWS API calls.
+
+Calls are grouped into categories, each with a token bucket budget shared by every client in the process that
+uses the same limiter. A throttled call is retried after a jittered, exponentially increasing delay and halves the
+rate of its category, which then recovers gradually as calls succeed, so throughput degrades smoothly under load
+rather than collapsing into retry storms. Clients made through a limiter should have botocore's own retries
+disabled (see LIMITED_CLIENT_CONFIG), so the limiter's retries are the only ones; it also retries transient server
+and connection errors.
+"""
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'Throttling', 'RequestLimitExceeded')
+TRANSIENT_ERROR_CODES = ('InternalFailure', 'InternalError', 'ServiceUnavailable', 'RequestTimeout')
+
+# botocore configuration for clients whose calls are retried by a limiter
+LIMITED_CLIENT_CONFIG = dict(retries={'max_attempts': 0})
+
+# Budgets are (calls per second, burst) and apply per process
+DEFAULT_SWF_BUDGETS = {
+    'poll': (20, 50),
+    'respond': (20, 50),
+    'history': (10, 25),
+    'describe': (5, 10),
+    'default': (10, 20),
+}
+
+SWF_API_CATEGORIES = {
+    'PollForActivityTask': 'poll',
+    'PollForDecisionTask': 'poll',
+    'RespondActivityTaskCompleted': 'respond',
+    'RespondActivityTaskFailed': 'respond',
+    'RespondActivityTaskCanceled': 'respond',
+    'RespondDecisionTaskCompleted': 'respond',
+    'RecordActivityTaskHeartbeat': 'respond',
+    'GetWorkflowExecutionHistory': 'history',
+    'DescribeWorkflowExecution': 'describe',
+    'DescribeWorkflowType': 'describe',
+    'DescribeActivityType': 'describe',
+    'DescribeDomain': 'describe',
+    'ListOpenWorkflowExecutions': 'describe',
+    'ListClosedWorkflowExecutions': 'describe',
+}
+
+_limiters = dict()
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket whose rate can be adjusted whilst in use.
+
+    Attributes:
+        max_rate (float): The configured number of tokens added per second.
+        rate (float): The current number of tokens added per second.
+        burst (int): The maximum number of tokens held.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting until one is available.
+
+        Returns:
+            the number of seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def decrease(self, factor=0.5, min_rate=0.1):
+        """Reduce the rate, e.g. after being throttled."""
+        with self._lock:
+            self.rate = max(min_rate, self.rate * factor)
+
+    def increase(self, step=0.05):
+        """Recover a proportion of the configured rate, e.g. after a successful call."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * step)
+
+
+def is_throttling_error(exc=None):
+    """Return True if an exception is an AWS throttling error."""
+    return isinstance(exc, ClientError) and exc.response['Error']['Code'] in THROTTLING_ERROR_CODES
+
+
+def is_transient_error(exc=None):
+    """Return True if an exception is a server or connection error that a retry may succeed after."""
+    if isinstance(exc, (ConnectionError, HTTPClientError)):
+        return True
+    if not isinstance(exc, ClientError):
+        return False
+    status_code = exc.response.get('ResponseMetadata', dict()).get('HTTPStatusCode') or 0
+    return exc.response['Error']['Code'] in TRANSIENT_ERROR_CODES or status_code >= 500
+
+
+class RateLimiter(object):
+    """Per-category token buckets with adaptive backoff and metrics on time spent waiting.
+
+    Attributes:
+        buckets (dict): Token buckets keyed by category.
+        max_retries (int): The number of times a throttled or transiently failed call is retried.
+        base_delay (float): The maximum delay, in seconds, before the first retry.
+        max_delay (float): The maximum delay, in seconds, before any retry.
+    """
+
+    def __init__(self, budgets=None, max_retries=5, base_delay=0.5, max_delay=20):
+        budgets = dict(DEFAULT_SWF_BUDGETS, **(budgets or dict()))
+        self.buckets = dict((category, TokenBucket(rate=rate, burst=burst))
+                            for category, (rate, burst) in budgets.items())
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._metrics = dict((category, dict(calls=0, throttled=0, retried=0, wait_seconds=0.0))
+                             for category in budgets)
+        self._metrics_lock = threading.Lock()
+
+    def call(self, category=None, func=None, *args, **kwargs):
+        """Call a function within the budget of a category, retrying if it is throttled or fails transiently.
+
+        Throttling also reduces the category's rate; transient server and connection errors do not.
+        """
+        bucket = self.buckets.get(category) or self.buckets['default']
+        metrics = self._metrics.get(category) or self._metrics['default']
+        attempt = 0
+        while True:
+            waited = bucket.acquire()
+            with self._metrics_lock:
+                metrics['calls'] += 1
+                metrics['wait_seconds'] += waited
+            try:
+                result = func(*args, **kwargs)
+            except (ClientError, ConnectionError, HTTPClientError) as exc:
+                throttled = is_throttling_error(exc=exc)
+                if not (throttled or is_transient_error(exc=exc)) or attempt >= self.max_retries:
+                    raise
+                if throttled:
+                    bucket.decrease()
+                # Full jitter, so throttled callers do not retry in step
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                with self._metrics_lock:
+                    metrics['throttled' if throttled else 'retried'] += 1
+                    metrics['wait_seconds'] += delay
+                time.sleep(delay)
+                attempt += 1
+                continue
+            bucket.increase()
+            return result
+
+    def get_metrics(self):
+        """Return the number of calls, throttled calls, other retried calls and seconds spent waiting, per category."""
+        with self._metrics_lock:
+            return dict((category, dict(metrics)) for category, metrics in self._metrics.items())
+
+
+class RateLimitedClient(object):
+    """A client proxy that makes each API call through a rate limiter.
+
+    Attributes:
+        client: The wrapped boto3 client.
+        limiter (RateLimiter): The limiter calls are made through.
+        categories (dict): Categories keyed by API operation name. Other operations use the 'default' category.
+    """
+
+    def __init__(self, client=None, limiter=None, categories=None):
+        self.client = client
+        self.limiter = limiter
+        self.categories = categories if categories is not None else SWF_API_CATEGORIES
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        operation_name = self.client.meta.method_to_api_mapping.get(name)
+        if not operation_name:
+            return attribute
+        category = self.categories.get(operation_name, 'default')
+
+        def rate_limited_call(*args, **kwargs):
+            return self.limiter.call(category, attribute, *args, **kwargs)
+        return rate_limited_call
+
+
+def get_rate_limiter(name=None, budgets=None):
+    """Get the rate limiter shared by all clients in the process with the same name and budgets.
+
+    Args:
+        name (unicode): the name of the limiter, e.g. the service and region it applies to.
+        budgets (Optional[dict]): (calls per second, burst) tuples keyed by category, overriding the defaults.
+    Returns:
+        a RateLimiter.
+    """
+    limiter_key = (name, repr(sorted((budgets or dict()).items())))
+    with _limiters_lock:
+        if limiter_key not in _limiters:
+            _limiters[limiter_key] = RateLimiter(budgets=budgets)
+        return _limiters[limiter_key]
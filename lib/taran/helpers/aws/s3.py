@@ -3,8 +3,30 @@
 """This module provides utilities to simplify working with Amazon S3."""
 from __future__ import (print_function, unicode_literals)
 
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
+from six import text_type
+
+from taran.errors import TaranError, TaranTransferError
 from taran.helpers.aws.clients import get_s3_client
-from taran.utils.files import write_md5
+from taran.utils.files import SIDECAR_EXTENSIONS, get_md5, write_md5
+
+DEFAULT_MAX_ITEM_CONCURRENCY = 4
+DEFAULT_RANGE_RETRIES = 3
+DEFAULT_STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+# S3 rejects multipart uploads with parts, other than the last, smaller than this
+MIN_PART_SIZE = 5 * 1024 * 1024
+MEBIBYTE = 1024 * 1024
 
 
 def get_s3_md5(s3_client=None, bucket=None, s3_path=None):
@@ -18,20 +40,675 @@ def get_s3_md5(s3_client=None, bucket=None, s3_path=None):
     return etag[1:-1]
 
 
-def s3_download(items=None):
-    """Download an object from S3."""
-    s3_client = get_s3_client()
-    for item in items:
-        s3_path = item.get('s3_path')[1:] if item.get('s3_path').startswith("/") else item.get('s3_path')
-        s3_client.download_file(item.get('bucket'), s3_path, item.get('local_path'))
-        write_md5(file_path=item.get('local_path'))
-    return True
+class TransferProgress(object):
+    """Thread-safe progress of a transfer of several items.
+
+    Attributes:
+        bytes (int): The number of bytes transferred across all items.
+        item_bytes (list): The number of bytes transferred for each item.
+        started (float): The time the transfer started.
+    """
+
+    def __init__(self, items=None, callback=None):
+        self.items = items
+        self.bytes = 0
+        self.item_bytes = [0] * len(items)
+        self.started = time.time()
+        self._callback = callback
+        self._lock = threading.Lock()
+
+    def get_item_callback(self, index=None):
+        """Return a function that records the progress of an item, as expected by boto3's Callback argument."""
+        def item_callback(bytes_transferred):
+            with self._lock:
+                self.bytes += bytes_transferred
+                self.item_bytes[index] += bytes_transferred
+                item_bytes = self.item_bytes[index]
+            if self._callback:
+                self._callback(self.items[index], item_bytes, self)
+        return item_callback
+
+    def get_throughput(self):
+        """Return the average number of bytes transferred per second since the transfer started."""
+        elapsed = time.time() - self.started
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+
+def get_s3_path(item=None):
+    """Get the key of an item's S3 object, without any leading slash."""
+    return item.get('s3_path')[1:] if item.get('s3_path').startswith("/") else item.get('s3_path')
+
+
+def transfer_items(transfer=None, items=None, transfer_config=None, max_concurrency=None, progress_callback=None):
+    """Transfer items concurrently, collecting the result of each.
+
+    Args:
+        transfer (callable): Transfers an item. Called with the s3 client, item, transfer config and a callback
+            to report the bytes transferred to.
+        items (list): The items to transfer.
+        transfer_config (Optional[TransferConfig]): boto3 configuration for the transfer of each item.
+        max_concurrency (Optional[int]): The maximum number of items to transfer at once.
+        progress_callback (Optional[callable]): Called with an item, the bytes transferred for that item so far
+            and the TransferProgress as bytes are transferred.
+    Returns:
+        a dict containing the result of each item, in the order given, and the totals of the transfer.
+    Raises:
+        TaranTransferError: if any item failed to transfer. Its results include those of every item.
+    """
+    items = list(items)
+    transfer_config = transfer_config or TransferConfig()
+    max_concurrency = max_concurrency or DEFAULT_MAX_ITEM_CONCURRENCY
+    # Enough connections for every thread of every item in progress
+    s3_client = get_s3_client(max_pool_connections=max_concurrency * transfer_config.max_concurrency)
+    progress = TransferProgress(items=items, callback=progress_callback)
+
+    def transfer_item(index):
+        item = items[index]
+        result = dict(bucket=item.get('bucket'), s3_path=item.get('s3_path'), local_path=item.get('local_path'),
+                      bytes=0, seconds=0.0, error=None)
+        started = time.time()
+        try:
+            transfer(s3_client=s3_client, item=item, transfer_config=transfer_config,
+                     callback=progress.get_item_callback(index=index))
+        except Exception as exc:
+            result['error'] = exc
+        result['seconds'] = time.time() - started
+        result['bytes'] = progress.item_bytes[index]
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        item_results = list(executor.map(transfer_item, range(len(items))))
+    seconds = time.time() - progress.started
+    total_bytes = sum(result['bytes'] for result in item_results)
+    results = dict(items=item_results, bytes=total_bytes, seconds=seconds,
+                   throughput=total_bytes / seconds if seconds > 0 else 0.0)
+    failed = [result for result in item_results if result['error']]
+    if failed:
+        raise TaranTransferError(message='{0} of {1} items failed to transfer, first error: {2}'.format(
+            len(failed), len(item_results), failed[0]['error']), results=results)
+    return results
+
+
+def check_etag(head=None, md5=None, bucket=None, s3_path=None):
+    """Check that the MD5 of a downloaded object's content matches its ETag, where the ETag is an MD5.
+
+    Multipart ETags, and the ETags of objects encrypted with SSE-KMS or SSE-C, are not the MD5 of the content, so
+    are not checked.
+
+    Raises:
+        TaranError: if the content does not match the ETag.
+    """
+    etag = head['ETag'].strip('"')
+    if '-' in etag or head.get('ServerSideEncryption') == 'aws:kms' or head.get('SSECustomerAlgorithm'):
+        return
+    if etag != md5:
+        raise TaranError('Content of s3://{0}/{1} does not match its ETag.'.format(bucket, s3_path))
+
+
+def stream_download(s3_client=None, bucket=None, s3_path=None, local_path=None, transfer_config=None,
+                    callback=None, head=None):
+    """Download an object to a file, calculating the MD5 of its content as it is written.
+
+    Objects larger than the multipart threshold are requested as ranges of the multipart chunk size, in order, so
+    the content is hashed in a single pass. The file is only moved into place once it is complete, and content
+    that does not match its ETag is rejected (see check_etag).
+
+    Args:
+        s3_client: an s3 client.
+        bucket (unicode): the bucket containing the object.
+        s3_path (unicode): the key of the object.
+        local_path (unicode): the path to save the object to.
+        transfer_config (Optional[TransferConfig]): the multipart threshold, chunk size and read size to use.
+        callback (Optional[callable]): called with the number of bytes written after each read.
+        head (Optional[dict]): the object's head_object response, if already requested.
+    Returns:
+        the MD5 hex digest of the object's content.
+    """
+    transfer_config = transfer_config or TransferConfig()
+    head = head or s3_client.head_object(Bucket=bucket, Key=s3_path)
+    size = head['ContentLength']
+    if size > transfer_config.multipart_threshold:
+        ranges = ['bytes={0}-{1}'.format(start, min(start + transfer_config.multipart_chunksize, size) - 1)
+                  for start in range(0, size, transfer_config.multipart_chunksize)]
+    else:
+        ranges = [None]
+    hash_md5 = hashlib.md5()
+    partial_path = '{0}.{1}.part'.format(local_path, os.getpid())
+    try:
+        with open(partial_path, 'wb') as partial_file:
+            for byte_range in ranges:
+                kwargs = dict(Range=byte_range) if byte_range else dict()
+                body = s3_client.get_object(Bucket=bucket, Key=s3_path, IfMatch=head['ETag'], **kwargs)['Body']
+                for chunk in iter(lambda: body.read(transfer_config.io_chunksize), b''):
+                    partial_file.write(chunk)
+                    hash_md5.update(chunk)
+                    if callback:
+                        callback(len(chunk))
+        md5 = text_type(hash_md5.hexdigest())
+        check_etag(head=head, md5=md5, bucket=bucket, s3_path=s3_path)
+        os.rename(partial_path, local_path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    return md5
+
+
+def write_at(file_descriptor=None, data=None, offset=None, lock=None):
+    """Write data at an offset of a file shared between threads, using os.pwrite where available."""
+    if hasattr(os, 'pwrite'):
+        while data:
+            written = os.pwrite(file_descriptor, data, offset)
+            data, offset = data[written:], offset + written
+        return
+    with lock:
+        os.lseek(file_descriptor, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(file_descriptor, data):]
+
+
+def read_at(file_descriptor=None, size=None, offset=None, lock=None):
+    """Read data from an offset of a file shared between threads, using os.pread where available."""
+    if hasattr(os, 'pread'):
+        return os.pread(file_descriptor, size, offset)
+    with lock:
+        os.lseek(file_descriptor, offset, os.SEEK_SET)
+        return os.read(file_descriptor, size)
+
+
+def is_retryable(exc=None):
+    """Return True if a ranged GET failed for a reason that may not recur, e.g. a dropped connection."""
+    if isinstance(exc, ClientError):
+        error = exc.response.get('Error', dict())
+        status = exc.response.get('ResponseMetadata', dict()).get('HTTPStatusCode') or 0
+        return status >= 500 or error.get('Code') in ('SlowDown', 'RequestTimeout')
+    return isinstance(exc, (BotoCoreError, IOError, OSError))
+
+
+def ranged_download(s3_client=None, bucket=None, s3_path=None, local_path=None, transfer_config=None,
+                    callback=None, head=None, max_retries=DEFAULT_RANGE_RETRIES):
+    """Download an object as byte ranges fetched concurrently into a preallocated file.
+
+    Each range is written at its offset as it arrives and, should its connection fail, retried from the last byte
+    written. Completed ranges are hashed in order, from the page cache, whilst later ranges are still downloading,
+    and content that does not match its ETag is rejected (see check_etag).
+
+    Args:
+        s3_client: an s3 client, with a connection for each concurrent range.
+        bucket (unicode): the bucket containing the object.
+        s3_path (unicode): the key of the object.
+        local_path (unicode): the path to save the object to.
+        transfer_config (Optional[TransferConfig]): the range size (multipart_chunksize), number of concurrent
+            ranges (max_concurrency) and read size (io_chunksize) to use.
+        callback (Optional[callable]): called with the number of bytes written after each read.
+        head (Optional[dict]): the object's head_object response, if already requested.
+        max_retries (int): the number of times each range is retried.
+    Returns:
+        the MD5 hex digest of the object's content.
+    """
+    transfer_config = transfer_config or TransferConfig()
+    head = head or s3_client.head_object(Bucket=bucket, Key=s3_path)
+    size = head['ContentLength']
+    ranges = [(start, min(start + transfer_config.multipart_chunksize, size))
+              for start in range(0, size, transfer_config.multipart_chunksize)]
+    partial_path = '{0}.{1}.part'.format(local_path, os.getpid())
+    lock = threading.Lock()
+    file_descriptor = os.open(partial_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+
+    def download_range(byte_range):
+        offset, end = byte_range
+        attempt = 0
+        while offset < end:
+            try:
+                body = s3_client.get_object(Bucket=bucket, Key=s3_path, IfMatch=head['ETag'],
+                                            Range='bytes={0}-{1}'.format(offset, end - 1))['Body']
+                for chunk in iter(lambda: body.read(transfer_config.io_chunksize), b''):
+                    write_at(file_descriptor=file_descriptor, data=chunk, offset=offset, lock=lock)
+                    offset += len(chunk)
+                    if callback:
+                        callback(len(chunk))
+                if offset < end:
+                    raise IOError('Connection closed {0} bytes before the end of the range.'.format(end - offset))
+            except Exception as exc:
+                if attempt >= max_retries or not is_retryable(exc=exc):
+                    raise
+                time.sleep(min(2 ** attempt * 0.1, 5))
+                attempt += 1
+
+    try:
+        try:
+            if hasattr(os, 'posix_fallocate') and size:
+                os.posix_fallocate(file_descriptor, 0, size)
+            else:
+                os.ftruncate(file_descriptor, size)
+            hash_md5 = hashlib.md5()
+            with ThreadPoolExecutor(max_workers=transfer_config.max_concurrency) as executor:
+                futures = [executor.submit(download_range, byte_range) for byte_range in ranges]
+                try:
+                    for (start, end), future in zip(ranges, futures):
+                        future.result()
+                        for offset in range(start, end, transfer_config.io_chunksize):
+                            hash_md5.update(read_at(file_descriptor=file_descriptor, offset=offset, lock=lock,
+                                                    size=min(transfer_config.io_chunksize, end - offset)))
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            os.close(file_descriptor)
+        md5 = text_type(hash_md5.hexdigest())
+        check_etag(head=head, md5=md5, bucket=bucket, s3_path=s3_path)
+        os.rename(partial_path, local_path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    return md5
+
+
+def download_object(s3_client=None, bucket=None, s3_path=None, local_path=None, transfer_config=None,
+                    callback=None, head=None):
+    """Download an object, as concurrent ranges if it is larger than the multipart threshold.
+
+    Returns:
+        the MD5 hex digest of the object's content.
+    """
+    transfer_config = transfer_config or TransferConfig()
+    head = head or s3_client.head_object(Bucket=bucket, Key=s3_path)
+    if head['ContentLength'] > transfer_config.multipart_threshold and transfer_config.max_concurrency > 1:
+        download = ranged_download
+    else:
+        download = stream_download
+    return download(s3_client=s3_client, bucket=bucket, s3_path=s3_path, local_path=local_path,
+                    transfer_config=transfer_config, callback=callback, head=head)
+
+
+def download_item(s3_client=None, item=None, transfer_config=None, callback=None, artifact_cache=None):
+    """Download an item's object, through the artifact cache if given, and write the MD5 of the downloaded file."""
+    bucket, s3_path = item.get('bucket'), get_s3_path(item=item)
+    if artifact_cache:
+        head = s3_client.head_object(Bucket=bucket, Key=s3_path)
+        md5, _ = artifact_cache.fetch(
+            bucket=bucket, s3_path=s3_path, etag=head['ETag'], local_path=item.get('local_path'),
+            download=lambda entry_path: download_object(
+                s3_client=s3_client, bucket=bucket, s3_path=s3_path, local_path=entry_path,
+                transfer_config=transfer_config, callback=callback, head=head))
+    else:
+        md5 = download_object(s3_client=s3_client, bucket=bucket, s3_path=s3_path, local_path=item.get('local_path'),
+                              transfer_config=transfer_config, callback=callback)
+    write_md5(file_path=item.get('local_path'), md5=md5)
+
+
+def upload_item(s3_client=None, item=None, transfer_config=None, callback=None):
+    """Upload an item's file."""
+    s3_client.upload_file(item.get('local_path'), item.get('bucket'), get_s3_path(item=item), Config=transfer_config,
+                          Callback=callback)
+
+
+def s3_download(items=None, transfer_config=None, max_concurrency=None, progress_callback=None,
+                artifact_cache=None):
+    """Download objects from S3 concurrently.
+
+    Args:
+        items (list): dicts containing the 'bucket' and 's3_path' of each object and the 'local_path' to save it to.
+        transfer_config (Optional[TransferConfig]): the multipart threshold, chunk size and concurrency to use for
+            each object.
+        max_concurrency (Optional[int]): the maximum number of objects to download at once.
+        progress_callback (Optional[callable]): called with an item, the bytes downloaded for that item so far and
+            the TransferProgress as bytes are downloaded.
+        artifact_cache (Optional[ArtifactCache]): a host-local cache to fetch objects through, so objects already
+            on the host are linked into place rather than downloaded.
+    Returns:
+        a dict containing the result of each item ('bytes', 'seconds' and 'error'), the total 'bytes', the
+        'seconds' taken and the 'throughput' in bytes per second.
+    """
+    return transfer_items(transfer=partial(download_item, artifact_cache=artifact_cache), items=items,
+                          transfer_config=transfer_config, max_concurrency=max_concurrency,
+                          progress_callback=progress_callback)
 
 
-def s3_upload(items=None):
-    """Upload an object to S3."""
-    s3_client = get_s3_client()
+def s3_upload(items=None, transfer_config=None, max_concurrency=None, progress_callback=None):
+    """Upload objects to S3 concurrently.
+
+    Args:
+        items (list): dicts containing the 'local_path' of each file and the 'bucket' and 's3_path' to upload to.
+        transfer_config (Optional[TransferConfig]): the multipart threshold, chunk size and concurrency to use for
+            each object.
+        max_concurrency (Optional[int]): the maximum number of objects to upload at once.
+        progress_callback (Optional[callable]): called with an item, the bytes uploaded for that item so far and
+            the TransferProgress as bytes are uploaded.
+    Returns:
+        a dict containing the result of each item ('bytes', 'seconds' and 'error'), the total 'bytes', the
+        'seconds' taken and the 'throughput' in bytes per second.
+    """
+    return transfer_items(transfer=upload_item, items=items, transfer_config=transfer_config,
+                          max_concurrency=max_concurrency, progress_callback=progress_callback)
+
+
+def list_s3_objects(s3_client=None, bucket=None, s3_prefix=None):
+    """List the objects under a prefix.
+
+    Args:
+        s3_client: an s3 client.
+        bucket (unicode): the bucket to list.
+        s3_prefix (unicode): the prefix of the keys to list.
+    Returns:
+        a dict of object summaries (including 'Size' and 'ETag') keyed by key.
+    """
+    objects = dict()
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=s3_prefix):
+        for s3_object in page.get('Contents', ()):
+            objects[s3_object['Key']] = s3_object
+    return objects
+
+
+def get_multipart_etag(file_path=None, chunk_size=None):
+    """Calculate the ETag S3 gives an object uploaded in parts of chunk_size: the MD5 of the parts' MD5s."""
+    part_digests = list()
+    with open(file_path, 'rb') as local_file:
+        for chunk in iter(lambda: local_file.read(chunk_size), b''):
+            part_digests.append(hashlib.md5(chunk).digest())
+    return '{0}-{1}'.format(hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+
+
+def is_unchanged(local_path=None, size=None, etag=None, transfer_config=None):
+    """Return True if a local file has the same content as an S3 object.
+
+    Sizes are compared first. Single part ETags are compared with the file's MD5 (see get_md5); multipart ETags are
+    compared with the ETag of the file split using the configured chunk size or, failing that, the chunk size
+    implied by the ETag's part count.
+
+    Args:
+        local_path (unicode): the local file.
+        size (int): the size of the object.
+        etag (unicode): the ETag of the object.
+        transfer_config (Optional[TransferConfig]): the configuration the object was likely uploaded with.
+    """
+    if not os.path.isfile(local_path) or os.path.getsize(local_path) != size:
+        return False
+    etag = etag.strip('"')
+    if '-' not in etag:
+        return get_md5(file_path=local_path) == etag
+    part_count = int(etag.split('-')[1])
+    chunk_sizes = [(transfer_config or TransferConfig()).multipart_chunksize]
+    implied_chunk_size = -(-size // part_count)
+    chunk_sizes.append(-(-implied_chunk_size // MEBIBYTE) * MEBIBYTE)
+    for chunk_size in chunk_sizes:
+        if -(-size // chunk_size) == part_count and get_multipart_etag(file_path=local_path,
+                                                                       chunk_size=chunk_size) == etag:
+            return True
+    return False
+
+
+def s3_sync(bucket=None, s3_prefix=None, local_dir=None, direction='download', transfer_config=None,
+            max_concurrency=None, progress_callback=None):
+    """Synchronise a local directory and an S3 prefix, transferring only the files that differ.
+
+    Remote ETags and sizes come from a single prefix listing rather than a request per object and are compared
+    with local MD5 sidecars, so unchanged files cost neither a transfer nor a request of their own.
+
+    Args:
+        bucket (unicode): the bucket to synchronise with.
+        s3_prefix (unicode): the prefix of the keys to synchronise with.
+        local_dir (unicode): the directory to synchronise with.
+        direction (unicode): 'download' to update local_dir from S3 or 'upload' to update S3 from local_dir.
+        transfer_config (Optional[TransferConfig]): the multipart threshold, chunk size and concurrency to use for
+            each object.
+        max_concurrency (Optional[int]): the maximum number of objects to transfer at once.
+        progress_callback (Optional[callable]): called with an item, the bytes transferred for that item so far and
+            the TransferProgress as bytes are transferred.
+    Returns:
+        the results of the transfer, as returned by s3_download or s3_upload, and the 'unchanged' items.
+    Raises:
+        TaranError: if downloading a key would write outside local_dir, e.g. a key containing '..'. Nothing is
+            downloaded.
+    """
+    if direction not in ('download', 'upload'):
+        raise ValueError('direction must be one of: download, upload')
+    s3_prefix = (s3_prefix or '').lstrip('/')
+    if s3_prefix and not s3_prefix.endswith('/'):
+        s3_prefix += '/'
+    remote_objects = list_s3_objects(s3_client=get_s3_client(), bucket=bucket, s3_prefix=s3_prefix)
+    items = list()
+    if direction == 'download':
+        root_dir = os.path.realpath(local_dir)
+        for key, s3_object in sorted(remote_objects.items()):
+            if key.endswith('/'):
+                continue
+            local_path = os.path.join(local_dir, *key[len(s3_prefix):].split('/'))
+            if not os.path.realpath(local_path).startswith(root_dir.rstrip(os.path.sep) + os.path.sep):
+                raise TaranError('s3://{0}/{1} would be written outside {2}.'.format(bucket, key, local_dir))
+            items.append(dict(bucket=bucket, s3_path=key, local_path=local_path, size=s3_object['Size'],
+                              etag=s3_object['ETag']))
+    else:
+        for directory, _, file_names in os.walk(local_dir):
+            for file_name in sorted(file_names):
+                if file_name.endswith(SIDECAR_EXTENSIONS + ('.part',)):
+                    continue
+                local_path = os.path.join(directory, file_name)
+                key = s3_prefix + os.path.relpath(local_path, local_dir).replace(os.path.sep, '/')
+                s3_object = remote_objects.get(key, dict())
+                items.append(dict(bucket=bucket, s3_path=key, local_path=local_path, size=s3_object.get('Size'),
+                                  etag=s3_object.get('ETag')))
+    changed, unchanged = list(), list()
     for item in items:
-        s3_path = item.get('s3_path')[1:] if item.get('s3_path').startswith("/") else item.get('s3_path')
-        s3_client.upload_file(item.get('local_path'), item.get('bucket'), s3_path)
-    return True
+        if item['etag'] and is_unchanged(local_path=item['local_path'], size=item['size'], etag=item['etag'],
+                                         transfer_config=transfer_config):
+            unchanged.append(item)
+        else:
+            changed.append(item)
+    if direction == 'download':
+        for item in changed:
+            if not os.path.isdir(os.path.dirname(item['local_path'])):
+                os.makedirs(os.path.dirname(item['local_path']))
+        results = s3_download(items=changed, transfer_config=transfer_config, max_concurrency=max_concurrency,
+                              progress_callback=progress_callback)
+    else:
+        results = s3_upload(items=changed, transfer_config=transfer_config, max_concurrency=max_concurrency,
+                            progress_callback=progress_callback)
+    results['unchanged'] = unchanged
+    return results
+
+
+def iter_s3_chunks(s3_client=None, bucket=None, s3_path=None, chunk_size=DEFAULT_STREAM_CHUNK_SIZE,
+                   read_ahead=2):
+    """Iterate over the content of an object in chunks, fetching the next chunks whilst the current one is used.
+
+    Chunks are requested as ranges of the version of the object that was current when iteration started, so at
+    most read_ahead + 1 chunks are held in memory whatever the size of the object.
+
+    Args:
+        s3_client (Optional): an s3 client. Defaults to the shared client.
+        bucket (unicode): the bucket containing the object.
+        s3_path (unicode): the key of the object.
+        chunk_size (int): the size of each chunk.
+        read_ahead (int): the number of chunks to fetch ahead of the one being used. 0 fetches each on demand.
+    Yields:
+        the object's content, as bytes.
+    """
+    s3_client = s3_client or get_s3_client()
+    s3_path = s3_path.lstrip('/')
+    head = s3_client.head_object(Bucket=bucket, Key=s3_path)
+    size = head['ContentLength']
+
+    def get_chunk(start):
+        return s3_client.get_object(Bucket=bucket, Key=s3_path, IfMatch=head['ETag'], Range='bytes={0}-{1}'.format(
+            start, min(start + chunk_size, size) - 1))['Body'].read()
+
+    starts = iter(range(0, size, chunk_size))
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max(1, read_ahead))
+    try:
+        while True:
+            for start in islice(starts, read_ahead + 1 - len(pending)):
+                pending.append(executor.submit(get_chunk, start))
+            if not pending:
+                break
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+class S3Reader(io.RawIOBase):
+    """A read-only, unseekable file-like view of an object's content, read ahead in chunks.
+
+    Use open_s3_reader for a buffered reader supporting readline and iteration over lines.
+    """
+
+    def __init__(self, s3_client=None, bucket=None, s3_path=None, chunk_size=DEFAULT_STREAM_CHUNK_SIZE,
+                 read_ahead=2):
+        super(S3Reader, self).__init__()
+        self._chunks = iter_s3_chunks(s3_client=s3_client, bucket=bucket, s3_path=s3_path, chunk_size=chunk_size,
+                                      read_ahead=read_ahead)
+        self._chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        """Read up to len(buffer) bytes into buffer, returning the number of bytes read (0 at the end)."""
+        if not len(self._chunk):
+            self._chunk = memoryview(next(self._chunks, b''))
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._chunks.close()
+        super(S3Reader, self).close()
+
+
+def open_s3_reader(s3_client=None, bucket=None, s3_path=None, chunk_size=DEFAULT_STREAM_CHUNK_SIZE, read_ahead=2):
+    """Open an object for streaming reads, without writing it to disk.
+
+    Args:
+        s3_client (Optional): an s3 client. Defaults to the shared client.
+        bucket (unicode): the bucket containing the object.
+        s3_path (unicode): the key of the object.
+        chunk_size (int): the size of each ranged request.
+        read_ahead (int): the number of chunks to fetch ahead of the one being read.
+    Returns:
+        a buffered binary file-like object. Wrap it in io.TextIOWrapper to read text.
+    """
+    return io.BufferedReader(S3Reader(s3_client=s3_client, bucket=bucket, s3_path=s3_path, chunk_size=chunk_size,
+                                      read_ahead=read_ahead), buffer_size=min(chunk_size, io.DEFAULT_BUFFER_SIZE * 8))
+
+
+class S3Writer(io.RawIOBase):
+    """A write-only file-like object that streams its content to an object as a multipart upload.
+
+    Parts are uploaded in the background as they fill, with at most max_in_flight parts held in memory; writes
+    block whilst that many are uploading. Content smaller than one part is uploaded with a single put. The upload
+    is only completed by commit, which a with block calls when it exits without an exception. Closing the writer
+    without committing it, including when an uncommitted writer is garbage collected, aborts the upload, so partial
+    content is never published.
+
+    Attributes:
+        bucket (unicode): The bucket to upload to.
+        s3_path (unicode): The key to upload to.
+        part_size (int): The size of each part, at least MIN_PART_SIZE.
+        upload_id (unicode): The id of the multipart upload, once started.
+    """
+
+    def __init__(self, s3_client=None, bucket=None, s3_path=None, part_size=DEFAULT_STREAM_CHUNK_SIZE,
+                 max_in_flight=2, extra_args=None):
+        """Initialise a writer.
+
+        Args:
+            s3_client (Optional): an s3 client. Defaults to the shared client.
+            bucket (unicode): the bucket to upload to.
+            s3_path (unicode): the key to upload to.
+            part_size (int): the size of each part.
+            max_in_flight (int): the maximum number of parts uploading at once.
+            extra_args (Optional[dict]): further arguments for the upload, e.g. ContentType.
+        """
+        super(S3Writer, self).__init__()
+        self.s3_client = s3_client or get_s3_client()
+        self.bucket = bucket
+        self.s3_path = s3_path.lstrip('/')
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.upload_id = None
+        self._extra_args = extra_args or dict()
+        self._buffer = bytearray()
+        self._parts = list()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """Buffer data, uploading each part as it fills. Returns the number of bytes written."""
+        if self.closed:
+            raise ValueError('write to closed file')
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.part_size:
+            self.upload_part(data=bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def upload_part(self, data=None):
+        """Upload a part in the background, starting the multipart upload if necessary."""
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.s3_path,
+                                                                    **self._extra_args)['UploadId']
+        part_number = len(self._parts) + 1
+        self._in_flight.acquire()
+        # The upload must not reference the writer, so a dropped writer is finalised (and aborted) promptly
+        s3_client, bucket, s3_path, upload_id, in_flight = (self.s3_client, self.bucket, self.s3_path, self.upload_id,
+                                                            self._in_flight)
+
+        def upload():
+            try:
+                return dict(PartNumber=part_number, ETag=s3_client.upload_part(
+                    Bucket=bucket, Key=s3_path, UploadId=upload_id, PartNumber=part_number, Body=data)['ETag'])
+            finally:
+                in_flight.release()
+        self._parts.append(self._executor.submit(upload))
+
+    def commit(self):
+        """Upload any buffered content, complete the upload and close the writer."""
+        if self.closed:
+            raise ValueError('commit of closed file')
+        try:
+            if self.upload_id is None:
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.s3_path, Body=bytes(self._buffer),
+                                          **self._extra_args)
+            else:
+                if self._buffer:
+                    self.upload_part(data=bytes(self._buffer))
+                parts = [part.result() for part in self._parts]
+                self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.s3_path,
+                                                         UploadId=self.upload_id, MultipartUpload=dict(Parts=parts))
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            self._executor.shutdown(wait=False)
+            super(S3Writer, self).close()
+
+    def close(self):
+        """Abort the upload, unless it has been committed."""
+        if not self.closed:
+            self.abort()
+
+    def abort(self):
+        """Discard the content written and abort the upload."""
+        for part in self._parts:
+            part.cancel()
+        self._executor.shutdown(wait=True)
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.s3_path, UploadId=self.upload_id)
+        self._buffer = bytearray()
+        super(S3Writer, self).close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
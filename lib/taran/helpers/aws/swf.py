@@ -3,8 +3,48 @@
 """This module provides utilities to simplify working with Amazon SWF."""
 from __future__ import (absolute_import, print_function, unicode_literals)
 
+import json
+import re
+import threading
+import uuid
+from collections import defaultdict
+from operator import itemgetter
+
+from six import string_types
+
 from taran.errors import TaranError
 
+ACTIVITY_EVENT_STATUSES = {
+    'ActivityTaskScheduled': 'scheduled',
+    'ActivityTaskStarted': 'started',
+    'ActivityTaskCompleted': 'completed',
+    'ActivityTaskFailed': 'failed',
+    'ActivityTaskTimedOut': 'timed_out',
+    'ActivityTaskCanceled': 'cancelled',
+    'ActivityTaskCancelRequested': 'cancel_requested',
+}
+
+CHILD_WORKFLOW_EVENT_STATUSES = {
+    'StartChildWorkflowExecutionInitiated': 'initiated',
+    'StartChildWorkflowExecutionFailed': 'start_failed',
+    'ChildWorkflowExecutionStarted': 'started',
+    'ChildWorkflowExecutionCompleted': 'completed',
+    'ChildWorkflowExecutionFailed': 'failed',
+    'ChildWorkflowExecutionTimedOut': 'timed_out',
+    'ChildWorkflowExecutionCanceled': 'cancelled',
+    'ChildWorkflowExecutionTerminated': 'terminated',
+}
+
+# SWF accepts at most 100 decisions per decision task
+MAX_DECISIONS = 100
+CLOSE_DECISION_TYPES = ('CompleteWorkflowExecution', 'FailWorkflowExecution', 'CancelWorkflowExecution',
+                        'ContinueAsNewWorkflowExecution')
+OVERFLOW_TIMER_PREFIX = 'taran-overflow-'
+# The maximum length of a timer's control data
+MAX_CONTROL_LENGTH = 32768
+# SWF does not allow these in names and ids, e.g. of task lists, activities and timers
+SWF_FORBIDDEN_NAME_PATTERN = re.compile(r'[:/|\s\x00-\x1f\x7f-\x9f]|arn')
+
 
 def get_activity_version(activity_type=None,
                          activity_list=None):
@@ -24,6 +64,22 @@ def get_activity_version(activity_type=None,
         raise AttributeError('Activity is not a dict')
 
 
+def clean_swf_name(value=None, replacement='-'):
+    """Replace the characters, and the literal string 'arn', that SWF does not allow in names and ids."""
+    return SWF_FORBIDDEN_NAME_PATTERN.sub(replacement, value)
+
+
+def get_activity_versions(activity_list=None):
+    """Map the name of each activity to its version, so versions are looked up rather than searched for.
+
+    Args:
+        activity_list (list): the list of activities.
+    Returns:
+        a dict of versions keyed by activity name.
+    """
+    return dict((activity.get('name'), activity.get('version')) for activity in activity_list or ())
+
+
 def get_activity_history(workflow_history=None, scheduled_ids=None, activity_type=None):
     """Get workflow history for a specific activity.
 
@@ -35,58 +91,529 @@ def get_activity_history(workflow_history=None, scheduled_ids=None, activity_typ
     Returns:
         a list of events from the workflow history that match the specified activity type.
     """
-    if not any((scheduled_ids, activity_type)):
-        raise TaranError('scheduled_ids and/or activity_type required.')
-    if not scheduled_ids:
-        scheduled_id_list = list()
-        for event in workflow_history.get('events'):
-            if (event.get('eventType') == 'ActivityTaskScheduled' and
-                        event['activityTaskScheduledEventAttributes']['activityType']['name'] == activity_type):
-                scheduled_id_list.append(event.get('eventId'))
-        if scheduled_id_list:
-            return get_activity_history(workflow_history=workflow_history,
-                                        scheduled_ids=scheduled_id_list,
-                                        activity_type=activity_type)
-    elif scheduled_ids:
-        statuses_list = list()
-        for event in workflow_history.get('events'):
+    return WorkflowHistory.from_workflow_history(workflow_history=workflow_history).get_activity_history(
+        scheduled_ids=scheduled_ids, activity_type=activity_type)
+
+
+def iter_history_pages(get_page=None, first_page=None, prefetch=False):
+    """Iterate over the pages of a workflow history, requesting each page only when it is reached.
+
+    Args:
+        get_page (callable): a function that accepts a next_page_token and returns the following page.
+        first_page (Optional[dict]): a page that has already been retrieved, e.g. as part of a decision task.
+        prefetch (bool): request the next page on a background thread whilst the current page is processed.
+    Yields:
+        each page of the workflow history.
+    """
+    page = first_page if first_page is not None else get_page(next_page_token=None)
+    while True:
+        if not page:
+            raise TaranError('No response when retrieving workflow history.')
+        next_page_token = page.get('nextPageToken')
+        next_page = None
+        if prefetch and next_page_token:
+            next_page = PageFetcher(get_page=get_page, next_page_token=next_page_token)
+            next_page.start()
+        yield page
+        if not next_page_token:
+            return
+        page = next_page.result() if next_page else get_page(next_page_token=next_page_token)
+
+
+def iter_history_events(pages=None):
+    """Iterate over the events in pages of workflow history.
+
+    Args:
+        pages (iterable): pages of workflow history, e.g. from iter_history_pages.
+    Yields:
+        each event, in the order they appear in the pages.
+    """
+    for page in pages:
+        for event in page.get('events') or ():
+            yield event
+
+
+class PageFetcher(threading.Thread):
+    """Retrieve a page of workflow history on a background thread."""
+
+    def __init__(self, get_page=None, next_page_token=None):
+        super(PageFetcher, self).__init__()
+        self.daemon = True
+        self.get_page = get_page
+        self.next_page_token = next_page_token
+        self.page = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.page = self.get_page(next_page_token=self.next_page_token)
+        except Exception as exc:
+            self.error = exc
+
+    def result(self):
+        """Wait for the page to be retrieved and return it, raising any error encountered."""
+        self.join()
+        if self.error:
+            raise self.error
+        return self.page
+
+
+def get_event_attributes(event=None):
+    """Get the attributes of an event, e.g. 'activityTaskStartedEventAttributes' for an 'ActivityTaskStarted' event.
+
+    Args:
+        event (dict): a workflow history event.
+    Returns:
+        the event's attributes, or an empty dict if it has none.
+    """
+    event_type = event.get('eventType')
+    return event.get('{0}{1}EventAttributes'.format(event_type[:1].lower(), event_type[1:]), {})
+
+
+def describe_activity_event(event=None):
+    """Summarise an activity task event as a status record.
+
+    Args:
+        event (dict): an activity task event.
+    Returns:
+        a dict containing the status of the activity and details relevant to that status.
+    """
+    attributes = get_event_attributes(event=event)
+    status = {'status': ACTIVITY_EVENT_STATUSES[event['eventType']], 'event_id': event.get('eventId')}
+    if event['eventType'] == 'ActivityTaskScheduled':
+        status['task_list'] = attributes['taskList']['name']
+    elif event['eventType'] == 'ActivityTaskStarted':
+        status['scheduled_event_id'] = attributes['scheduledEventId']
+        status['identity'] = attributes['identity']
+    elif event['eventType'] == 'ActivityTaskCompleted':
+        status['result'] = attributes['result']
+        status['scheduled_event_id'] = attributes['scheduledEventId']
+    return status
+
+
+def describe_child_workflow_event(event=None):
+    """Summarise a child workflow execution event as a status record.
+
+    Args:
+        event (dict): a child workflow execution event.
+    Returns:
+        a dict containing the status of the child workflow and details relevant to that status.
+    """
+    attributes = get_event_attributes(event=event)
+    status = {'status': CHILD_WORKFLOW_EVENT_STATUSES[event['eventType']], 'event_id': event.get('eventId')}
+    if 'workflowExecution' in attributes:
+        status['run_id'] = attributes['workflowExecution'].get('runId')
+    if event['eventType'] == 'StartChildWorkflowExecutionInitiated':
+        status['control'] = attributes.get('control')
+    elif event['eventType'] == 'StartChildWorkflowExecutionFailed':
+        status['cause'] = attributes.get('cause')
+    elif event['eventType'] == 'ChildWorkflowExecutionCompleted':
+        status['result'] = attributes.get('result')
+    elif event['eventType'] == 'ChildWorkflowExecutionFailed':
+        status['reason'] = attributes.get('reason')
+        status['details'] = attributes.get('details')
+    elif event['eventType'] == 'ChildWorkflowExecutionTimedOut':
+        status['timeout_type'] = attributes.get('timeoutType')
+    return status
+
+
+class WorkflowHistory(object):
+    """An index of the events in a workflow execution history.
+
+    Events are indexed as they are added - by event type, by activity type name, by scheduled event id and by child
+    workflow id - so queries made whilst processing a decision task are dictionary lookups rather than scans of the
+    history.
+
+    Attributes:
+        events (list): the indexed events, in the order they were added.
+        last_event_id (int): the highest event id indexed.
+    """
+
+    def __init__(self, events=None):
+        self.events = list()
+        self.last_event_id = 0
+        self._events_by_id = dict()
+        self._events_by_type = defaultdict(list)
+        self._scheduled_events_by_activity_type = defaultdict(list)
+        self._events_by_scheduled_id = defaultdict(list)
+        self._cancel_requests_by_activity_id = defaultdict(list)
+        self._child_events_by_workflow_id = defaultdict(list)
+        self._source_events = events
+        self._source_length = len(events) if events else 0
+        if events:
+            self.add_events(events=events)
+
+    @classmethod
+    def from_workflow_history(cls, workflow_history=None):
+        """Build an index from a workflow history dict, as returned when polling or fetching history.
+
+        Args:
+            workflow_history (dict): a workflow history containing a list of 'events'.
+        Returns:
+            a WorkflowHistory of the events.
+        """
+        return cls(events=workflow_history.get('events') if workflow_history else None)
+
+    def __len__(self):
+        return len(self.events)
+
+    def __contains__(self, event_id):
+        return event_id in self._events_by_id
+
+    def is_index_of(self, events=None):
+        """Return True if the given list of events is the index's own, or the unchanged list it was built from."""
+        return events is self.events or (events is self._source_events and len(events or ()) == self._source_length)
+
+    def add_events(self, events=None):
+        """Index events, ignoring any that have already been indexed.
+
+        Args:
+            events (list): workflow history events, in any order.
+        """
+        for event in events:
+            event_id = event.get('eventId')
+            if event_id in self._events_by_id:
+                continue
+            self._events_by_id[event_id] = event
+            self.events.append(event)
+            self.last_event_id = max(self.last_event_id, event_id)
             event_type = event.get('eventType')
-            if (event_type == 'ActivityTaskCompleted' and
-                        event['activityTaskCompletedEventAttributes']['scheduledEventId'] in scheduled_ids):
-                statuses_list.append(
-                    {
-                        'status': 'completed',
-                        'event_id': event.get('eventId'),
-                        'result': event['activityTaskCompletedEventAttributes']['result'],
-                        'scheduled_event_id': event['activityTaskCompletedEventAttributes']['scheduledEventId']})
-            elif (event_type == 'ActivityTaskScheduled' and
-                          event['activityTaskScheduledEventAttributes']['activityType']['name'] == activity_type):
-                statuses_list.append({'status': 'scheduled',
-                                      'event_id': event.get('eventId'),
-                                      'task_list': event['activityTaskScheduledEventAttributes']['taskList']['name']})
-            elif (event_type == 'ActivityTaskStarted' and
-                          event['activityTaskStartedEventAttributes']['scheduledEventId'] in scheduled_ids):
-                statuses_list.append({'status': 'started',
-                                      'event_id': event.get('eventId'),
-                                      'scheduled_event_id': event['activityTaskStartedEventAttributes'][
-                                          'scheduledEventId'],
-                                      'identity': event['activityTaskStartedEventAttributes']['identity']})
-            elif (event_type == 'ActivityTaskFailed' and
-                          event['activityTaskFailedEventAttributes']['scheduledEventId'] in scheduled_ids):
-                statuses_list.append({'status': 'failed',
-                                      'event_id': event.get('eventId')})
-            elif (event_type == 'ActivityTaskTimedOut' and
-                          event['activityTaskTimedOutEventAttributes']['scheduledEventId'] in scheduled_ids):
-                statuses_list.append({'status': 'timed_out',
-                                      'event_id': event.get('eventId')})
-            elif (event_type == 'ActivityTaskCanceled' and
-                          event['activityTaskCanceledEventAttributes']['scheduledEventId'] in scheduled_ids):
-                statuses_list.append({'status': 'cancelled',
-                                      'event_id': event.get('eventId')})
-            elif (event_type == 'ActivityTaskCancelRequested' and
-                          event['activityTaskCancelRequestedEventAttributes']['scheduledEventId'] in scheduled_ids):
-                statuses_list.append({'status': 'cancel_requested',
-                                      'event_id': event.get('eventId')})
-            elif event_type.startswith('Decision'):
-                pass
-        return statuses_list
+            self._events_by_type[event_type].append(event)
+            if event_type in CHILD_WORKFLOW_EVENT_STATUSES:
+                attributes = get_event_attributes(event=event)
+                # Events before the child starts carry its workflow id, and those after its execution
+                workflow_id = attributes.get('workflowId') or attributes['workflowExecution']['workflowId']
+                self._child_events_by_workflow_id[workflow_id].append(event)
+                continue
+            if event_type not in ACTIVITY_EVENT_STATUSES:
+                continue
+            attributes = get_event_attributes(event=event)
+            if event_type == 'ActivityTaskScheduled':
+                self._scheduled_events_by_activity_type[attributes['activityType']['name']].append(event)
+            elif event_type == 'ActivityTaskCancelRequested':
+                # Cancel requests reference the activity id rather than the scheduled event
+                self._cancel_requests_by_activity_id[attributes.get('activityId')].append(event)
+            else:
+                self._events_by_scheduled_id[attributes['scheduledEventId']].append(event)
+
+    def get_event(self, event_id=None):
+        """Get an event by its id, or None if it has not been indexed."""
+        return self._events_by_id.get(event_id)
+
+    def get_events(self, event_type=None):
+        """Get all events of the specified type, ordered by event id.
+
+        Args:
+            event_type (unicode): the type of event, e.g. 'ActivityTaskCompleted'.
+        Returns:
+            a list of matching events.
+        """
+        return sorted(self._events_by_type.get(event_type, ()), key=itemgetter('eventId'))
+
+    def get_workflow_input(self):
+        """Get the input specified when the workflow execution was started."""
+        started_events = self._events_by_type.get('WorkflowExecutionStarted')
+        if started_events:
+            return json.loads(started_events[0]['workflowExecutionStartedEventAttributes']['input'])
+
+    def get_activity_statuses(self, activity_type=None):
+        """Get the latest status of each activity, keyed by activity id.
+
+        Args:
+            activity_type (Optional[unicode]): the type of activity to restrict the statuses to.
+        Returns:
+            a dict of status records, as returned by get_activity_history. An activity scheduled more than once has
+            the status of its latest scheduling.
+        """
+        statuses = dict()
+        for scheduled_event in self.get_events(event_type='ActivityTaskScheduled'):
+            attributes = get_event_attributes(event=scheduled_event)
+            if activity_type and attributes['activityType']['name'] != activity_type:
+                continue
+            events = [scheduled_event] + self._events_by_scheduled_id.get(scheduled_event['eventId'], list())
+            events.extend(event for event in self._cancel_requests_by_activity_id.get(attributes['activityId'], ())
+                          if event['eventId'] > scheduled_event['eventId'])
+            statuses[attributes['activityId']] = describe_activity_event(event=max(events, key=itemgetter('eventId')))
+        return statuses
+
+    def get_deferred_decisions(self, after_event_id=0):
+        """Get the decisions deferred by DecisionBuilder.take_batch to overflow timers that have fired since an event.
+
+        The decisions deferred by one response are restored once all of its overflow timers have fired, so a
+        decision closing the workflow is never made ahead of decisions deferred with it.
+
+        Args:
+            after_event_id (int): The DecisionTaskStarted event id of the last decision task processed, whose
+                decisions have already been made.
+        Returns:
+            a list of decisions, in the order they were added to the builder.
+        """
+        groups = defaultdict(dict)
+        for fired_event in self.get_events(event_type='TimerFired'):
+            attributes = get_event_attributes(event=fired_event)
+            if not attributes['timerId'].startswith(OVERFLOW_TIMER_PREFIX):
+                continue
+            group, index, count = attributes['timerId'][len(OVERFLOW_TIMER_PREFIX):].rsplit('-', 2)
+            started_event = self.get_event(event_id=attributes['startedEventId'])
+            if started_event is None:
+                raise TaranError('Overflow timer started event missing: {0}'.format(attributes['startedEventId']))
+            groups[group][int(index)] = (started_event['eventId'], fired_event['eventId'], int(count),
+                                         get_event_attributes(event=started_event).get('control'))
+        decisions = list()
+        for timers in sorted(groups.values(), key=lambda timers: min(timer[0] for timer in timers.values())):
+            count = next(iter(timers.values()))[2]
+            if len(timers) < count or max(timer[1] for timer in timers.values()) <= after_event_id:
+                continue
+            for index in range(count):
+                decisions.extend(json.loads(timers[index][3]))
+        return decisions
+
+    def get_child_workflow_statuses(self, workflow_type=None):
+        """Get the latest status of each child workflow, keyed by workflow id.
+
+        Args:
+            workflow_type (Optional[unicode]): the type of workflow to restrict the statuses to.
+        Returns:
+            a dict of status records, as returned by describe_child_workflow_event, each with the number of
+            'attempts' made to start the child.
+        """
+        statuses = dict()
+        for workflow_id, events in self._child_events_by_workflow_id.items():
+            latest = max(events, key=itemgetter('eventId'))
+            if workflow_type and get_event_attributes(event=latest)['workflowType']['name'] != workflow_type:
+                continue
+            status = describe_child_workflow_event(event=latest)
+            status['attempts'] = sum(1 for event in events
+                                     if event['eventType'] == 'StartChildWorkflowExecutionInitiated')
+            statuses[workflow_id] = status
+        return statuses
+
+    def get_activity_history(self, scheduled_ids=None, activity_type=None):
+        """Get the history of a specific activity type and/or scheduled events.
+
+        Args:
+            scheduled_ids (list): a list of scheduled event ids.
+            activity_type (unicode): the type of activity to restrict the history to.
+
+        Returns:
+            a list of status records, ordered by event id, for events that match the specified activity type
+            and/or scheduled event ids.
+        """
+        if not any((scheduled_ids, activity_type)):
+            raise TaranError('scheduled_ids and/or activity_type required.')
+        scheduled_events = self._scheduled_events_by_activity_type.get(activity_type, ()) if activity_type else ()
+        if not scheduled_ids:
+            scheduled_ids = [event.get('eventId') for event in scheduled_events]
+            if not scheduled_ids:
+                return None
+        matched_events = dict((event.get('eventId'), event) for event in scheduled_events)
+        for scheduled_id in set(scheduled_ids):
+            for event in self._events_by_scheduled_id.get(scheduled_id, ()):
+                matched_events[event.get('eventId')] = event
+            scheduled_event = self._events_by_id.get(scheduled_id)
+            if scheduled_event and scheduled_event.get('eventType') == 'ActivityTaskScheduled':
+                activity_id = get_event_attributes(event=scheduled_event).get('activityId')
+                for event in self._cancel_requests_by_activity_id.get(activity_id, ()):
+                    matched_events[event.get('eventId')] = event
+        return [describe_activity_event(event=matched_events[event_id]) for event_id in sorted(matched_events)]
+
+
+def is_overflow_timer(decision=None):
+    """Return True if a decision starts a timer holding decisions deferred by DecisionBuilder.take_batch."""
+    timer_id = decision.get('startTimerDecisionAttributes', dict()).get('timerId', '')
+    return decision.get('decisionType') == 'StartTimer' and timer_id.startswith(OVERFLOW_TIMER_PREFIX)
+
+
+def get_control_chunks(decisions=None, max_length=MAX_CONTROL_LENGTH):
+    """Encode decisions as JSON lists, each short enough to be a timer's control data.
+
+    Raises:
+        TaranError: if a single decision is too long.
+    """
+    chunks, chunk, length = list(), list(), 2
+    for decision in decisions:
+        encoded = json.dumps(decision)
+        if len(encoded) + 2 > max_length:
+            raise TaranError('Decision too long to defer: {0}'.format(decision.get('decisionType')))
+        if chunk and length + 2 + len(encoded) > max_length:
+            chunks.append('[{0}]'.format(', '.join(chunk)))
+            chunk, length = list(), 2
+        length += len(encoded) + (2 if chunk else 0)
+        chunk.append(encoded)
+    if chunk:
+        chunks.append('[{0}]'.format(', '.join(chunk)))
+    return chunks
+
+
+def encode_input(value=None):
+    """Return a value as an SWF input or result string, encoding values other than strings as JSON."""
+    if value is None or isinstance(value, string_types):
+        return value
+    return json.dumps(value)
+
+
+class DecisionBuilder(object):
+    """Accumulate decisions of any type, to respond to one or more decision tasks with.
+
+    SWF accepts at most MAX_DECISIONS decisions per response, so take_batch splits larger sets of decisions,
+    deferring the remainder (including any decision closing the workflow) to the next decision task by storing them
+    in the control data of overflow timers, from which WorkflowHistory.get_deferred_decisions restores them.
+
+    Attributes:
+        decisions (list): The decisions not yet taken, in the order they were added.
+        activity_versions (dict): Activity versions keyed by name, e.g. from get_activity_versions.
+        id_prefix (unicode): The prefix of the activity, timer and child workflow ids generated.
+    """
+
+    def __init__(self, activity_versions=None, id_prefix=None):
+        self.decisions = list()
+        self.activity_versions = activity_versions or dict()
+        self.id_prefix = id_prefix or uuid.uuid4().hex[:12]
+        self._count = 0
+
+    def __len__(self):
+        return len(self.decisions)
+
+    def new_id(self):
+        """Return an id that is unique amongst those generated with this prefix."""
+        self._count += 1
+        return '{0}-{1}'.format(self.id_prefix, self._count)
+
+    def is_closed(self):
+        """Return True if a decision closing the workflow has been added."""
+        return bool(self.decisions) and self.decisions[-1]['decisionType'] in CLOSE_DECISION_TYPES
+
+    def add(self, decision_type=None, **attributes):
+        """Add a decision of any type, with attributes named as in the SWF API. Attributes of None are omitted.
+
+        Raises:
+            TaranError: if the workflow has already been closed by an earlier decision.
+        """
+        if self.is_closed():
+            raise TaranError('No decision may follow a {0} decision.'.format(self.decisions[-1]['decisionType']))
+        decision = {'decisionType': decision_type}
+        attributes = dict((key, value) for key, value in attributes.items() if value is not None)
+        if attributes:
+            decision['{0}{1}DecisionAttributes'.format(decision_type[:1].lower(), decision_type[1:])] = attributes
+        self.decisions.append(decision)
+        return self
+
+    def extend(self, builder=None):
+        """Add another builder's decisions, ahead of any decision closing the workflow."""
+        closing = [self.decisions.pop()] if self.is_closed() else list()
+        self.decisions.extend(builder.decisions)
+        if closing and builder.is_closed():
+            raise TaranError('Both builders close the workflow.')
+        self.decisions.extend(closing)
+        builder.decisions = list()
+        return self
+
+    def schedule_activity(self, name=None, version=None, activity_id=None, task_list=None, input=None,
+                          control=None, schedule_to_start_timeout=None, start_to_close_timeout=None,
+                          schedule_to_close_timeout=None, heartbeat_timeout=None, task_priority=None):
+        """Schedule an activity task. The version defaults to that of the named activity in activity_versions.
+
+        Raises:
+            TaranError: if no version is given or known for the activity.
+        """
+        version = version or self.activity_versions.get(name)
+        if not version:
+            raise TaranError('No version known for activity: {0}'.format(name))
+        return self.add('ScheduleActivityTask', activityType={'name': name, 'version': version},
+                        activityId=activity_id or self.new_id(),
+                        taskList={'name': task_list} if task_list else None, input=encode_input(input),
+                        control=control, scheduleToStartTimeout=schedule_to_start_timeout,
+                        startToCloseTimeout=start_to_close_timeout, scheduleToCloseTimeout=schedule_to_close_timeout,
+                        heartbeatTimeout=heartbeat_timeout, taskPriority=task_priority)
+
+    def request_cancel_activity(self, activity_id=None):
+        """Request the cancellation of an activity task."""
+        return self.add('RequestCancelActivityTask', activityId=activity_id)
+
+    def start_timer(self, timer_id=None, start_to_fire_timeout=None, control=None):
+        """Start a timer, which adds a decision task when it fires."""
+        return self.add('StartTimer', timerId=timer_id or self.new_id(),
+                        startToFireTimeout='{0}'.format(start_to_fire_timeout), control=control)
+
+    def cancel_timer(self, timer_id=None):
+        """Cancel a timer."""
+        return self.add('CancelTimer', timerId=timer_id)
+
+    def record_marker(self, marker_name=None, details=None):
+        """Record a marker in the workflow history, e.g. to checkpoint decider state."""
+        return self.add('RecordMarker', markerName=marker_name, details=encode_input(details))
+
+    def start_child_workflow(self, name=None, version=None, workflow_id=None, input=None, task_list=None,
+                             child_policy=None, execution_start_to_close_timeout=None,
+                             task_start_to_close_timeout=None, control=None, tag_list=None):
+        """Start a child workflow execution."""
+        return self.add('StartChildWorkflowExecution', workflowType={'name': name, 'version': version},
+                        workflowId=workflow_id or self.new_id(), input=encode_input(input),
+                        taskList={'name': task_list} if task_list else None, childPolicy=child_policy,
+                        executionStartToCloseTimeout=execution_start_to_close_timeout,
+                        taskStartToCloseTimeout=task_start_to_close_timeout, control=control, tagList=tag_list)
+
+    def signal_external_workflow(self, workflow_id=None, signal_name=None, run_id=None, input=None, control=None):
+        """Signal another workflow execution."""
+        return self.add('SignalExternalWorkflowExecution', workflowId=workflow_id, runId=run_id,
+                        signalName=signal_name, input=encode_input(input), control=control)
+
+    def request_cancel_external_workflow(self, workflow_id=None, run_id=None, control=None):
+        """Request the cancellation of another workflow execution."""
+        return self.add('RequestCancelExternalWorkflowExecution', workflowId=workflow_id, runId=run_id,
+                        control=control)
+
+    def complete_workflow(self, result=None):
+        """Complete the workflow execution."""
+        return self.add('CompleteWorkflowExecution', result=encode_input(result))
+
+    def fail_workflow(self, reason=None, details=None):
+        """Fail the workflow execution."""
+        return self.add('FailWorkflowExecution', reason=reason, details=encode_input(details))
+
+    def cancel_workflow(self, details=None):
+        """Cancel the workflow execution, e.g. in response to a cancellation request."""
+        return self.add('CancelWorkflowExecution', details=encode_input(details))
+
+    def continue_as_new(self, input=None, task_list=None, workflow_type_version=None, child_policy=None,
+                        execution_start_to_close_timeout=None, task_start_to_close_timeout=None):
+        """Close the workflow execution and start a new run of it, with a new history."""
+        return self.add('ContinueAsNewWorkflowExecution', input=encode_input(input),
+                        taskList={'name': task_list} if task_list else None,
+                        workflowTypeVersion=workflow_type_version, childPolicy=child_policy,
+                        executionStartToCloseTimeout=execution_start_to_close_timeout,
+                        taskStartToCloseTimeout=task_start_to_close_timeout)
+
+    def take_batch(self, max_decisions=MAX_DECISIONS):
+        """Remove and return the decisions for one response.
+
+        If there are too many decisions for one response, the batch ends with timers that fire immediately, whose
+        control data holds the remaining decisions. The timers firing adds another decision task, in which
+        WorkflowHistory.get_deferred_decisions restores the remaining decisions from the history, so they survive
+        the next decision task going to another decider.
+
+        Args:
+            max_decisions (int): The maximum number of decisions in the batch.
+        Returns:
+            a list of decisions.
+        Raises:
+            TaranError: if the remaining decisions need as many timers as the batch can hold.
+        """
+        if len(self.decisions) <= max_decisions:
+            batch, self.decisions = self.decisions, list()
+            return batch
+        timer_count = 1
+        while True:
+            if timer_count >= max_decisions:
+                raise TaranError('Too many decisions to defer: {0}'.format(len(self.decisions)))
+            chunks = get_control_chunks(decisions=self.decisions[max_decisions - timer_count:])
+            if len(chunks) <= timer_count:
+                break
+            timer_count = len(chunks)
+        batch, self.decisions = self.decisions[:max_decisions - timer_count], list()
+        group = self.new_id()
+        for index, chunk in enumerate(chunks):
+            batch.append({'decisionType': 'StartTimer', 'startTimerDecisionAttributes': {
+                'timerId': '{0}{1}-{2}-{3}'.format(OVERFLOW_TIMER_PREFIX, group, index, len(chunks)),
+                'startToFireTimeout': '0', 'control': chunk}})
+        return batch
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module provides a runtime that processes a worker's activity tasks concurrently.
+"""
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+EXECUTORS = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+
+
+class WorkerPool(object):
+    """Hold several long polls for activity tasks open and execute the tasks on a bounded pool.
+
+    Each task is passed to the handler as an ActivityTask, so no task state is shared between concurrent tasks.
+    The value returned by the handler completes the task; an exception raised by the handler fails it. Polls are
+    only made whilst the pool has capacity, so tasks are never accepted only to wait for an executor.
+
+    Attributes:
+        worker (Worker): The worker used to poll for, and respond to, activity tasks.
+        handler (callable): Called with each ActivityTask. Must be picklable when using the 'process' executor.
+        pollers (int): The number of long polls to hold open.
+        max_workers (int): The maximum number of tasks to execute at once.
+        executor (unicode): 'thread' for I/O bound activities or 'process' for CPU bound activities.
+    """
+
+    def __init__(self, worker=None, handler=None, pollers=None, max_workers=None, executor=None):
+        """Initialise a pool for a worker.
+
+        Args:
+            worker (Worker): The worker used to poll for, and respond to, activity tasks.
+            handler (callable): Called with each ActivityTask to perform the activity.
+            pollers (Optional[int]): The number of long polls to hold open. Defaults to WORKER_POLLERS or 2.
+            max_workers (Optional[int]): The size of the execution pool. Defaults to WORKER_POOL_SIZE or 4.
+            executor (Optional[unicode]): 'thread' or 'process'. Defaults to WORKER_POOL_EXECUTOR or 'thread'.
+        """
+        configuration = worker.configuration
+        self.worker = worker
+        self.handler = handler
+        self.pollers = pollers or (configuration.WORKER_POLLERS if hasattr(configuration, 'WORKER_POLLERS') else 2)
+        self.max_workers = max_workers or (
+            configuration.WORKER_POOL_SIZE if hasattr(configuration, 'WORKER_POOL_SIZE') else 4)
+        self.executor = executor or (
+            configuration.WORKER_POOL_EXECUTOR if hasattr(configuration, 'WORKER_POOL_EXECUTOR') else 'thread')
+        if self.executor not in EXECUTORS:
+            raise ValueError('executor must be one of: {0}'.format(', '.join(sorted(EXECUTORS))))
+        self.stopping = threading.Event()
+        self._capacity = threading.BoundedSemaphore(self.max_workers)
+        self._pool = None
+        self._poller_threads = list()
+
+    def start(self):
+        """Start the execution pool and the pollers."""
+        self.stopping.clear()
+        self._pool = EXECUTORS[self.executor](max_workers=self.max_workers)
+        for index in range(self.pollers):
+            poller = threading.Thread(target=self.poll, name='taran-poller-{0}'.format(index))
+            poller.daemon = True
+            poller.start()
+            self._poller_threads.append(poller)
+
+    def stop(self, wait=True):
+        """Stop polling for tasks and shut down the execution pool.
+
+        Polls already open are allowed to return and any tasks they receive are executed.
+
+        Args:
+            wait (bool): Wait for tasks in progress to finish.
+        """
+        self.stopping.set()
+        if wait:
+            for poller in self._poller_threads:
+                poller.join()
+        self._poller_threads = list()
+        if self._pool:
+            self._pool.shutdown(wait=wait)
+
+    def run(self):
+        """Process tasks until interrupted, or until the pool stops itself."""
+        self.start()
+        try:
+            while not self.stopping.is_set():
+                self.stopping.wait(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def poll(self):
+        """Poll for tasks whilst the pool has capacity, submitting each task received to the pool.
+
+        If the worker exits whilst polling (e.g. as it lacks permission to poll), the pool stops. A task received
+        after the pool has been shut down is failed, so it can be rescheduled without waiting for it to time out.
+        """
+        while not self.stopping.is_set():
+            if not self._capacity.acquire(False):
+                self.stopping.wait(0.1)
+                continue
+            try:
+                activity_task = self.worker.poll_for_task()
+            except SystemExit:
+                self._capacity.release()
+                self.worker.msg(message='Worker exited whilst polling for task; stopping the pool', level='error')
+                self.stopping.set()
+                return
+            except Exception as exc:
+                self._capacity.release()
+                self.worker.msg(message='Polling for task failed: {0}'.format(exc), level='error')
+                self.stopping.wait(1)
+                continue
+            if not activity_task:
+                self._capacity.release()
+                continue
+            try:
+                future = self._pool.submit(self.handler, activity_task)
+            except RuntimeError:
+                # The pool has been shut down, e.g. by stop(wait=False) whilst this poll was open
+                self._capacity.release()
+                self.worker.activity_task_failed(reason='WorkerPoolStopped', details='The worker pool was stopped.',
+                                                 task_token=activity_task.task_token)
+                return
+            future.add_done_callback(partial(self.respond, activity_task))
+
+    def respond(self, activity_task, future):
+        """Complete or fail a task, depending on the outcome of its handler, and release its capacity."""
+        try:
+            error = future.exception()
+            if error:
+                self.worker.activity_task_failed(reason=type(error).__name__, details=str(error),
+                                                 task_token=activity_task.task_token)
+            else:
+                result = future.result()
+                self.worker.complete_activity_task(result=result if result is not None else 'Undefined',
+                                                   task_token=activity_task.task_token)
+        finally:
+            self._capacity.release()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module provides a rolling deployment workflow: decision logic and the activities it schedules.
+
+Hosts are deployed to in batches, each host passing through a sequence of stages (by default: drain it from its
+load balancers, install the release, then check its health and return it to service). Each stage is an activity
+scheduled on a task list of the host's own, so it runs on that host. Batches are pipelined: a batch starts a stage as
+soon as the previous batch has finished it, so a deployment takes time proportional to the number of batches rather
+than the number of hosts. Once more hosts have failed than the failure budget allows, no further stages are
+scheduled and the workflow fails when the stages in progress have finished.
+
+The workflow input is a JSON object containing the 'hosts' to deploy to and, optionally, the 'batch_size',
+'max_failures', 'max_batches_in_flight', 'stages' and stage 'options'.
+"""
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import json
+
+from contracts import contract
+from six import binary_type
+
+from taran.errors import TaranError
+from taran.foreman import Foreman
+from taran.helpers.aws.ec2 import elb_rotate, get_ec2_instance_id
+from taran.helpers.aws.s3 import s3_download
+from taran.helpers.aws.swf import MAX_DECISIONS, clean_swf_name
+from taran.utils import is_command_failed, run_commands
+from taran.utils.service import services
+from taran.utils.web import check_urls
+
+DEFAULT_STAGES = ('drain', 'install', 'health')
+DEFAULT_TASK_LIST_PREFIX = 'rolling-deploy'
+RUNNING_STATUSES = ('scheduled', 'started', 'cancel_requested')
+FAILED_STATUSES = ('failed', 'timed_out', 'cancelled')
+
+
+def get_host_task_list(prefix=DEFAULT_TASK_LIST_PREFIX, host=None):
+    """Return the task list a host polls for its rolling deployment activities, as a valid SWF name."""
+    return clean_swf_name(value='{0}-{1}'.format(prefix, host))
+
+
+def get_stage_activity_id(stage=None, host=None):
+    """Return the activity id of a stage of a host's deployment, as a valid SWF id."""
+    return clean_swf_name(value='{0}-{1}'.format(stage, host))
+
+
+@contract(hosts='list', batch_size='int,>0', statuses='dict', max_failures='int,>=0')
+def plan_rolling_deploy(hosts=None, batch_size=1, stages=DEFAULT_STAGES, statuses=None, max_failures=0,
+                        max_batches_in_flight=None, max_scheduled=MAX_DECISIONS):
+    """Decide which stages of a rolling deployment to start next.
+
+    A host starts a stage once it has completed the previous stage and every host of the previous batch has
+    finished (completed or failed) the same stage.
+
+    Args:
+        hosts (list): The hosts to deploy to, in order.
+        batch_size (int): The number of hosts in each batch.
+        stages (list): The stages each host passes through, in order.
+        statuses (dict): The status of each stage started, e.g. 'completed', keyed by (stage, host).
+        max_failures (int): The number of hosts that may fail before the deployment is aborted.
+        max_batches_in_flight (Optional[int]): The number of batches that may be in progress at once. Defaults
+            to the number of stages; 1 deploys one batch at a time.
+        max_scheduled (int): The maximum number of stages to start.
+    Returns:
+        a dict containing the (stage, host) pairs to 'schedule', the hosts that 'succeeded' and 'failed', the
+        number of stages 'running', whether the deployment is 'aborted' and whether it is 'complete'.
+    """
+    batches = [hosts[start:start + batch_size] for start in range(0, len(hosts), batch_size)]
+    max_batches_in_flight = max_batches_in_flight or len(stages)
+    failed = set(host for host in hosts if any(statuses.get((stage, host)) in FAILED_STATUSES for stage in stages))
+    succeeded = [host for host in hosts
+                 if host not in failed and all(statuses.get((stage, host)) == 'completed' for stage in stages)]
+    running = sum(1 for status in statuses.values() if status in RUNNING_STATUSES)
+    aborted = len(failed) > max_failures
+
+    def is_finished(host, stage_index=None):
+        stage_indexes = range(len(stages)) if stage_index is None else (stage_index,)
+        return host in failed or all(statuses.get((stages[index], host)) == 'completed' for index in stage_indexes)
+
+    def is_started(batch):
+        return any((stages[0], host) in statuses for host in batch)
+
+    batches_in_flight = sum(1 for batch in batches
+                            if is_started(batch) and not all(is_finished(host) for host in batch))
+    schedule = list()
+    for batch_index, batch in enumerate(batches):
+        started = is_started(batch)
+        if aborted or (not started and batches_in_flight >= max_batches_in_flight):
+            break
+        for host in batch:
+            if host in failed:
+                continue
+            for stage_index, stage in enumerate(stages):
+                status = statuses.get((stage, host))
+                if status == 'completed':
+                    continue
+                if status is None and (batch_index == 0 or all(is_finished(previous_host, stage_index)
+                                                               for previous_host in batches[batch_index - 1])):
+                    schedule.append((stage, host))
+                break
+        if not started and any(pair[1] in batch for pair in schedule):
+            batches_in_flight += 1
+    return dict(schedule=schedule[:max_scheduled], succeeded=succeeded,
+                failed=[host for host in hosts if host in failed], running=running, aborted=aborted,
+                complete=not aborted and not running and len(succeeded) + len(failed) == len(hosts))
+
+
+class RollingDeployForeman(Foreman):
+    """A foreman that makes the decisions of rolling deployment workflows.
+
+    Attributes:
+        task_list_prefix (unicode): The prefix of each host's task list, from ROLLING_DEPLOY_TASK_LIST_PREFIX.
+    """
+
+    @contract(configuration='*')
+    def __init__(self, configuration=None):
+        super(RollingDeployForeman, self).__init__(configuration=configuration)
+        self.task_list_prefix = configuration.ROLLING_DEPLOY_TASK_LIST_PREFIX if hasattr(
+            configuration, 'ROLLING_DEPLOY_TASK_LIST_PREFIX') else DEFAULT_TASK_LIST_PREFIX
+
+    def get_stage_statuses(self, stages=None, hosts=None):
+        """Get the status of each stage started, keyed by (stage, host), from the workflow history."""
+        history = self.get_indexed_history()
+        stage_hosts = dict((get_stage_activity_id(stage=stage, host=host), (stage, host))
+                           for stage in stages for host in hosts)
+        statuses = dict()
+        for activity_id, status in history.get_activity_statuses().items():
+            if activity_id in stage_hosts:
+                statuses[stage_hosts[activity_id]] = status['status']
+        for event in history.get_events(event_type='ScheduleActivityTaskFailed'):
+            activity_id = event['scheduleActivityTaskFailedEventAttributes']['activityId']
+            if activity_id in stage_hosts:
+                statuses[stage_hosts[activity_id]] = 'failed'
+        return statuses
+
+    def add_stage_decision(self, builder=None, stage=None, host=None, options=None):
+        """Add a decision scheduling a stage of a host's deployment on the host's task list."""
+        activity = dict((activity.get('name'), activity) for activity in self.activity_list or ()).get(stage, dict())
+        builder.schedule_activity(name=stage, activity_id=get_stage_activity_id(stage=stage, host=host),
+                                  task_list=get_host_task_list(prefix=self.task_list_prefix, host=host),
+                                  input=dict(options or dict(), stage=stage, host=host),
+                                  schedule_to_start_timeout=activity.get('schedule_to_start_timeout'),
+                                  start_to_close_timeout=activity.get('start_to_close_timeout'),
+                                  schedule_to_close_timeout=activity.get('schedule_to_close_timeout'),
+                                  heartbeat_timeout=activity.get('heartbeat_timeout'))
+
+    def decide(self):
+        """Schedule the next stages of the deployment, or complete or fail the workflow once it has finished.
+
+        Returns:
+            the plan the decisions were made from, as returned by plan_rolling_deploy.
+        """
+        deploy = self.get_workflow_input()
+        hosts = deploy['hosts']
+        stages = deploy.get('stages') or list(DEFAULT_STAGES)
+        plan = plan_rolling_deploy(hosts=hosts, batch_size=deploy.get('batch_size', 1), stages=stages,
+                                   statuses=self.get_stage_statuses(stages=stages, hosts=hosts),
+                                   max_failures=deploy.get('max_failures', 0),
+                                   max_batches_in_flight=deploy.get('max_batches_in_flight'))
+        # The plan is capped at the decision limit, so no stage is deferred and then planned again
+        builder = self.get_decision_builder()
+        for stage, host in plan['schedule']:
+            self.add_stage_decision(builder=builder, stage=stage, host=host, options=deploy.get('options'))
+        outcome = dict(succeeded=plan['succeeded'], failed=plan['failed'])
+        if plan['complete']:
+            builder.complete_workflow(result=outcome)
+        elif plan['aborted'] and not plan['running']:
+            builder.fail_workflow(reason='Failure budget exceeded', details=outcome)
+        self.msg(message='Scheduling {0} stages with {1} running, {2} hosts succeeded and {3} failed'.format(
+            len(plan['schedule']), plan['running'], len(plan['succeeded']), len(plan['failed'])))
+        self.respond_decisions(builder=builder)
+        return plan
+
+
+def get_instance_id(options=None):
+    """Return the instance id given in a stage's options, or else that of the instance the stage is running on."""
+    instance_id = options.get('instance_id') or get_ec2_instance_id()
+    if isinstance(instance_id, binary_type):
+        instance_id = instance_id.decode('utf-8')
+    if not instance_id:
+        raise TaranError('Unable to determine the instance id of {0}.'.format(options.get('host')))
+    return instance_id
+
+
+def drain_host(options=None):
+    """Deregister the host from its load balancers ('elb_names')."""
+    if not options.get('elb_names'):
+        return dict(drained=list())
+    instance_id = get_instance_id(options=options)
+    results = elb_rotate(deregister=dict((elb_name, [instance_id]) for elb_name in options['elb_names']),
+                         region=options.get('region'), timeout=options.get('elb_timeout', 300))
+    if not all(results.values()):
+        raise TaranError('Timed out deregistering {0} from: {1}'.format(
+            instance_id, ', '.join(sorted(elb_name for elb_name, drained in results.items() if not drained))))
+    return dict(drained=sorted(results))
+
+
+def install_host(options=None):
+    """Download the release's 'artifacts', run its 'commands' and restart its 'services'."""
+    if options.get('artifacts'):
+        s3_download(items=options['artifacts'])
+    results = run_commands(cmds=options.get('commands') or list(), policy='fail_fast',
+                           timeout=options.get('command_timeout'))
+    failed = [result['cmd'] for result in results if is_command_failed(result=result)]
+    if failed:
+        raise TaranError('Commands failed: {0}'.format(failed))
+    restarted = services(names=options.get('services') or list(), action='restart',
+                         timeout=options.get('command_timeout'))
+    if not all(restarted.values()):
+        raise TaranError('Services failed to restart: {0}'.format(
+            ', '.join(sorted(name for name, ok in restarted.items() if not ok))))
+    return dict(commands=len(results), services=sorted(restarted))
+
+
+def check_host(options=None):
+    """Wait for the host's 'health_urls' (formatted with the host) to be healthy, then return it to service."""
+    checks = list()
+    for check in options.get('health_urls') or list():
+        check = dict(url=check) if not isinstance(check, dict) else dict(check)
+        check['url'] = check['url'].format(host=options.get('host'))
+        checks.append(check)
+    health = check_urls(checks=checks, timeout=options.get('health_timeout', 300)) if checks else dict()
+    unhealthy = sorted(url for url, result in health.items() if not result['healthy'])
+    if unhealthy:
+        raise TaranError('Unhealthy: {0}'.format(', '.join(unhealthy)))
+    if options.get('elb_names'):
+        instance_id = get_instance_id(options=options)
+        results = elb_rotate(register=dict((elb_name, [instance_id]) for elb_name in options['elb_names']),
+                             region=options.get('region'), timeout=options.get('elb_timeout', 300))
+        if not all(results.values()):
+            raise TaranError('Timed out registering {0} with: {1}'.format(
+                instance_id, ', '.join(sorted(elb_name for elb_name, registered in results.items()
+                                              if not registered))))
+    return dict(healthy=sorted(health))
+
+
+STAGE_HANDLERS = {'drain': drain_host, 'install': install_host, 'health': check_host}
+
+
+def handle_stage_task(activity_task=None):
+    """Perform a stage of a rolling deployment, e.g. as the handler of a WorkerPool polling the host's task list.
+
+    Args:
+        activity_task (ActivityTask): A task scheduled by RollingDeployForeman.
+    Returns:
+        the result of the stage, as JSON.
+    Raises:
+        TaranError: if the stage failed.
+    """
+    options = json.loads(activity_task.input)
+    handler = STAGE_HANDLERS.get(options['stage'])
+    if handler is None:
+        raise TaranError('Unknown stage: {0}'.format(options['stage']))
+    return json.dumps(handler(options=options))
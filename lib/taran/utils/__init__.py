@@ -9,9 +9,25 @@ import select
 import shlex
 import subprocess
 import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from contracts import contract
-from six import string_types
+from six import PY2, string_types
+
+DEFAULT_MAX_OUTPUT_LINES = 1000
+DEFAULT_MAX_COMMAND_CONCURRENCY = 4
+COMMAND_POLICIES = ('continue', 'fail_fast')
+
+
+def split_command(cmd=None):
+    """Split a command line into arguments, leaving a list of arguments unchanged."""
+    if not isinstance(cmd, string_types):
+        return cmd
+    return shlex.split(cmd.encode('utf-8')) if PY2 else shlex.split(cmd)
 
 
 # Daemonize functionality taken from Ansible project
@@ -42,12 +58,10 @@ def execute_command(cmd=None, cwd=None, env=None, daemonize=False):
         if pid > 0:
             exit(0)
 
-        if isinstance(cmd, string_types):
-            cmd = shlex.split(cmd.encode('ascii'))
-        p = subprocess.Popen(args=cmd, cwd=cwd, env=env, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                             preexec_fn=lambda: os.close(pipe[1]))
-        stdout = ""
-        stderr = ""
+        p = subprocess.Popen(args=split_command(cmd=cmd), cwd=cwd, env=env, shell=False, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, preexec_fn=lambda: os.close(pipe[1]))
+        stdout = bytearray()
+        stderr = bytearray()
         fds = [p.stdout, p.stderr]
         # Wait for all output, or until the main process is dead and its output is done.
         while fds:
@@ -58,15 +72,16 @@ def execute_command(cmd=None, cwd=None, env=None, daemonize=False):
                 dat = os.read(p.stdout.fileno(), 4096)
                 if not dat:
                     fds.remove(p.stdout)
-                stdout += dat
+                stdout.extend(dat)
             if p.stderr in rfd:
                 dat = os.read(p.stderr.fileno(), 4096)
                 if not dat:
                     fds.remove(p.stderr)
-                stderr += dat
+                stderr.extend(dat)
         p.wait()
         # Return a JSON blob to parent
-        os.write(pipe[1], json.dumps([p.returncode, stdout, stderr]))
+        os.write(pipe[1], json.dumps([p.returncode, stdout.decode('utf-8', 'replace'),
+                                      stderr.decode('utf-8', 'replace')]).encode('utf-8'))
         os.close(pipe[1])
         exit(0)
     elif pid == -1:
@@ -75,25 +90,152 @@ def execute_command(cmd=None, cwd=None, env=None, daemonize=False):
         os.close(pipe[1])
         os.waitpid(pid, 0)
         # Wait for data from daemon process and process it.
-        data = ""
+        data = bytearray()
         while True:
             rfd, wfd, efd = select.select([pipe[0]], [], [pipe[0]])
             if pipe[0] in rfd:
                 dat = os.read(pipe[0], 4096)
                 if not dat:
                     break
-                data += dat
-        return json.loads(data)
+                data.extend(dat)
+        return json.loads(data.decode('utf-8'))
 
 
 @contract(cmd='unicode')
 def run_command(cmd=None, cwd=None, env=None):
     """Interactively run the command and return any output."""
-    if isinstance(cmd, string_types):
-        cmd = shlex.split(cmd.encode('ascii'))
-    output = subprocess.Popen(args=cmd, env=env, cwd=cwd, stdout=subprocess.PIPE)
-    out, _ = output.communicate()
-    return out.rstrip('\n')
+    def print_stderr(stream_name, line):
+        if stream_name == 'stderr':
+            print(line, file=sys.stderr)
+    return stream_command(cmd=cmd, cwd=cwd, env=env, line_callback=print_stderr, max_lines=None)['stdout']
+
+
+def read_lines(stream=None, stream_name=None, lines=None, line_callback=None, counts=None):
+    """Read a stream line by line until it closes, keeping the last lines and passing each to the callback."""
+    for raw_line in iter(stream.readline, b''):
+        line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+        lines.append(line)
+        counts[stream_name] += 1
+        if line_callback:
+            line_callback(stream_name, line)
+    stream.close()
+
+
+@contract(cmd='unicode|list(unicode)', cwd='unicode|None', timeout='int|float|None', max_lines='int|None')
+def stream_command(cmd=None, cwd=None, env=None, timeout=None, line_callback=None, logger=None,
+                   max_lines=DEFAULT_MAX_OUTPUT_LINES, cancel_event=None, kill_after=5):
+    """Run a command, streaming its output line by line as it is produced.
+
+    Output is read on a thread per stream, so neither stream can fill its pipe and block the command, and only the
+    last max_lines lines of each stream are kept, so chatty commands run in constant memory.
+
+    Args:
+        cmd (unicode|list): The command line, or a list of arguments.
+        cwd (Optional[unicode]): The directory to run the command in.
+        env (Optional[dict]): The environment to run the command with.
+        timeout (Optional[float]): The number of seconds after which the command is terminated.
+        line_callback (Optional[callable]): Called with the stream name ('stdout' or 'stderr') and each line.
+        logger (Optional[logging.Logger]): Logs stdout lines at info and stderr lines at warning.
+        max_lines (Optional[int]): The number of lines of each stream to keep. None keeps every line.
+        cancel_event (Optional[threading.Event]): Terminates the command when set.
+        kill_after (float): The number of seconds to wait for a terminated command before killing it.
+    Returns:
+        a dict containing the 'returncode', the kept 'stdout' and 'stderr', the total number of 'stdout_lines' and
+        'stderr_lines', whether the command 'timed_out' or was 'cancelled', and the 'seconds' it ran for.
+    """
+    started = time.time()
+    process = subprocess.Popen(args=split_command(cmd=cmd), cwd=cwd, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    if logger:
+        log_methods = dict(stdout=logger.info, stderr=logger.warning)
+
+        def log_line(stream_name, line):
+            log_methods[stream_name](line)
+            if line_callback:
+                line_callback(stream_name, line)
+        callback = log_line
+    else:
+        callback = line_callback
+    lines = dict(stdout=deque(maxlen=max_lines), stderr=deque(maxlen=max_lines))
+    counts = dict(stdout=0, stderr=0)
+    readers = [threading.Thread(target=read_lines, kwargs=dict(stream=getattr(process, stream_name),
+                                                               stream_name=stream_name, lines=lines[stream_name],
+                                                               line_callback=callback, counts=counts))
+               for stream_name in ('stdout', 'stderr')]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    timed_out = cancelled = False
+    while process.poll() is None:
+        if timeout is not None and time.time() - started > timeout:
+            timed_out = True
+        elif cancel_event is not None and cancel_event.is_set():
+            cancelled = True
+        if timed_out or cancelled:
+            process.terminate()
+            deadline = time.time() + kill_after
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if process.poll() is None:
+                process.kill()
+            break
+        if cancel_event is not None:
+            cancel_event.wait(0.05)
+        else:
+            time.sleep(0.05)
+    process.wait()
+    for reader in readers:
+        # Output pipes may be held open by processes the command started
+        reader.join(kill_after if timed_out or cancelled else None)
+    return dict(returncode=process.returncode, stdout='\n'.join(lines['stdout']), stderr='\n'.join(lines['stderr']),
+                stdout_lines=counts['stdout'], stderr_lines=counts['stderr'], timed_out=timed_out,
+                cancelled=cancelled, seconds=time.time() - started)
+
+
+def is_command_failed(result=None):
+    """Return True if a command exited with a non-zero code, timed out or was cancelled."""
+    return bool(result['returncode'] or result['timed_out'] or result['cancelled'])
+
+
+@contract(cmds='list', max_concurrency='int|None', timeout='int|float|None', policy='unicode')
+def run_commands(cmds=None, max_concurrency=None, timeout=None, policy='continue', cwd=None, env=None,
+                 line_callback=None, max_lines=DEFAULT_MAX_OUTPUT_LINES, cancel_event=None):
+    """Run several commands at once, so they take as long as the slowest rather than the sum of all.
+
+    Args:
+        cmds (list): The command lines, or lists of arguments, to run.
+        max_concurrency (Optional[int]): The maximum number of commands to run at once. Defaults to 4.
+        timeout (Optional[float]): The number of seconds after which each command is terminated.
+        policy (unicode): 'continue' to run every command regardless of failures, or 'fail_fast' to cancel the
+            commands running, and not start those waiting, once any command fails.
+        cwd (Optional[unicode]): The directory to run the commands in.
+        env (Optional[dict]): The environment to run the commands with.
+        line_callback (Optional[callable]): Called with the index of the command, the stream name and each line.
+        max_lines (Optional[int]): The number of lines of each stream to keep per command.
+        cancel_event (Optional[threading.Event]): Cancels all commands when set.
+    Returns:
+        a list of results, as returned by stream_command, in the order of cmds, each including its 'cmd'.
+        Commands not started because of an earlier failure or cancellation have a returncode of None and are
+        marked as cancelled.
+    """
+    if policy not in COMMAND_POLICIES:
+        raise ValueError('policy must be one of: {0}'.format(', '.join(COMMAND_POLICIES)))
+    cancel_event = cancel_event or threading.Event()
+
+    def run(index):
+        if cancel_event.is_set():
+            return dict(cmd=cmds[index], returncode=None, stdout='', stderr='', stdout_lines=0, stderr_lines=0,
+                        timed_out=False, cancelled=True, seconds=0.0)
+        callback = partial(line_callback, index) if line_callback else None
+        result = stream_command(cmd=cmds[index], cwd=cwd, env=env, timeout=timeout, line_callback=callback,
+                                max_lines=max_lines, cancel_event=cancel_event)
+        result['cmd'] = cmds[index]
+        if policy == 'fail_fast' and is_command_failed(result=result):
+            cancel_event.set()
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_concurrency or DEFAULT_MAX_COMMAND_CONCURRENCY) as executor:
+        return list(executor.map(run, range(len(cmds))))
 
 
 @contract(bytestring='str')
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cache related utilities"""
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A thread-safe cache that evicts the least recently used entries once it is full.
+
+    Entries may optionally expire a number of seconds after they were cached, and may be weighed (for example by
+    the number of events in a workflow history) so that the cache is bounded by the combined weight of its entries
+    as well as by their number.
+
+    Attributes:
+        max_entries (int): The maximum number of entries to hold.
+        max_weight (int): The maximum combined weight of all entries, or None for no limit.
+        ttl (int): The number of seconds an entry remains valid for, or None for no expiry.
+        weight (int): The combined weight of all entries.
+    """
+
+    def __init__(self, max_entries=128, max_weight=None, weigher=None, ttl=None):
+        """Initialise an empty cache.
+
+        Args:
+            max_entries (int): The maximum number of entries to hold.
+            max_weight (Optional[int]): The maximum combined weight of all entries.
+            weigher (Optional[callable]): A function returning the weight of a value. Defaults to a weight of 1.
+            ttl (Optional[int]): The number of seconds an entry remains valid for.
+        """
+        self.max_entries = max_entries
+        self.max_weight = max_weight
+        self.ttl = ttl
+        self.weight = 0
+        self._weigher = weigher or (lambda value: 1)
+        self._entries = OrderedDict()
+        self._weights = dict()
+        self._expiries = dict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Return the value cached for a key, marking it as the most recently used."""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            if key in self._expiries and self._expiries[key] <= time.time():
+                self.pop(key)
+                return default
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        """Cache a value, (re)weighing it and evicting least recently used entries as required.
+
+        Values that are modified in place should be put again so that their weight is updated.
+        """
+        with self._lock:
+            self.pop(key)
+            value_weight = self._weigher(value)
+            self._entries[key] = value
+            self._weights[key] = value_weight
+            if self.ttl is not None:
+                self._expiries[key] = time.time() + self.ttl
+            self.weight += value_weight
+            while len(self._entries) > 1 and (
+                    len(self._entries) > self.max_entries or
+                    (self.max_weight is not None and self.weight > self.max_weight)):
+                self.pop(next(iter(self._entries)))
+
+    def pop(self, key, default=None):
+        """Remove and return the value cached for a key."""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self.weight -= self._weights.pop(key)
+            self._expiries.pop(key, None)
+            return self._entries.pop(key)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+            self._weights.clear()
+            self._expiries.clear()
+            self.weight = 0
@@ -5,21 +5,304 @@ from __future__ import (absolute_import, print_function, unicode_literals)
 
 import hashlib
 import io
+import multiprocessing
+import os
+import stat
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from os import path
 from six import text_type
 from contracts import contract
 
+from taran.errors import TaranError
+from taran.utils.cache import LRUCache
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# md5 matches single part S3 ETags; the others are for local integrity checks only. The xxhash algorithms are not
+# cryptographic, but are several times faster, and are available if the xxhash package is installed.
+HASH_ALGORITHMS = ('md5', 'sha256', 'blake2b', 'xxh64', 'xxh3_64', 'xxh128')
+XXHASH_ALGORITHMS = ('xxh64', 'xxh3_64', 'xxh128')
+
+# Files named after a file and an algorithm, containing the file's digest and, on a second line, the stat key of the
+# file when it was hashed
+SIDECAR_EXTENSIONS = tuple('.{0}'.format(algorithm) for algorithm in HASH_ALGORITHMS)
+
+# The directory, private to the current user, that caches shared by the user's processes are kept in
+PRIVATE_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or path.expanduser('~/.cache'), 'taran')
+
+# Digests of files hashed by this process, keyed by path and algorithm, with the stat key of the file when it was
+# hashed
+digest_cache = LRUCache(max_entries=100000)
+
+
+def get_private_dir(dir_path=None):
+    """Create a directory only the current user can access, or check that an existing directory is one.
+
+    Returns:
+        the directory's path.
+    Raises:
+        TaranError: if the path is not a directory (e.g. is a symlink), or is owned by or accessible to another user.
+    """
+    try:
+        os.makedirs(dir_path, 0o700)
+    except OSError:
+        if not path.isdir(dir_path):
+            raise
+    if not hasattr(os, 'getuid'):
+        return dir_path
+    dir_stat = os.lstat(dir_path)
+    if (not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid() or
+            stat.S_IMODE(dir_stat.st_mode) & 0o077):
+        raise TaranError('{0} must be a directory owned by, and only accessible to, the current user.'.format(dir_path))
+    return dir_path
+
+
+def get_hash(algorithm='md5'):
+    """Return a new hash object for an algorithm.
+
+    Raises:
+        ValueError: if the algorithm is unknown or not available.
+    """
+    if algorithm in XXHASH_ALGORITHMS:
+        if xxhash is None or not hasattr(xxhash, algorithm):
+            raise ValueError('{0} requires the xxhash package.'.format(algorithm))
+        return getattr(xxhash, algorithm)()
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError('algorithm must be one of: {0}'.format(', '.join(HASH_ALGORITHMS)))
+    return hashlib.new(algorithm)
+
+
+def get_available_algorithms():
+    """Return the hash algorithms that can be used with the installed packages."""
+    available = list()
+    for algorithm in HASH_ALGORITHMS:
+        try:
+            get_hash(algorithm=algorithm)
+        except ValueError:
+            continue
+        available.append(algorithm)
+    return available
+
+
+def get_stat_key(file_path=None):
+    """Return the size, modification time (in nanoseconds) and inode of a file, which change whenever it does."""
+    stat = os.stat(file_path)
+    mtime_ns = getattr(stat, 'st_mtime_ns', None) or int(stat.st_mtime * 1e9)
+    return stat.st_size, mtime_ns, stat.st_ino
+
+
+def hash_file(file_path=None, algorithm='md5', buffer_size=HASH_BUFFER_SIZE):
+    """Calculate the digest of a file's content.
+
+    The file is read into a single reused buffer, so no memory is allocated per read.
+
+    Args:
+        file_path (unicode): The file to hash.
+        algorithm (unicode): One of HASH_ALGORITHMS.
+        buffer_size (int): The number of bytes to read at a time.
+    Returns:
+        the hex digest.
+    """
+    file_hash = get_hash(algorithm=algorithm)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        for size in iter(lambda: f.readinto(view), 0):
+            file_hash.update(view[:size])
+    return text_type(file_hash.hexdigest())
+
+
+@contract(file_path='unicode', digest='unicode|None', algorithm='unicode', stat_key='tuple|None')
+def write_digest(file_path=None, digest=None, algorithm='md5', stat_key=None):
+    """Write a sidecar file containing a file's digest, named after the file and algorithm.
+
+    The file's stat key is written on a second line, so the digest is only trusted whilst the file is unchanged.
+
+    Args:
+        file_path (unicode): The file to write the digest of.
+        digest (Optional[unicode]): The digest, if already known. Otherwise the file is read to calculate it.
+        algorithm (unicode): One of HASH_ALGORITHMS.
+        stat_key (Optional[tuple]): The file's stat key from before the digest was calculated. Defaults to its current
+            stat key. Nothing is written if the file has changed since, as the digest may be of neither version.
+    """
+    if stat_key is None:
+        stat_key = get_stat_key(file_path=file_path)
+    if digest is None:
+        digest = hash_file(file_path=file_path, algorithm=algorithm)
+    if get_stat_key(file_path=file_path) != stat_key:
+        return
+    with io.open('{0}.{1}'.format(file_path, algorithm), "w", encoding='utf-8') as digest_file:
+        digest_file.write('{0}\n{1}'.format(digest, ' '.join('{0}'.format(value) for value in stat_key)))
+    digest_cache.put((path.abspath(file_path), algorithm), (stat_key, digest))
+
+
+@contract(file_path='unicode', md5='unicode|None')
+def write_md5(file_path=None, md5=None):
+    """Write a file containing a file's MD5 checksum
+
+    Args:
+        file_path (unicode): The file to write the checksum of.
+        md5 (Optional[unicode]): The checksum, if already known (e.g. calculated whilst the file was written).
+            Otherwise the file is read to calculate it.
+    """
+    write_digest(file_path=file_path, digest=md5, algorithm='md5')
+
+
+def read_digest(digest_path=None):
+    """Read a sidecar file.
+
+    Returns:
+        the digest and the stat key recorded with it, which is None if the sidecar has none (e.g. it was written by
+        another tool).
+    """
+    with io.open(digest_path, "r", encoding='utf-8') as digest_file:
+        lines = digest_file.read().split('\n')
+    try:
+        stat_key = tuple(int(value) for value in lines[1].split()) if len(lines) > 1 else None
+    except ValueError:
+        stat_key = None
+    return lines[0].strip(), stat_key
+
+
+def get_cached_digest(file_path=None, stat_key=None, algorithm='md5'):
+    """Get a file's digest without reading the file, or None if it may have changed since it was last hashed.
+
+    The digest is taken from this process's cache, or otherwise from the file's sidecar, if the stat key it was
+    recorded with matches the file's current stat key. A file replaced with one of the same modification time
+    (e.g. by cp -p, tar or rsync -t) has a new size or inode, so is hashed again.
+    """
+    cache_key = (path.abspath(file_path), algorithm)
+    cached = digest_cache.get(cache_key)
+    if cached and cached[0] == stat_key:
+        return cached[1]
+    try:
+        digest, sidecar_stat_key = read_digest(digest_path='{0}.{1}'.format(file_path, algorithm))
+    except (IOError, OSError):
+        return None
+    if sidecar_stat_key != tuple(stat_key):
+        return None
+    digest_cache.put(cache_key, (stat_key, digest))
+    return digest
+
+
+@contract(file_path='unicode', algorithm='unicode')
+def get_digest(file_path=None, algorithm='md5'):
+    """Get the digest of a file's content, only reading the file if it has changed since it was last hashed.
+
+    Args:
+        file_path (unicode): The file to get the digest of.
+        algorithm (unicode): One of HASH_ALGORITHMS.
+    Returns:
+        the hex digest. The file's sidecar is rewritten if it was missing or out of date.
+    """
+    stat_key = get_stat_key(file_path=file_path)
+    digest = get_cached_digest(file_path=file_path, stat_key=stat_key, algorithm=algorithm)
+    if digest is None:
+        digest = hash_file(file_path=file_path, algorithm=algorithm)
+        write_digest(file_path=file_path, digest=digest, algorithm=algorithm, stat_key=stat_key)
+    return digest
+
 
 @contract(file_path='unicode')
-def write_md5(file_path=None):
-    """Write a file containing a file's MD5 checksum"""
-    hash_md5 = hashlib.md5()
-    with open('{0}'.format(file_path), "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    # return hash_md5.hexdigest()
-    with io.open('{0}.md5'.format(file_path), "w", encoding='utf-8') as md5_file:
-        md5_file.write(text_type(hash_md5.hexdigest()))
+def get_md5(file_path=None):
+    """Get the MD5 of a file's content, only reading the file if it has changed since it was last hashed.
+
+    Args:
+        file_path (unicode): The file to get the checksum of.
+    Returns:
+        the MD5 hex digest. The file's sidecar is rewritten if it was missing or out of date.
+    """
+    return get_digest(file_path=file_path, algorithm='md5')
+
+
+@contract(file_paths='list(unicode)', algorithm='unicode', max_workers='int|None', executor='unicode')
+def get_digests(file_paths=None, algorithm='md5', max_workers=None, executor='process'):
+    """Get the digests of many files, hashing those that have changed since they were last hashed in parallel.
+
+    Args:
+        file_paths (list): The files to get the digests of.
+        algorithm (unicode): One of HASH_ALGORITHMS.
+        max_workers (Optional[int]): The number of files to hash at once. Defaults to the number of CPUs.
+        executor (unicode): 'process' to hash on a process pool, or 'thread' for a thread pool (hashlib releases the
+            GIL whilst hashing large buffers).
+    Returns:
+        a dict of hex digests keyed by file path. Sidecars are rewritten for the files that were hashed.
+    """
+    get_hash(algorithm=algorithm)
+    digests = dict()
+    changed = list()
+    stat_keys = dict()
+    for file_path in file_paths:
+        stat_keys[file_path] = get_stat_key(file_path=file_path)
+        digest = get_cached_digest(file_path=file_path, stat_key=stat_keys[file_path], algorithm=algorithm)
+        if digest is None:
+            changed.append(file_path)
+        else:
+            digests[file_path] = digest
+    if changed:
+        pool = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        with pool(max_workers=max_workers or multiprocessing.cpu_count()) as hash_executor:
+            for file_path, digest in zip(changed, hash_executor.map(partial(hash_file, algorithm=algorithm),
+                                                                    changed)):
+                write_digest(file_path=file_path, digest=digest, algorithm=algorithm, stat_key=stat_keys[file_path])
+                digests[file_path] = digest
+    return digests
+
+
+@contract(file_paths='list(unicode)', max_workers='int|None', executor='unicode')
+def get_md5s(file_paths=None, max_workers=None, executor='process'):
+    """Get the MD5s of many files, hashing those that have changed since they were last hashed in parallel.
+
+    See get_digests.
+    """
+    return get_digests(file_paths=file_paths, algorithm='md5', max_workers=max_workers, executor=executor)
+
+
+def benchmark_hashes(file_path=None, size=256 * 1024 * 1024, algorithms=None, buffer_sizes=None):
+    """Measure the throughput of each hash algorithm and read size on a file.
+
+    Args:
+        file_path (Optional[unicode]): The file to hash. Defaults to a temporary file of random content.
+        size (int): The size of the temporary file.
+        algorithms (Optional[list]): The algorithms to compare. Defaults to all those available.
+        buffer_sizes (Optional[list]): The read sizes to compare. Defaults to 64 KiB, 1 MiB and 8 MiB.
+    Returns:
+        a list of dicts containing the 'algorithm', 'buffer_size', 'seconds' taken and 'throughput' in bytes per
+        second, fastest first.
+    """
+    algorithms = algorithms or get_available_algorithms()
+    buffer_sizes = buffer_sizes or [64 * 1024, HASH_BUFFER_SIZE, 8 * HASH_BUFFER_SIZE]
+    temp_path = None
+    if not file_path:
+        file_descriptor, temp_path = tempfile.mkstemp(prefix='taran-hash-benchmark-')
+        with os.fdopen(file_descriptor, 'wb') as temp_file:
+            for offset in range(0, size, HASH_BUFFER_SIZE):
+                temp_file.write(os.urandom(min(HASH_BUFFER_SIZE, size - offset)))
+        file_path = temp_path
+    try:
+        file_size = os.path.getsize(file_path)
+        # Read the file once so every measurement is made from the page cache
+        hash_file(file_path=file_path, algorithm='md5')
+        results = list()
+        for algorithm in algorithms:
+            for buffer_size in buffer_sizes:
+                started = time.time()
+                hash_file(file_path=file_path, algorithm=algorithm, buffer_size=buffer_size)
+                seconds = time.time() - started
+                results.append(dict(algorithm=algorithm, buffer_size=buffer_size, seconds=seconds,
+                                    throughput=file_size / seconds if seconds > 0 else 0.0))
+    finally:
+        if temp_path:
+            os.remove(temp_path)
+    return sorted(results, key=lambda result: result['throughput'], reverse=True)
 
 
 @contract(file_path='unicode')
@@ -27,5 +310,4 @@ def get_local_md5(file_path=None):
     """Get the MD5 value of a file's content."""
     if not path.exists('{0}.md5'.format(file_path)):
         return None
-    with open('{0}.md5'.format(file_path), "r") as existing_md5_file:
-        return existing_md5_file.read()
+    return read_digest(digest_path='{0}.md5'.format(file_path))[0]
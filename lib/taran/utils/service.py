@@ -3,7 +3,7 @@
 """Service related utilities"""
 from __future__ import (print_function, unicode_literals)
 
-from taran.utils import execute_command
+from taran.utils import execute_command, is_command_failed, run_commands
 
 
 def service(name=None, action=None, daemonize=True):
@@ -11,3 +11,20 @@ def service(name=None, action=None, daemonize=True):
     # TODO: Handle different service types
     execute_command(cmd='service {0} {1}'.format(name, action), daemonize=daemonize)
     return True
+
+
+def services(names=None, action=None, max_concurrency=None, timeout=None, policy='continue'):
+    """Apply an action to several installed daemons at once.
+
+    Args:
+        names (list): The names of the services.
+        action (unicode): The action, e.g. 'restart'.
+        max_concurrency (Optional[int]): The maximum number of services to act on at once.
+        timeout (Optional[float]): The number of seconds after which each action is terminated.
+        policy (unicode): 'continue' or 'fail_fast', as for run_commands.
+    Returns:
+        a dict of booleans, keyed by service name, indicating whether the action succeeded.
+    """
+    results = run_commands(cmds=['service {0} {1}'.format(name, action) for name in names],
+                           max_concurrency=max_concurrency, timeout=timeout, policy=policy)
+    return dict((name, not is_command_failed(result=result)) for name, result in zip(names, results))
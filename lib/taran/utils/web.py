@@ -3,30 +3,123 @@
 """Utilities relating to online services"""
 from __future__ import (print_function, unicode_literals)
 
+import heapq
+import os
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from six.moves import queue
+
+DEFAULT_MAX_CHECK_CONCURRENCY = 10
+
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
+
+def get_session(max_pool_connections=DEFAULT_MAX_CHECK_CONCURRENCY):
+    """Get the process's shared session, whose keep-alive connections are reused by every check of a host.
+
+    Args:
+        max_pool_connections (int): the number of connections to keep per host.
+    """
+    session_key = (os.getpid(), max_pool_connections)
+    with _sessions_lock:
+        if session_key not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=max_pool_connections, pool_maxsize=max_pool_connections)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[session_key] = session
+        return _sessions[session_key]
 
 
 def url_check(url=None, method='get', timeout=None, response_timeout=2, expected_codes=200, interval=2,
               healthy_threshold=1, ssl_verify=False):
     """Check if a request for a URL gives an expected response"""
-    if not isinstance(expected_codes, list):
-        expected_codes = expected_codes,
-    response = None
-    wait_timeout = time.time() + timeout
-    healthy_count = 0
-    while wait_timeout > time.time():
-        try:
-            if method.lower() == 'get':
-                response = requests.get(url=url, timeout=response_timeout, verify=ssl_verify)
-            elif method.lower() == 'head':
-                response = requests.head(url=url, timeout=response_timeout, verify=ssl_verify)
-            if response.status_code in expected_codes:
-                healthy_count += 1
-            if healthy_count == healthy_threshold:
-                return True
-        # TODO: Remove broad exception - some scenarios should be a failure
-        except BaseException:
-            healthy_count = 0
-            time.sleep(interval)
+    results = check_urls(checks=[dict(url=url, method=method, response_timeout=response_timeout,
+                                      expected_codes=expected_codes, interval=interval,
+                                      healthy_threshold=healthy_threshold, ssl_verify=ssl_verify)],
+                         timeout=timeout, jitter=0)
+    return results[url]['healthy']
+
+
+def check_urls(checks=None, timeout=None, max_concurrency=None, jitter=0.1, session=None):
+    """Check many URLs concurrently until all give their expected responses or the timeout passes.
+
+    Each URL is checked at its own interval until it has given the expected response healthy_threshold times in a
+    row. Intervals are jittered so checks of the same backends do not fall in step, and requests are made over a
+    pooled keep-alive session.
+
+    Args:
+        checks (list): URLs, or dicts containing a 'url' and, optionally, the 'method', 'expected_codes',
+            'interval', 'healthy_threshold', 'response_timeout' and 'ssl_verify' to check it with, as for url_check.
+        timeout (float): The number of seconds to wait for all URLs to become healthy.
+        max_concurrency (Optional[int]): The maximum number of requests in progress at once. Defaults to 10.
+        jitter (float): The proportion by which each interval is randomly lengthened or shortened.
+        session (Optional[requests.Session]): The session to make requests with. Defaults to a shared session.
+    Returns:
+        a dict, keyed by URL, of dicts containing whether the URL is 'healthy', the number of 'attempts', and the
+        'status_code' or 'error' of the last attempt.
+    """
+    max_concurrency = max_concurrency or DEFAULT_MAX_CHECK_CONCURRENCY
+    session = session or get_session(max_pool_connections=max_concurrency)
+    states = list()
+    for check in checks:
+        check = dict(url=check) if not isinstance(check, dict) else check
+        expected_codes = check.get('expected_codes', 200)
+        states.append(dict(url=check['url'], method=check.get('method', 'get').upper(),
+                           expected_codes=expected_codes if isinstance(expected_codes, (list, tuple)) else (
+                               expected_codes,),
+                           interval=check.get('interval', 2), healthy_threshold=check.get('healthy_threshold', 1),
+                           response_timeout=check.get('response_timeout', 2), ssl_verify=check.get('ssl_verify', False),
+                           healthy_count=0, attempts=0, status_code=None, error=None))
+
+    def attempt(state):
+        return session.request(state['method'], state['url'], timeout=state['response_timeout'],
+                               verify=state['ssl_verify']).status_code
+
+    now = time.time()
+    deadline = now + timeout
+    # Spread the first checks over a fraction of their interval
+    due = [(now + random.uniform(0, jitter * state['interval']), index) for index, state in enumerate(states)]
+    heapq.heapify(due)
+    completed = queue.Queue()
+    in_flight = 0
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        while due or in_flight:
+            now = time.time()
+            if now >= deadline:
+                break
+            while due and due[0][0] <= now and in_flight < max_concurrency:
+                _, index = heapq.heappop(due)
+                future = executor.submit(attempt, states[index])
+                future.add_done_callback(lambda done, index=index: completed.put((index, done)))
+                in_flight += 1
+            wait_until = due[0][0] if due and in_flight < max_concurrency else deadline
+            try:
+                index, done = completed.get(timeout=max(0.0, min(wait_until, deadline) - now))
+            except queue.Empty:
+                continue
+            in_flight -= 1
+            state = states[index]
+            state['attempts'] += 1
+            error = done.exception()
+            if error is None and done.result() in state['expected_codes']:
+                state['healthy_count'] += 1
+            else:
+                state['healthy_count'] = 0
+            state['status_code'] = done.result() if error is None else None
+            state['error'] = '{0}'.format(error) if error is not None else None
+            if state['healthy_count'] < state['healthy_threshold']:
+                interval = state['interval'] * random.uniform(1 - jitter, 1 + jitter)
+                heapq.heappush(due, (time.time() + interval, index))
+    finally:
+        executor.shutdown(wait=False)
+    return dict((state['url'], dict(healthy=state['healthy_count'] >= state['healthy_threshold'],
+                                    attempts=state['attempts'], status_code=state['status_code'],
+                                    error=state['error'])) for state in states)
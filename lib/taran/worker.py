@@ -5,6 +5,7 @@
 from __future__ import (absolute_import, print_function, unicode_literals)
 
 import json
+import threading
 
 from botocore.exceptions import ClientError
 from contracts import contract
@@ -12,11 +13,140 @@ from contracts import contract
 from taran import Taran
 
 
+class ActivityTask(object):
+    """The context of a single activity task, allowing several tasks to be in progress at once.
+
+    Attributes:
+        task (dict): The activity task as returned by SWF.
+        task_token (unicode): The token used to respond to the task.
+        activity_id (unicode): The id of the activity.
+        activity_type_name (unicode): The name of the activity type.
+        activity_type_version (unicode): The version of the activity type.
+        input (unicode): The input provided when the activity was scheduled.
+        workflow_id (unicode): The id of the workflow execution the task belongs to.
+        run_id (unicode): The run id of the workflow execution the task belongs to.
+        workflow_name (unicode): The name of the workflow type.
+        workflow_version (unicode): The version of the workflow type.
+        cancel_requested (bool): True once a heartbeat has reported that cancellation of the task was requested.
+    """
+
+    def __init__(self, task=None, workflow_type=None):
+        self.task = task
+        self.task_token = task['taskToken']
+        self.activity_id = task.get('activityId')
+        self.activity_type_name = task['activityType']['name']
+        self.activity_type_version = task['activityType'].get('version')
+        self.input = task.get('input')
+        self.workflow_id = task['workflowExecution']['workflowId']
+        self.run_id = task['workflowExecution']['runId']
+        self.workflow_name = workflow_type['name'] if workflow_type else '-'
+        self.workflow_version = workflow_type['version'] if workflow_type else '-'
+        self.cancel_requested = False
+
+
+class HeartbeatManager(object):
+    """Record heartbeats for a worker's activity tasks in progress from a single background thread.
+
+    Every task in progress is heartbeated on each round, so concurrent tasks share one thread and one schedule.
+    The thread runs only whilst there are tasks to heartbeat.
+
+    Attributes:
+        worker (Worker): The worker the tasks were assigned to.
+        interval (int): The number of seconds between rounds of heartbeats.
+    """
+
+    def __init__(self, worker=None, interval=60):
+        self.worker = worker
+        self.interval = interval
+        self._tasks = dict()
+        self._details = dict()
+        self._closed_tasks = dict()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def add(self, activity_task=None):
+        """Start heartbeating an activity task.
+
+        Args:
+            activity_task (ActivityTask): The context of the task.
+        """
+        with self._lock:
+            self._tasks[activity_task.task_token] = activity_task
+            if self._thread is None:
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self.run, name='taran-heartbeat')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def remove(self, task_token=None):
+        """Stop heartbeating an activity task, e.g. because it has completed or failed."""
+        with self._lock:
+            self._tasks.pop(task_token, None)
+            self._details.pop(task_token, None)
+            self._closed_tasks.pop(task_token, None)
+
+    def set_details(self, task_token=None, details=None):
+        """Set the details, e.g. progress, to send with subsequent heartbeats of a task."""
+        with self._lock:
+            if task_token in self._tasks:
+                self._details[task_token] = details
+
+    def is_cancel_requested(self, task_token=None):
+        """Return True if cancellation of a task has been requested."""
+        activity_task = self._tasks.get(task_token) or self._closed_tasks.get(task_token)
+        return bool(activity_task and activity_task.cancel_requested)
+
+    def stop(self):
+        """Stop heartbeating all tasks and wait for the heartbeat thread to finish."""
+        with self._lock:
+            self._tasks.clear()
+            self._details.clear()
+            self._closed_tasks.clear()
+            thread = self._thread
+        self._stopping.set()
+        if thread and thread is not threading.current_thread():
+            thread.join()
+
+    def run(self):
+        """Heartbeat tasks every interval until there are none left."""
+        while True:
+            self._stopping.wait(self.interval)
+            with self._lock:
+                if not self._tasks or self._stopping.is_set():
+                    self._thread = None
+                    return
+            self.beat()
+
+    def beat(self):
+        """Record a heartbeat for every task in progress."""
+        with self._lock:
+            tasks = list(self._tasks.items())
+            details = dict(self._details)
+        for task_token, activity_task in tasks:
+            kwargs = dict(details=details[task_token]) if details.get(task_token) else dict()
+            try:
+                status = self.worker.swf_client.record_activity_task_heartbeat(taskToken=task_token, **kwargs)
+            except ClientError as ce:
+                if 'UnknownResourceFault' in ce.response['Error']['Code']:
+                    # The task has already timed out or its workflow execution has closed
+                    activity_task.cancel_requested = True
+                    with self._lock:
+                        if self._tasks.pop(task_token, None):
+                            self._closed_tasks[task_token] = activity_task
+                else:
+                    self.worker.msg(message='Unable to record heartbeat: {0}'.format(ce), level='warning')
+                continue
+            if status and status.get('cancelRequested'):
+                activity_task.cancel_requested = True
+
+
 class Worker(Taran):
     """A template for all decision processors.
 
     Attributes:
         configuration (module): The configuration a worker needs in order to participate in the workflow.
+        heartbeat (HeartbeatManager): Records heartbeats for the worker's activity tasks in progress.
     """
 
     @contract(configuration='*')
@@ -27,6 +157,9 @@ class Worker(Taran):
             configuration (module): The configuration a worker needs in order to participate in the workflow.
         """
         super(Worker, self).__init__(configuration=configuration)
+        self.heartbeat = HeartbeatManager(
+            worker=self,
+            interval=configuration.HEARTBEAT_INTERVAL if hasattr(configuration, 'HEARTBEAT_INTERVAL') else 60)
 
     def poll_for_activity_task(self):
         """Poll for an activity task from SWF and return if a task token has been provided.
@@ -35,25 +168,44 @@ class Worker(Taran):
             task (dict): Details of the assigned task.
         """
         self.msg(message='Polling for task routed to: ({0})...'.format(self.task_list))
+        activity_task = self.poll_for_task()
+        if activity_task:
+            self.set_activity_task(activity_task=activity_task)
+
+    def set_activity_task(self, activity_task=None):
+        """Make an activity task the worker's current task.
+
+        Args:
+            activity_task (ActivityTask): The context of the task.
+        """
+        self.activity_task = activity_task.task
+        self.activity_type_name = activity_task.activity_type_name
+        self.workflow_id = activity_task.workflow_id
+        self.run_id = activity_task.run_id
+        self.task_token = activity_task.task_token
+        self.workflow_name = activity_task.workflow_name
+        self.workflow_version = activity_task.workflow_version
+
+    def poll_for_task(self, task_list=None):
+        """Poll for an activity task from SWF without changing the worker's state.
+
+        Args:
+            task_list (Optional[unicode]): The task list to poll. Defaults to the worker's task list.
+        Returns:
+            activity_task (ActivityTask): The context of the assigned task, or None if no task was assigned.
+        """
         try:
             task = self.swf_client.poll_for_activity_task(domain=self.domain_name,
-                                                          taskList={'name': self.task_list},
+                                                          taskList={'name': task_list or self.task_list},
                                                           identity=self.identity)
             if task and 'taskToken' in task:
-                self.activity_task = task
-                self.activity_type_name = task['activityType']['name']
-                self.workflow_id = task['workflowExecution']['workflowId']
-                self.run_id = task['workflowExecution']['runId']
-                self.task_token = task['taskToken']
-                # SET WORKFLOW NAME AND VERSION
-                workflow_execution = self.swf_client.describe_workflow_execution(domain=self.domain_name,
-                                                                                 execution={
-                                                                                     'workflowId': self.workflow_id,
-                                                                                     'runId': self.run_id
-                                                                                 }
-                                                                                 )
-                self.workflow_name = workflow_execution['executionInfo']['workflowType']['name']
-                self.workflow_version = workflow_execution['executionInfo']['workflowType']['version']
+                workflow_type = self.describe_workflow_execution(
+                    workflow_id=task['workflowExecution']['workflowId'],
+                    run_id=task['workflowExecution']['runId'])['workflowType']
+                activity_task = ActivityTask(task=task, workflow_type=workflow_type)
+                if self.heartbeat.interval:
+                    self.heartbeat.add(activity_task=activity_task)
+                return activity_task
         except ClientError as ce:
             if 'AccessDeniedException' in ce.response['Error']['Code']:
                 self.msg(message='Insufficient privileges to poll for task', level='error')
@@ -61,10 +213,26 @@ class Worker(Taran):
         except:
             raise
 
+    def is_cancel_requested(self, task_token=None):
+        """Return True if cancellation of an activity task has been requested.
+
+        Args:
+            task_token (Optional[unicode]): The token of the task. Defaults to the current task.
+        """
+        return self.heartbeat.is_cancel_requested(task_token=task_token or self.task_token)
+
+    def set_heartbeat_details(self, details=None, task_token=None):
+        """Set the details, e.g. progress, to send with subsequent heartbeats of an activity task.
+
+        Args:
+            details (unicode): The details to send.
+            task_token (Optional[unicode]): The token of the task. Defaults to the current task.
+        """
+        self.heartbeat.set_details(task_token=task_token or self.task_token, details=details)
+
     def get_activity_results(self, activity=None):
         """Get a list of all results (when activity completed)"""
-        activity_history = self.get_activity_history(workflow_history=self.workflow_history,
-                                                     activity_type=activity)
+        activity_history = self.get_indexed_history().get_activity_history(activity_type=activity)
         results_list = list()
         if activity_history:
             for activity_event in activity_history:
@@ -72,20 +240,33 @@ class Worker(Taran):
                     results_list.append(json.loads(activity_event.get('result')))
         return results_list
 
-    def complete_activity_task(self, result='Undefined'):
-        """Signal activity task as complete."""
+    def complete_activity_task(self, result='Undefined', task_token=None):
+        """Signal activity task as complete.
+
+        Args:
+            result (unicode): The result of the activity task.
+            task_token (Optional[unicode]): The token of the task to complete. Defaults to the current task.
+        """
+        self.heartbeat.remove(task_token=task_token or self.task_token)
         try:
-            self.swf_client.respond_activity_task_completed(taskToken=self.task_token, result=result)
+            self.swf_client.respond_activity_task_completed(taskToken=task_token or self.task_token, result=result)
         except ClientError as ce:
             if 'UnknownResourceFault' in ce.response['Error']['Code']:
                 self.msg(message='Unable to complete activity task as Workflow'
                                  ' execution does not exist (already terminated?)')
 
-    def activity_task_failed(self, reason=None, details=None):
-        """Signal that activity task failed."""
+    def activity_task_failed(self, reason=None, details=None, task_token=None):
+        """Signal that activity task failed.
+
+        Args:
+            reason (unicode): The reason the activity task failed.
+            details (unicode): Details of the failure.
+            task_token (Optional[unicode]): The token of the task that failed. Defaults to the current task.
+        """
+        self.heartbeat.remove(task_token=task_token or self.task_token)
         try:
             self.swf_client.respond_activity_task_failed(
-                taskToken=self.task_token,
+                taskToken=task_token or self.task_token,
                 reason=reason,
                 details=details
             )
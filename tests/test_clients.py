@@ -5,7 +5,7 @@ from __future__ import (absolute_import, print_function, unicode_literals)
 from moto import mock_swf, mock_ec2, mock_elb, mock_autoscaling, mock_s3
 
 from taran.helpers.aws.clients import (get_swf_client, get_ec2_client, get_elb_client,
-                                       get_asg_client, get_s3_client)
+                                       get_asg_client, get_s3_client, reset_clients)
 
 
 @mock_swf
@@ -44,3 +44,15 @@ def test_get_s3_client():
     # with pytest.raises(ValueError, SystemExit):
     #     os.environ['AWS_DEFAULT_REGION'] = ''
     #     assert get_s3_client()
+
+
+@mock_swf
+def test_clients_are_shared():
+    """Clients are reused for the same service, region and configuration"""
+    assert get_swf_client() is get_swf_client()
+    assert get_swf_client(region='us-east-1') is not get_swf_client()
+    assert get_swf_client(max_pool_connections=50) is not get_swf_client()
+    assert get_swf_client(max_pool_connections=50).meta.config.max_pool_connections == 50
+    client = get_swf_client()
+    reset_clients()
+    assert get_swf_client() is not client
@@ -3,17 +3,30 @@
 from __future__ import (absolute_import, print_function, unicode_literals)
 
 import datetime
+import gc
+import hashlib
+import io
+import os
+import time
 
 import pytest
 from boto3 import Session
+from boto3.s3.transfer import TransferConfig
+from botocore.client import Config
+from botocore.exceptions import ClientError
 from dateutil.tz.tz import tzlocal
-from moto import mock_ec2, mock_s3, mock_iam
+from moto import mock_ec2, mock_elb, mock_s3, mock_iam, mock_sts, mock_swf
 from six import text_type
 
-from taran.errors import TaranError
+from taran.errors import TaranError, TaranTransferError
 from taran.helpers.aws import get_account_id
-from taran.helpers.aws.s3 import get_s3_md5, s3_download, s3_upload
-from taran.helpers.aws.swf import get_activity_history, get_activity_version
+from taran.helpers.aws.artifacts import ArtifactCache
+from taran.helpers.aws.ec2 import elb_deregister_instances, elb_rotate, wait_with_backoff
+from taran.helpers.aws.ratelimit import RateLimitedClient, RateLimiter, TokenBucket
+from taran.helpers.aws.s3 import (S3Writer, get_s3_md5, is_unchanged, iter_s3_chunks, open_s3_reader, ranged_download,
+                                  s3_download, s3_sync, s3_upload, stream_download)
+from taran.helpers.aws.swf import (WorkflowHistory, get_activity_history, get_activity_version, iter_history_events,
+                                   iter_history_pages)
 
 
 # TODO - Implement once moto library supports list_users
@@ -24,12 +37,134 @@ def test_get_account_id():
         get_account_id()
 
 
+def test_get_account_id_cached(tmpdir):
+    """Account ids are looked up once and then served from the process and disk caches"""
+    import taran.helpers.aws
+    cache_path = text_type(tmpdir.join('cache', 'account_id.json'))
+    with mock_sts():
+        assert get_account_id(cache_path=cache_path) == '123456789012'
+    assert get_account_id(cache_path=cache_path) == '123456789012'
+    taran.helpers.aws._account_ids.clear()
+    assert get_account_id(cache_path=cache_path) == '123456789012'
+    taran.helpers.aws._account_ids.clear()
+    with mock_sts():
+        assert get_account_id(ttl=0, cache_path=cache_path) == '123456789012'
+    assert oct(os.stat(text_type(tmpdir.join('cache'))).st_mode & 0o777) == oct(0o700)
+
+
+def test_account_id_cache_must_be_private(tmpdir):
+    """A cache file other users could have written is not trusted"""
+    import taran.helpers.aws
+    account_ids = {'key': dict(account_id='123456789012', expires=time.time() + 60)}
+    cache_path = text_type(tmpdir.join('cache', 'account_id.json'))
+    taran.helpers.aws.write_account_id_cache(cache_path=cache_path, account_ids=account_ids)
+    assert taran.helpers.aws.read_account_id_cache(cache_path=cache_path) == account_ids
+    os.chmod(cache_path, 0o666)
+    assert taran.helpers.aws.read_account_id_cache(cache_path=cache_path) == dict()
+    os.chmod(cache_path, 0o600)
+    tmpdir.join('cache').chmod(0o777)
+    assert taran.helpers.aws.read_account_id_cache(cache_path=cache_path) == dict()
+    taran.helpers.aws.write_account_id_cache(cache_path=cache_path, account_ids=dict())
+    tmpdir.join('cache').chmod(0o700)
+    assert taran.helpers.aws.read_account_id_cache(cache_path=cache_path) == account_ids
+
+
 @mock_ec2
 def test_get_ec2_instance_id():
     """Return the id from an ec2 instance"""
     assert test_get_ec2_instance_id
 
 
+@mock_ec2
+@mock_elb
+def test_elb_rotate():
+    """Instances are rotated on many ELBs at once"""
+    instances = Session().client('ec2').run_instances(ImageId='ami-12c6146b', MinCount=4, MaxCount=4)['Instances']
+    old_ids, new_ids = [instance['InstanceId'] for instance in instances[:2]], [
+        instance['InstanceId'] for instance in instances[2:]]
+    elb_client = Session().client('elb')
+    elb_names = ['elb-{0}'.format(index) for index in range(3)]
+    for elb_name in elb_names:
+        elb_client.create_load_balancer(LoadBalancerName=elb_name, AvailabilityZones=['eu-west-1a'], Listeners=[
+            {'Protocol': 'http', 'LoadBalancerPort': 80, 'InstancePort': 80}])
+        elb_client.register_instances_with_load_balancer(LoadBalancerName=elb_name,
+                                                         Instances=[{'InstanceId': old_id} for old_id in old_ids])
+    results = elb_rotate(register=dict((elb_name, new_ids) for elb_name in elb_names),
+                         deregister=dict((elb_name, old_ids) for elb_name in elb_names), timeout=10)
+    assert results == dict((elb_name, True) for elb_name in elb_names)
+    for description in elb_client.describe_load_balancers(LoadBalancerNames=elb_names)['LoadBalancerDescriptions']:
+        assert sorted(instance['InstanceId'] for instance in description['Instances']) == sorted(new_ids)
+    assert elb_deregister_instances(elb_name='elb-0', instance_ids=new_ids[:1], timeout=10)
+
+
+def test_wait_with_backoff():
+    """Checks are made at increasing intervals until the timeout passes"""
+    calls = list()
+    started = time.time()
+    assert not wait_with_backoff(check=lambda: calls.append(time.time()) and False, timeout=0.5,
+                                 initial_delay=0.05)
+    assert 0.5 <= time.time() - started < 1 and 3 <= len(calls) <= 8
+    assert wait_with_backoff(check=lambda: True, timeout=0)
+
+
+def test_token_bucket():
+    """Tokens beyond the burst are only available at the bucket's rate"""
+    bucket = TokenBucket(rate=50, burst=2)
+    assert bucket.acquire() == 0 and bucket.acquire() == 0
+    assert bucket.acquire() > 0
+    bucket.decrease()
+    assert bucket.rate == 25
+    bucket.increase(step=1)
+    assert bucket.rate == 50
+
+
+@mock_swf
+def test_rate_limited_client_retries_throttled_calls():
+    """Throttled calls are retried with backoff, slowing the category, and recorded in the metrics"""
+    swf_client = Session().client('swf')
+    responses = [ClientError({'Error': {'Code': 'ThrottlingException', 'Message': ''}}, 'PollForActivityTask'),
+                 {'taskToken': 'token'}]
+
+    def poll_for_activity_task(**kwargs):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    swf_client.poll_for_activity_task = poll_for_activity_task
+    limiter = RateLimiter(budgets={'poll': (100, 1)}, base_delay=0.01)
+    client = RateLimitedClient(client=swf_client, limiter=limiter)
+    start = time.time()
+    assert client.poll_for_activity_task(domain='test') == {'taskToken': 'token'}
+    assert time.time() - start < 1
+    assert client.meta is swf_client.meta
+    metrics = limiter.get_metrics()
+    assert metrics['poll']['calls'] == 2 and metrics['poll']['throttled'] == 1
+    assert metrics['poll']['wait_seconds'] > 0 and limiter.buckets['poll'].rate < 100
+    with pytest.raises(ClientError):
+        RateLimitedClient(client=swf_client, limiter=RateLimiter(max_retries=0)).describe_domain(name='unknown')
+
+
+def test_rate_limited_client_retries_transient_errors():
+    """Server errors are retried by the limiter without reducing the rate, and only the limiter retries"""
+    swf_client = Session().client('swf')
+    responses = [ClientError({'Error': {'Code': 'InternalFailure', 'Message': ''},
+                              'ResponseMetadata': {'HTTPStatusCode': 500}}, 'RespondActivityTaskCompleted'), {}]
+
+    def respond_activity_task_completed(**kwargs):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    swf_client.respond_activity_task_completed = respond_activity_task_completed
+    limiter = RateLimiter(budgets={'respond': (100, 1)}, base_delay=0.01)
+    assert RateLimitedClient(client=swf_client, limiter=limiter).respond_activity_task_completed(taskToken='t') == {}
+    metrics = limiter.get_metrics()
+    assert metrics['respond']['retried'] == 1 and metrics['respond']['throttled'] == 0
+    assert limiter.buckets['respond'].rate == 100
+
+
 @mock_s3
 def test_get_s3_md5(tmpdir):
     """Return the md5/etag of an object in S3"""
@@ -73,6 +208,284 @@ def test_s3_upload(tmpdir):
             {'s3_path': 'test-file.txt', 'bucket': 'test-bucket', 'local_path': text_type(local_file)}])
 
 
+def create_bucket(s3_client=None, bucket=None):
+    """Create a bucket in the client's region"""
+    s3_client.create_bucket(Bucket=bucket, CreateBucketConfiguration={
+        'LocationConstraint': s3_client.meta.region_name})
+
+
+@mock_s3
+def test_s3_transfer_many_items(tmpdir):
+    """Upload and download several objects concurrently, reporting progress and per-item results"""
+    s3_client = Session().client('s3')
+    create_bucket(s3_client=s3_client, bucket='test-bucket')
+    upload_dir, download_dir = tmpdir.mkdir('upload'), tmpdir.mkdir('download')
+    items = list()
+    for index in range(6):
+        local_file = upload_dir.join('file-{0}.txt'.format(index))
+        local_file.write('x' * (index + 1) * 1000)
+        items.append({'s3_path': '/files/file-{0}.txt'.format(index), 'bucket': 'test-bucket',
+                      'local_path': text_type(local_file)})
+    progress = list()
+    results = s3_upload(items=items, max_concurrency=3,
+                        progress_callback=lambda item, item_bytes, transfer: progress.append(item_bytes))
+    assert results['bytes'] == 21000 and results['throughput'] > 0
+    assert [result['bytes'] for result in results['items']] == [1000, 2000, 3000, 4000, 5000, 6000]
+    assert max(progress) == 6000
+    for item in items:
+        item['local_path'] = text_type(download_dir.join(item['s3_path'].split('/')[-1]))
+    results = s3_download(items=items, transfer_config=TransferConfig(max_concurrency=2))
+    assert all(result['error'] is None for result in results['items'])
+    assert download_dir.join('file-5.txt').read() == 'x' * 6000
+    assert download_dir.join('file-5.txt.md5').read().split('\n')[0] == hashlib.md5(b'x' * 6000).hexdigest()
+    items.append({'s3_path': 'missing.txt', 'bucket': 'test-bucket',
+                  'local_path': text_type(download_dir.join('missing.txt'))})
+    with pytest.raises(TaranTransferError) as exc_info:
+        s3_download(items=items)
+    assert [result['error'] is None for result in exc_info.value.results['items']] == [True] * 6 + [False]
+
+
+@mock_s3
+def test_s3_download_through_artifact_cache(tmpdir):
+    """Objects already in the artifact cache are copied into place, and the least recently used are evicted"""
+    s3_client = Session().client('s3')
+    create_bucket(s3_client=s3_client, bucket='test-bucket')
+    s3_client.put_object(Bucket='test-bucket', Key='artifact-1.zip', Body=b'1' * 1000)
+    s3_client.put_object(Bucket='test-bucket', Key='artifact-2.zip', Body=b'2' * 1000)
+    artifact_cache = ArtifactCache(cache_dir=text_type(tmpdir.join('cache')), max_bytes=1500)
+    local_paths = [text_type(tmpdir.join('first.zip')), text_type(tmpdir.join('second.zip'))]
+    results = [s3_download(items=[{'bucket': 'test-bucket', 's3_path': '/artifact-1.zip', 'local_path': local_path}],
+                           artifact_cache=artifact_cache) for local_path in local_paths]
+    assert [result['bytes'] for result in results] == [1000, 0]
+    assert os.stat(local_paths[0]).st_ino != os.stat(local_paths[1]).st_ino
+    assert tmpdir.join('second.zip.md5').read().split('\n')[0] == hashlib.md5(b'1' * 1000).hexdigest()
+    # Changing a fetched file leaves the cached copy intact
+    tmpdir.join('second.zip').write('changed')
+    entry_path = artifact_cache.get_entry_path(bucket='test-bucket', s3_path='artifact-1.zip',
+                                               etag=s3_client.head_object(Bucket='test-bucket',
+                                                                          Key='artifact-1.zip')['ETag'])
+    with open(entry_path) as entry_file:
+        assert entry_file.read() == '1' * 1000
+    tmpdir.join('second.zip').write('1' * 1000)
+    s3_client.put_object(Bucket='test-bucket', Key='artifact-1.zip', Body=b'3' * 1000)
+    s3_download(items=[{'bucket': 'test-bucket', 's3_path': 'artifact-1.zip', 'local_path': local_paths[0]}],
+                artifact_cache=artifact_cache)
+    assert tmpdir.join('first.zip').read() == '3' * 1000
+    assert tmpdir.join('second.zip').read() == '1' * 1000
+    assert len(artifact_cache.get_entries()) == 1
+    assert not os.path.exists('{0}.lock'.format(entry_path))
+    lock_paths = [os.path.join(entry_dir, file_name) for entry_dir, _, file_names in os.walk(artifact_cache.objects_dir)
+                  for file_name in file_names if file_name.endswith('.lock')]
+    assert len(lock_paths) == 1
+
+
+def test_artifact_cache_requires_private_dir(tmpdir):
+    """A cache directory other users can access is not trusted"""
+    cache_dir = tmpdir.join('shared-cache')
+    cache_dir.mkdir()
+    cache_dir.chmod(0o755)
+    with pytest.raises(TaranError):
+        ArtifactCache(cache_dir=text_type(cache_dir))
+    cache_dir.chmod(0o700)
+    assert ArtifactCache(cache_dir=text_type(cache_dir)).cache_dir == text_type(cache_dir)
+    os.symlink(text_type(cache_dir), text_type(tmpdir.join('linked-cache')))
+    with pytest.raises(TaranError):
+        ArtifactCache(cache_dir=text_type(tmpdir.join('linked-cache')))
+
+
+@mock_s3
+def test_s3_sync_skips_unchanged(tmpdir):
+    """Only files whose size or ETag differ are transferred, in either direction"""
+    s3_client = Session().client('s3')
+    create_bucket(s3_client=s3_client, bucket='test-bucket')
+    upload_dir, download_dir = tmpdir.mkdir('upload'), tmpdir.mkdir('download')
+    upload_dir.mkdir('nested').join('b.txt').write('bbb')
+    upload_dir.join('a.txt').write('aaa')
+    results = s3_sync(bucket='test-bucket', s3_prefix='sync', local_dir=text_type(upload_dir), direction='upload')
+    assert sorted(result['s3_path'] for result in results['items']) == ['sync/a.txt', 'sync/nested/b.txt']
+    results = s3_sync(bucket='test-bucket', s3_prefix='sync', local_dir=text_type(upload_dir), direction='upload')
+    assert results['items'] == [] and len(results['unchanged']) == 2
+    upload_dir.join('a.txt').write('changed')
+    results = s3_sync(bucket='test-bucket', s3_prefix='sync/', local_dir=text_type(upload_dir), direction='upload')
+    assert [result['s3_path'] for result in results['items']] == ['sync/a.txt']
+    results = s3_sync(bucket='test-bucket', s3_prefix='sync', local_dir=text_type(download_dir))
+    assert len(results['items']) == 2
+    assert download_dir.join('nested', 'b.txt').read() == 'bbb'
+    results = s3_sync(bucket='test-bucket', s3_prefix='sync', local_dir=text_type(download_dir))
+    assert results['items'] == [] and len(results['unchanged']) == 2
+
+
+@mock_s3
+def test_s3_sync_rejects_keys_outside_local_dir(tmpdir, monkeypatch):
+    """Keys that would be written outside the local directory are rejected before anything is downloaded"""
+    import taran.helpers.aws.s3
+    download_dir = tmpdir.mkdir('download')
+    for key in ('sync/../escaped.txt', 'sync/nested/../../../escaped.txt'):
+        monkeypatch.setattr(taran.helpers.aws.s3, 'list_s3_objects', lambda key=key, **kwargs: {
+            'sync/a.txt': {'Size': 1, 'ETag': '"0"'}, key: {'Size': 1, 'ETag': '"0"'}})
+        with pytest.raises(TaranError):
+            s3_sync(bucket='test-bucket', s3_prefix='sync', local_dir=text_type(download_dir))
+    assert download_dir.listdir() == [] and not tmpdir.join('escaped.txt').exists()
+
+
+def test_is_unchanged_with_multipart_etag(tmpdir):
+    """Multipart ETags are compared with the ETag of the local file split into parts"""
+    local_file = tmpdir.join('large.bin')
+    content = b'x' * (3 * 1024 * 1024 + 10)
+    local_file.write_binary(content)
+    part_digests = b''.join(hashlib.md5(content[start:start + 2 * 1024 * 1024]).digest()
+                            for start in range(0, len(content), 2 * 1024 * 1024))
+    etag = '"{0}-2"'.format(hashlib.md5(part_digests).hexdigest())
+    assert is_unchanged(local_path=text_type(local_file), size=len(content), etag=etag)
+    assert not is_unchanged(local_path=text_type(local_file), size=len(content), etag='"{0}-3"'.format('0' * 32))
+    assert not is_unchanged(local_path=text_type(local_file), size=len(content) + 1, etag=etag)
+
+
+@mock_s3
+def test_stream_download_hashes_ranges_in_order(tmpdir):
+    """An object downloaded as several ranges is hashed whilst it is written"""
+    s3_client = Session().client('s3')
+    create_bucket(s3_client=s3_client, bucket='test-bucket')
+    content = b''.join(text_type(index).encode('utf-8') for index in range(2000))
+    s3_client.put_object(Bucket='test-bucket', Key='large.txt', Body=content)
+    local_path = text_type(tmpdir.join('large.txt'))
+    transfer_config = TransferConfig(multipart_threshold=1024, multipart_chunksize=1000, io_chunksize=300)
+    received = list()
+    md5 = stream_download(s3_client=s3_client, bucket='test-bucket', s3_path='large.txt', local_path=local_path,
+                          transfer_config=transfer_config, callback=received.append)
+    assert md5 == hashlib.md5(content).hexdigest()
+    assert tmpdir.join('large.txt').read_binary() == content
+    assert sum(received) == len(content) and max(received) == 300
+    assert tmpdir.listdir() == [tmpdir.join('large.txt')]
+
+
+class EncryptedS3Client(object):
+    """An S3 client serving one object whose ETag, as for SSE-KMS and SSE-C objects, is not the MD5 of its content"""
+
+    def __init__(self, content=None, encryption=None):
+        self.content = content
+        self.head = dict(ContentLength=len(content), ETag='"{0}"'.format('0' * 32), **encryption)
+
+    def head_object(self, **kwargs):
+        return self.head
+
+    def get_object(self, **kwargs):
+        start, end = 0, len(self.content) - 1
+        if kwargs.get('Range'):
+            start, end = [int(position) for position in kwargs['Range'][len('bytes='):].split('-')]
+        return {'Body': io.BytesIO(self.content[start:end + 1])}
+
+
+def test_stream_download_encrypted_objects(tmpdir):
+    """The ETags of objects encrypted with SSE-KMS or SSE-C are not checked against their content"""
+    content = b'encrypted' * 100
+    local_path = text_type(tmpdir.join('encrypted.txt'))
+    for encryption in (dict(ServerSideEncryption='aws:kms'), dict(SSECustomerAlgorithm='AES256')):
+        md5 = stream_download(s3_client=EncryptedS3Client(content=content, encryption=encryption), bucket='b',
+                              s3_path='encrypted.txt', local_path=local_path)
+        assert md5 == hashlib.md5(content).hexdigest() and tmpdir.join('encrypted.txt').read_binary() == content
+    with pytest.raises(TaranError):
+        stream_download(s3_client=EncryptedS3Client(content=content, encryption=dict(ServerSideEncryption='AES256')),
+                        bucket='b', s3_path='encrypted.txt', local_path=local_path)
+
+
+def test_ranged_download_encrypted_objects(tmpdir):
+    """Objects downloaded as concurrent ranges have their ETags checked as for stream_download"""
+    content = b''.join(text_type(index).encode('utf-8') for index in range(2000))
+    local_path = text_type(tmpdir.join('encrypted.txt'))
+    transfer_config = TransferConfig(multipart_chunksize=1000, max_concurrency=3)
+    md5 = ranged_download(s3_client=EncryptedS3Client(content=content, encryption=dict(ServerSideEncryption='aws:kms')),
+                          bucket='b', s3_path='encrypted.txt', local_path=local_path, transfer_config=transfer_config)
+    assert md5 == hashlib.md5(content).hexdigest() and tmpdir.join('encrypted.txt').read_binary() == content
+    with pytest.raises(TaranError):
+        ranged_download(s3_client=EncryptedS3Client(content=content, encryption=dict()), bucket='b',
+                        s3_path='encrypted.txt', local_path=local_path, transfer_config=transfer_config)
+
+
+class TruncatingS3Client(object):
+    """An S3 client whose first response to each range is cut short, as if its connection dropped"""
+
+    def __init__(self, s3_client=None):
+        self.s3_client = s3_client
+        self.ranges = list()
+
+    def get_object(self, **kwargs):
+        self.ranges.append(kwargs['Range'])
+        response = self.s3_client.get_object(**kwargs)
+        if len(self.ranges) <= 4:
+            response['Body'] = io.BytesIO(response['Body'].read()[:100])
+        return response
+
+
+@mock_s3
+def test_ranged_download_resumes_failed_ranges(tmpdir):
+    """Ranges are downloaded concurrently and resumed from the last byte written after a dropped connection"""
+    s3_client = Session().client('s3')
+    create_bucket(s3_client=s3_client, bucket='test-bucket')
+    content = b''.join(text_type(index).encode('utf-8') for index in range(2000))
+    s3_client.put_object(Bucket='test-bucket', Key='large.txt', Body=content)
+    head = s3_client.head_object(Bucket='test-bucket', Key='large.txt')
+    truncating_client = TruncatingS3Client(s3_client=s3_client)
+    local_path = text_type(tmpdir.join('large.txt'))
+    transfer_config = TransferConfig(multipart_threshold=1024, multipart_chunksize=1000, max_concurrency=4,
+                                     io_chunksize=300)
+    received = list()
+    md5 = ranged_download(s3_client=truncating_client, bucket='test-bucket', s3_path='large.txt',
+                          local_path=local_path, transfer_config=transfer_config, callback=received.append,
+                          head=head)
+    assert md5 == hashlib.md5(content).hexdigest()
+    assert tmpdir.join('large.txt').read_binary() == content
+    assert sum(received) == len(content)
+    assert len(truncating_client.ranges) == len(range(0, len(content), 1000)) + 4
+    assert 'bytes=100-999' in truncating_client.ranges
+    assert tmpdir.listdir() == [tmpdir.join('large.txt')]
+
+
+@mock_s3
+def test_stream_s3_objects():
+    """Objects are read in chunks with read ahead and written as multipart uploads, without local files"""
+    s3_client = Session().client('s3')
+    create_bucket(s3_client=s3_client, bucket='test-bucket')
+    lines = ['line {0}\n'.format(index) for index in range(500)]
+    s3_client.put_object(Bucket='test-bucket', Key='lines.txt', Body=''.join(lines).encode('utf-8'))
+    chunks = list(iter_s3_chunks(s3_client=s3_client, bucket='test-bucket', s3_path='/lines.txt', chunk_size=1000))
+    assert [len(chunk) for chunk in chunks[:-1]] == [1000] * (len(chunks) - 1)
+    reader = io.TextIOWrapper(open_s3_reader(bucket='test-bucket', s3_path='lines.txt', chunk_size=1000),
+                              encoding='utf-8')
+    with reader:
+        assert list(reader) == lines
+    part = b'x' * (1024 * 1024)
+    # Parts sent with trailing checksums are stored verbatim by moto
+    part_client = Session().client('s3', config=Config(request_checksum_calculation='when_required'))
+    with S3Writer(s3_client=part_client, bucket='test-bucket', s3_path='large.bin', part_size=1) as writer:
+        for _ in range(11):
+            writer.write(part)
+    large = s3_client.get_object(Bucket='test-bucket', Key='large.bin')
+    assert large['ETag'].strip('"').endswith('-3') and large['ContentLength'] == 11 * len(part)
+    with S3Writer(bucket='test-bucket', s3_path='small.txt', extra_args={'ContentType': 'text/plain'}) as writer:
+        writer.write(b'small')
+    small = s3_client.get_object(Bucket='test-bucket', Key='small.txt')
+    assert small['Body'].read() == b'small' and small['ContentType'] == 'text/plain'
+    with pytest.raises(ValueError):
+        with S3Writer(bucket='test-bucket', s3_path='aborted.bin') as writer:
+            writer.write(part * 6)
+            raise ValueError('Failed to produce content')
+    assert 'aborted.bin' not in [s3_object['Key'] for s3_object in s3_client.list_objects_v2(
+        Bucket='test-bucket')['Contents']]
+    assert not s3_client.list_multipart_uploads(Bucket='test-bucket').get('Uploads')
+    # A writer dropped part way through, or closed without being committed, publishes nothing
+    writer = S3Writer(s3_client=part_client, bucket='test-bucket', s3_path='dropped.bin', part_size=1)
+    writer.write(part * 6)
+    del writer
+    gc.collect()
+    writer = S3Writer(bucket='test-bucket', s3_path='closed.txt')
+    writer.write(b'partial')
+    writer.close()
+    keys = [s3_object['Key'] for s3_object in s3_client.list_objects_v2(Bucket='test-bucket')['Contents']]
+    assert 'dropped.bin' not in keys and 'closed.txt' not in keys
+    assert not s3_client.list_multipart_uploads(Bucket='test-bucket').get('Uploads')
+
+
 successful_workflow_history = {'previous_started_event_id': 9, 'next_page_token': None, 'events': [
     {'eventId': 1, 'eventType': 'WorkflowExecutionStarted',
      'workflowExecutionStartedEventAttributes': {'taskList': {'name': 'default'},
@@ -198,6 +611,61 @@ def test_get_activity_with_missing_input():
         assert get_activity_history(workflow_history=successful_workflow_history)
 
 
+def test_workflow_history_index():
+    """Query an indexed workflow history by event type, activity type and scheduled event id"""
+    history = WorkflowHistory.from_workflow_history(workflow_history=successful_workflow_history)
+    assert len(history) == 15
+    assert history.last_event_id == 15
+    assert [event['eventId'] for event in history.get_events(event_type='ActivityTaskCompleted')] == [7, 13]
+    assert history.get_workflow_input() == {'test': 'test', 'task_list': 'i-6fbd1de3'}
+    activity_history = history.get_activity_history(activity_type='activity1')
+    assert [event['status'] for event in activity_history] == ['scheduled', 'started', 'completed']
+    assert activity_history[2]['result'] == '{"result": "the_result"}'
+    assert [event['status'] for event in history.get_activity_history(scheduled_ids=[11])] == ['started', 'completed']
+    assert history.get_activity_history(activity_type='unknown') is None
+    assert history.get_activity_history(activity_type='activity1') == get_activity_history(
+        workflow_history=successful_workflow_history, activity_type='activity1')
+
+
+def test_workflow_history_index_is_order_independent():
+    """Events indexed newest first or added twice give the same results"""
+    events = successful_workflow_history['events']
+    history = WorkflowHistory(events=list(reversed(events)))
+    history.add_events(events=events)
+    assert len(history) == len(events)
+    assert history.get_activity_history(activity_type='activity2') == WorkflowHistory(
+        events=events).get_activity_history(activity_type='activity2')
+
+
+def test_workflow_history_index_cancel_requested():
+    """Cancel requests are matched to their activity by activity id"""
+    events = timed_out_workflow_history['events'][:5] + [
+        {'eventId': 6, 'eventType': 'ActivityTaskCancelRequested',
+         'activityTaskCancelRequestedEventAttributes': {'decisionTaskCompletedEventId': 4,
+                                                        'activityId': '4378db30-04ba-11e6-859f-3c15c2e45d3a'}}]
+    history = WorkflowHistory(events=events)
+    assert [event['status'] for event in history.get_activity_history(activity_type='activity1')] == [
+        'scheduled', 'cancel_requested']
+
+
+def test_iter_history_pages():
+    """Pages are retrieved using the token from the previous page, optionally ahead of time"""
+    pages = {None: {'events': [{'eventId': 3}], 'nextPageToken': 'b'},
+             'b': {'events': [{'eventId': 2}, {'eventId': 1}]}}
+    for prefetch in (False, True):
+        requested = list()
+
+        def get_page(next_page_token=None):
+            requested.append(next_page_token)
+            return pages[next_page_token]
+
+        events = iter_history_events(pages=iter_history_pages(get_page=get_page, prefetch=prefetch))
+        assert [event['eventId'] for event in events] == [3, 2, 1]
+        assert requested == [None, 'b']
+    with pytest.raises(TaranError):
+        list(iter_history_pages(get_page=lambda next_page_token=None: None))
+
+
 def test_get_activity_version():
     """Test the retrieval of a version number from an activity list based on the name as input."""
     activity_list = [{'name': 'test', 'version': '9'}]
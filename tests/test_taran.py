@@ -2,13 +2,28 @@
 """Test workflow creation, start and termination basics"""
 from __future__ import (absolute_import, print_function, unicode_literals)
 
+import json
+import re
+import sys
+import threading
+import time
+
 import pytest
+from botocore.exceptions import ClientError
 from moto import mock_swf
+from six import text_type
 
 import tests.config as config
-from taran.foreman import Foreman
-from taran.helpers.aws.swf import get_activity_version
+from taran.errors import TaranError
+from taran.foreman import Decision, Foreman, get_shard_workflow_id, plan_fan_out
+from taran.helpers.aws.swf import (MAX_CONTROL_LENGTH, MAX_DECISIONS, OVERFLOW_TIMER_PREFIX, DecisionBuilder,
+                                   WorkflowHistory, get_activity_version)
+from taran.pool import WorkerPool
+from taran.rolling import (RollingDeployForeman, get_host_task_list, get_stage_activity_id, handle_stage_task,
+                           plan_rolling_deploy)
 from taran.starter import Starter
+from taran.worker import ActivityTask, Worker
+from tests.test_helpers import successful_workflow_history
 
 
 # def test_import_error():
@@ -31,6 +46,14 @@ def test_foreman_instanciation():
     assert foreman
 
 
+@mock_swf
+def test_rate_limited_swf_client_has_no_botocore_retries():
+    """Calls made through the rate limiter are only retried by the limiter"""
+    foreman = Foreman(configuration=config)
+    retries = foreman.get_rate_limited_swf_client().client.meta.config.retries
+    assert retries.get('total_max_attempts', retries.get('max_attempts', 0) + 1) == 1
+
+
 @mock_swf
 def test_starter_domain_registration():
     """Test domain registration when domain does not exist"""
@@ -120,6 +143,294 @@ def test_schedule_activity_task():
     foreman.identity = foreman.hostname
     assert foreman.poll_for_decision_task()
 
+
+class PagedHistoryClient(object):
+    """An SWF client stand-in that serves a workflow history newest first, two events per page."""
+
+    def __init__(self, events=None):
+        self.events = events
+        self.requests = list()
+
+    def get_page(self, next_page_token=None):
+        start = int(next_page_token or 0)
+        newest_first = sorted(self.events, key=lambda event: event['eventId'], reverse=True)
+        page = dict(events=newest_first[start:start + 2])
+        if start + 2 < len(newest_first):
+            page['nextPageToken'] = text_type(start + 2)
+        return page
+
+    def get_workflow_execution_history(self, **kwargs):
+        self.requests.append(kwargs)
+        return self.get_page(next_page_token=kwargs.get('nextPageToken'))
+
+    def poll_for_decision_task(self, **kwargs):
+        self.requests.append(kwargs)
+        page = self.get_page(next_page_token=kwargs.get('nextPageToken'))
+        page.update(taskToken='token', workflowExecution={'workflowId': 'wf', 'runId': 'run'},
+                    workflowType={'name': 'wftype', 'version': '1'})
+        return page
+
+    def describe_workflow_execution(self, **kwargs):
+        self.requests.append(kwargs)
+        return {'executionInfo': {'workflowType': {'name': 'wftype', 'version': '1'}}}
+
+
+@mock_swf
+def test_foreman_incremental_workflow_history():
+    """Only events added since the previous decision are fetched for a cached workflow execution"""
+    foreman = Foreman(configuration=config)
+    events = successful_workflow_history['events']
+    foreman.swf_client = PagedHistoryClient(events=events[:11])
+    assert foreman.poll_for_decision_task()
+    assert len(foreman.swf_client.requests) == 6
+    assert [event['eventId'] for event in foreman.get_workflow_history()['events']] == list(range(1, 12))
+    foreman.swf_client = PagedHistoryClient(events=events)
+    assert foreman.poll_for_decision_task()
+    assert len(foreman.swf_client.requests) == 2
+    assert [event['eventId'] for event in foreman.workflow_history['events']] == list(range(1, 16))
+    assert foreman.get_activity_results(activity='activity1') == [{'result': 'the_result'}]
+
+
+@mock_swf
+def test_foreman_get_workflow_history():
+    """Fetch the entire workflow history of an execution that was not polled for"""
+    foreman = Foreman(configuration=config)
+    foreman.swf_client = PagedHistoryClient(events=successful_workflow_history['events'])
+    foreman.workflow_id, foreman.run_id = 'wf', 'run'
+    assert len(foreman.get_workflow_history()['events']) == 15
+    assert len(foreman.swf_client.requests) == 8
+    assert foreman.get_activity_status(activity='activity1')['counts']['completed'] == 1
+
+
+@mock_swf
+def test_foreman_iter_workflow_history():
+    """Stop iterating over the workflow history once the required event is found"""
+    foreman = Foreman(configuration=config)
+    foreman.swf_client = PagedHistoryClient(events=successful_workflow_history['events'])
+    foreman.workflow_id, foreman.run_id = 'wf', 'run'
+    for event in foreman.iter_workflow_history():
+        if event['eventType'] == 'ActivityTaskScheduled':
+            break
+    assert event['eventId'] == 11
+    assert len(foreman.swf_client.requests) == 3
+
+
+@mock_swf
+def test_foreman_prefetch_workflow_history():
+    """Retrieve pages of workflow history on a background thread"""
+    foreman = Foreman(configuration=config)
+    foreman.history_prefetch = True
+    foreman.swf_client = PagedHistoryClient(events=successful_workflow_history['events'])
+    foreman.workflow_id, foreman.run_id = 'wf', 'run'
+    assert [event['eventId'] for event in foreman.get_workflow_history()['events']] == list(range(1, 16))
+    assert [event['eventId'] for event in foreman.iter_workflow_history()] == list(range(15, 0, -1))
+    assert len(foreman.swf_client.requests) == 8
+
+
+@mock_swf
+def test_worker_caches_execution_info():
+    """Workflow executions are only described once across activity tasks"""
+    worker = Worker(configuration=config)
+    worker.swf_client = PagedHistoryClient(events=list())
+    worker.workflow_id, worker.run_id = 'wf', 'run'
+    for _ in range(3):
+        worker.set_workflow_type()
+    assert (worker.workflow_name, worker.workflow_version) == ('wftype', '1')
+    assert len(worker.swf_client.requests) == 1
+
+
+class ActivityTaskClient(object):
+    """An SWF client stand-in that assigns a fixed set of activity tasks and records the responses."""
+
+    def __init__(self, count=0):
+        self.tasks = [{'taskToken': text_type(index), 'activityId': text_type(index), 'input': text_type(index),
+                       'activityType': {'name': 'activity1', 'version': '1'},
+                       'workflowExecution': {'workflowId': 'wf', 'runId': 'run'}} for index in range(count)]
+        self.completed = dict()
+        self.failed = dict()
+        self.heartbeats = list()
+        self.lock = threading.Lock()
+
+    def poll_for_activity_task(self, **kwargs):
+        with self.lock:
+            if self.tasks:
+                return self.tasks.pop(0)
+        time.sleep(0.01)
+        return {'startedEventId': 0}
+
+    def describe_workflow_execution(self, **kwargs):
+        return {'executionInfo': {'workflowType': {'name': 'wftype', 'version': '1'}}}
+
+    def record_activity_task_heartbeat(self, taskToken=None, details=None):
+        with self.lock:
+            self.heartbeats.append((taskToken, details))
+        if taskToken == 'closed':
+            raise ClientError({'Error': {'Code': 'UnknownResourceFault', 'Message': ''}},
+                              'RecordActivityTaskHeartbeat')
+        return {'cancelRequested': taskToken == '1'}
+
+    def respond_activity_task_completed(self, taskToken=None, result=None):
+        self.completed[taskToken] = result
+
+    def respond_activity_task_failed(self, taskToken=None, reason=None, details=None):
+        self.failed[taskToken] = reason
+
+
+def double_input(activity_task):
+    """Activity handler that fails on odd input."""
+    if int(activity_task.input) % 2:
+        raise ValueError('odd input')
+    return text_type(int(activity_task.input) * 2)
+
+
+def wait_for_responses(client=None, count=None):
+    deadline = time.time() + 10
+    while len(client.completed) + len(client.failed) < count and time.time() < deadline:
+        time.sleep(0.01)
+
+
+@mock_swf
+def test_worker_poll_for_activity_task():
+    """Polling sets the worker's state from the assigned task"""
+    worker = Worker(configuration=config)
+    worker.swf_client = ActivityTaskClient(count=1)
+    worker.poll_for_activity_task()
+    assert (worker.task_token, worker.activity_type_name, worker.workflow_name) == ('0', 'activity1', 'wftype')
+    assert worker.poll_for_task() is None
+
+
+@mock_swf
+def test_worker_heartbeat():
+    """Tasks in progress are heartbeated until they complete and cancellation requests are surfaced"""
+    worker = Worker(configuration=config)
+    worker.heartbeat.interval = 0.01
+    worker.swf_client = ActivityTaskClient(count=2)
+    first_task, second_task = worker.poll_for_task(), worker.poll_for_task()
+    worker.set_heartbeat_details(details='50%', task_token=first_task.task_token)
+    time.sleep(0.1)
+    assert worker.is_cancel_requested(task_token=second_task.task_token) and second_task.cancel_requested
+    assert not worker.is_cancel_requested(task_token=first_task.task_token)
+    assert ('0', '50%') in worker.swf_client.heartbeats
+    worker.complete_activity_task(result='done', task_token=first_task.task_token)
+    worker.activity_task_failed(reason='cancelled', task_token=second_task.task_token)
+    time.sleep(0.05)
+    heartbeat_count = len(worker.swf_client.heartbeats)
+    time.sleep(0.05)
+    assert len(worker.swf_client.heartbeats) == heartbeat_count
+    worker.heartbeat.add(activity_task=ActivityTask(task=dict(first_task.task, taskToken='closed')))
+    time.sleep(0.05)
+    assert worker.is_cancel_requested(task_token='closed')
+    worker.heartbeat.stop()
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+@mock_swf
+def test_worker_pool(executor):
+    """Tasks are executed concurrently and completed or failed according to their handler"""
+    worker = Worker(configuration=config)
+    worker.swf_client = ActivityTaskClient(count=8)
+    pool = WorkerPool(worker=worker, handler=double_input, pollers=3, max_workers=2, executor=executor)
+    pool.start()
+    wait_for_responses(client=worker.swf_client, count=8)
+    pool.stop()
+    assert worker.swf_client.completed == {'0': '0', '2': '4', '4': '8', '6': '12'}
+    assert worker.swf_client.failed == {'1': 'ValueError', '3': 'ValueError', '5': 'ValueError', '7': 'ValueError'}
+
+
+class ExitingWorker(object):
+    """A worker stand-in whose polls exit, as Worker.poll_for_task does without permission to poll"""
+
+    configuration = config
+
+    def __init__(self):
+        self.messages = list()
+
+    def poll_for_task(self):
+        exit()
+
+    def msg(self, message=None, level='info'):
+        self.messages.append((level, message))
+
+
+class ShutdownWorker(ExitingWorker):
+    """A worker stand-in whose first poll returns once its pool has been shut down"""
+
+    def __init__(self, pool_stopped=None):
+        super(ShutdownWorker, self).__init__()
+        self.pool_stopped = pool_stopped
+        self.failed = dict()
+
+    def poll_for_task(self):
+        if self.failed or not self.pool_stopped.wait(5):
+            return None
+        return ActivityTask(task={'taskToken': 'late', 'activityId': '1', 'input': '1',
+                                  'activityType': {'name': 'activity1', 'version': '1'},
+                                  'workflowExecution': {'workflowId': 'wf', 'runId': 'run'}})
+
+    def activity_task_failed(self, reason=None, details=None, task_token=None):
+        self.failed[task_token] = reason
+
+
+def test_worker_pool_stops_when_worker_exits():
+    """A poll that exits stops the pool and releases its capacity, rather than killing its poller"""
+    pool = WorkerPool(worker=ExitingWorker(), handler=double_input, pollers=2, max_workers=2)
+    pool.start()
+    assert pool.stopping.wait(5)
+    pool.stop()
+    assert all(pool._capacity.acquire(False) for _ in range(2))
+    assert pool.worker.messages[0][0] == 'error'
+
+
+def test_worker_pool_fails_tasks_received_after_shutdown():
+    """A task received after stop(wait=False) is failed and its capacity released"""
+    pool_stopped = threading.Event()
+    pool = WorkerPool(worker=ShutdownWorker(pool_stopped=pool_stopped), handler=double_input, pollers=1,
+                      max_workers=1)
+    pool.start()
+    poller = pool._poller_threads[0]
+    pool.stop(wait=False)
+    pool_stopped.set()
+    poller.join(5)
+    assert not poller.is_alive() and pool.worker.failed == {'late': 'WorkerPoolStopped'}
+    assert pool._capacity.acquire(False)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason='requires asyncio coroutines')
+@mock_swf
+def test_async_worker_concurrent_polls():
+    """Many polls for activity tasks are held open at once by a single worker"""
+    import asyncio
+    from taran.aio import AsyncWorker
+    worker = AsyncWorker(configuration=config)
+    worker.swf_client = ActivityTaskClient(count=20)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    activity_tasks = loop.run_until_complete(asyncio.gather(*[worker.poll_for_task() for _ in range(20)]))
+    loop.run_until_complete(asyncio.gather(*[worker.complete_activity_task(result='done', task_token=task.task_token)
+                                             for task in activity_tasks]))
+    loop.close()
+    asyncio.set_event_loop(None)
+    assert sorted(worker.swf_client.completed, key=int) == [text_type(index) for index in range(20)]
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason='requires asyncio coroutines')
+@mock_swf
+def test_async_foreman_spawn():
+    """Spawned foremen poll independently whilst sharing the history cache"""
+    import asyncio
+    from taran.aio import AsyncForeman
+    foreman = AsyncForeman(configuration=config)
+    foreman.swf_client = PagedHistoryClient(events=successful_workflow_history['events'])
+    spawned = foreman.spawn(task_list='other')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    assert loop.run_until_complete(spawned.poll_for_decision_task())
+    loop.close()
+    asyncio.set_event_loop(None)
+    assert spawned.task_list == 'other' and spawned.workflow_id == 'wf' and foreman.workflow_id is None
+    assert foreman.history_cache.get(('wf', 'run')) is spawned.indexed_history
+
+
 # RAW BOTO3 EXAMPLE - FOR TEST COMPARISON
 # @mock_swf
 # def test_start_workflow_raw():
@@ -164,3 +475,261 @@ def test_schedule_activity_task():
 #     foreman.workflow_id = start_response.get('workflow_id')
 #     foreman.run_id = start_response.get('run_id')
 #     assert foreman.get_workflow_history()
+
+
+def run_rolling_deploy(hosts=None, failing=(), **kwargs):
+    """Simulate a rolling deployment in which every stage started finishes before the next decision"""
+    statuses = dict()
+    rounds = list()
+    while True:
+        plan = plan_rolling_deploy(hosts=hosts, statuses=statuses, **kwargs)
+        if plan['complete'] or (plan['aborted'] and not plan['running']):
+            return plan, rounds
+        rounds.append(plan['schedule'])
+        for stage, host in plan['schedule']:
+            statuses[(stage, host)] = 'failed' if (stage, host) in failing else 'completed'
+
+
+def test_plan_rolling_deploy_pipelines_batches():
+    """Batches start each stage as soon as the previous batch has finished it"""
+    hosts = ['host-{0}'.format(index) for index in range(6)]
+    plan, rounds = run_rolling_deploy(hosts=hosts, batch_size=2)
+    assert plan['succeeded'] == hosts and len(rounds) == 5
+    assert rounds[2] == [('health', 'host-0'), ('health', 'host-1'), ('install', 'host-2'), ('install', 'host-3'),
+                         ('drain', 'host-4'), ('drain', 'host-5')]
+    _, rounds = run_rolling_deploy(hosts=hosts, batch_size=2, max_batches_in_flight=1)
+    assert len(rounds) == 9
+
+
+def test_plan_rolling_deploy_failure_budget():
+    """Failed hosts within the budget are skipped; exceeding the budget stops further stages"""
+    hosts = ['host-{0}'.format(index) for index in range(6)]
+    plan, _ = run_rolling_deploy(hosts=hosts, batch_size=2, max_failures=1, failing=[('install', 'host-1')])
+    assert plan['complete'] and plan['failed'] == ['host-1'] and len(plan['succeeded']) == 5
+    plan, rounds = run_rolling_deploy(hosts=hosts, batch_size=2, max_failures=1,
+                                      failing=[('install', 'host-1'), ('drain', 'host-2')])
+    assert plan['aborted'] and not plan['complete'] and plan['failed'] == ['host-1', 'host-2']
+    assert not any(host in ('host-4', 'host-5') for _, host in sum(rounds, []))
+
+
+class DecisionClient(object):
+    """An SWF client stand-in that records the decisions made."""
+
+    def __init__(self):
+        self.decisions = list()
+
+    def respond_decision_task_completed(self, taskToken=None, decisions=None):
+        self.decisions.append(decisions)
+
+
+def get_rolling_deploy_history(deploy=None, completed=()):
+    """Build a workflow history in which the given stages have been scheduled and completed"""
+    events = [{'eventId': 1, 'eventType': 'WorkflowExecutionStarted',
+               'workflowExecutionStartedEventAttributes': {'input': json.dumps(deploy)}}]
+    for stage, host in completed:
+        scheduled_id = len(events) + 1
+        events.append({'eventId': scheduled_id, 'eventType': 'ActivityTaskScheduled',
+                       'activityTaskScheduledEventAttributes': {
+                           'activityType': {'name': stage, 'version': '1'}, 'activityId': '{0}-{1}'.format(stage, host),
+                           'taskList': {'name': 'rolling-deploy-{0}'.format(host)}}})
+        events.append({'eventId': scheduled_id + 1, 'eventType': 'ActivityTaskCompleted',
+                       'activityTaskCompletedEventAttributes': {'scheduledEventId': scheduled_id, 'result': '{}'}})
+    return dict(events=events)
+
+
+def test_rolling_deploy_names_are_valid_for_swf():
+    """Activity ids and task lists contain none of the characters, or the string 'arn', that SWF forbids"""
+    for host in ('web-1.example.com', 'web:1', 'a/b|c d', 'barney\t'):
+        for name in (get_stage_activity_id(stage='install', host=host), get_host_task_list(host=host)):
+            assert not re.search(r'[:/|\s\x00-\x1f\x7f-\x9f]|arn', name)
+    assert get_stage_activity_id(stage='install', host='web:1') != get_stage_activity_id(stage='drain', host='web:1')
+
+
+@mock_swf
+def test_rolling_deploy_foreman_decide():
+    """Stages are scheduled on each host's task list and the workflow completes once all hosts are deployed"""
+    foreman = RollingDeployForeman(configuration=config)
+    foreman.swf_client = DecisionClient()
+    foreman.activity_versions['install'] = '1'
+    deploy = dict(hosts=['a', 'b'], batch_size=1, stages=['install'], options={'commands': []})
+    foreman.workflow_history = get_rolling_deploy_history(deploy=deploy)
+    foreman.decide()
+    decision = foreman.swf_client.decisions[-1]
+    assert [item['scheduleActivityTaskDecisionAttributes']['taskList']['name'] for item in decision] == [
+        'rolling-deploy-a']
+    assert json.loads(decision[0]['scheduleActivityTaskDecisionAttributes']['input']) == dict(
+        commands=[], stage='install', host='a')
+    assert handle_stage_task(activity_task=ActivityTask(task={
+        'taskToken': 't', 'activityId': 'install-a', 'activityType': {'name': 'install', 'version': '1'},
+        'input': decision[0]['scheduleActivityTaskDecisionAttributes']['input'],
+        'workflowExecution': {'workflowId': 'wf', 'runId': 'run'}}))
+    foreman.workflow_history = get_rolling_deploy_history(deploy=deploy, completed=[('install', 'a'), ('install', 'b')])
+    plan = foreman.decide()
+    assert plan['complete'] and foreman.swf_client.decisions[-1][0]['decisionType'] == 'CompleteWorkflowExecution'
+
+
+def test_decision_builder():
+    """Decisions of any type are built with known activity versions, and nothing may follow a closing decision"""
+    builder = DecisionBuilder(activity_versions={'build': '2'}, id_prefix='7')
+    builder.schedule_activity(name='build', task_list='builders', input={'branch': 'master'})
+    builder.start_timer(start_to_fire_timeout=30).record_marker(marker_name='checkpoint', details='1')
+    builder.start_child_workflow(name='shard', version='1', input=[1, 2])
+    builder.complete_workflow(result={'built': True})
+    assert [decision['decisionType'] for decision in builder.decisions] == [
+        'ScheduleActivityTask', 'StartTimer', 'RecordMarker', 'StartChildWorkflowExecution',
+        'CompleteWorkflowExecution']
+    attributes = builder.decisions[0]['scheduleActivityTaskDecisionAttributes']
+    assert attributes['activityType'] == {'name': 'build', 'version': '2'} and attributes['activityId'] == '7-1'
+    assert json.loads(attributes['input']) == {'branch': 'master'} and 'control' not in attributes
+    assert builder.decisions[1]['startTimerDecisionAttributes'] == {'timerId': '7-2', 'startToFireTimeout': '30'}
+    with pytest.raises(TaranError):
+        builder.cancel_timer(timer_id='7-2')
+    with pytest.raises(TaranError):
+        DecisionBuilder().schedule_activity(name='unknown')
+
+
+def get_overflow_history(decisions=None, fired=None):
+    """Build a history in which the timers started by a response have started and the given timers have fired"""
+    events = [{'eventId': 1, 'eventType': 'DecisionTaskStarted', 'decisionTaskStartedEventAttributes': {}}]
+    timers = [decision['startTimerDecisionAttributes'] for decision in decisions
+              if decision['decisionType'] == 'StartTimer']
+    for timer in timers:
+        events.append({'eventId': len(events) + 1, 'eventType': 'TimerStarted', 'timerStartedEventAttributes': dict(
+            timer, decisionTaskCompletedEventId=1)})
+    for index in fired if fired is not None else range(len(timers)):
+        events.append({'eventId': len(events) + 1, 'eventType': 'TimerFired', 'timerFiredEventAttributes': {
+            'timerId': timers[index]['timerId'], 'startedEventId': index + 2}})
+    return dict(events=events)
+
+
+@mock_swf
+def test_foreman_respond_decisions_defers_overflow():
+    """Decisions beyond the per-response limit, and the closing decision, are restored from the history by the
+    foreman making the next decision"""
+    foreman = Foreman(configuration=config)
+    foreman.swf_client = DecisionClient()
+    foreman.workflow_id, foreman.run_id, foreman.task_token = 'wf', 'run', 't1'
+    builder = foreman.get_decision_builder()
+    for _ in range(MAX_DECISIONS + 10):
+        builder.schedule_activity(name=config.ACTIVITY_NAME)
+    builder.complete_workflow()
+    assert foreman.respond_decisions(builder=builder) == 12
+    first = foreman.swf_client.decisions[-1]
+    assert len(first) == MAX_DECISIONS and first[-1]['decisionType'] == 'StartTimer'
+    assert first[-1]['startTimerDecisionAttributes']['timerId'].startswith(OVERFLOW_TIMER_PREFIX)
+    # Another foreman, holding no state, makes the next decision
+    other = Foreman(configuration=config)
+    other.swf_client = DecisionClient()
+    other.workflow_id, other.run_id, other.task_token = 'wf', 'run', 't2'
+    other.decision_task = {'previousStartedEventId': 1}
+    other.workflow_history = get_overflow_history(decisions=first)
+    extra = other.get_decision_builder().record_marker(marker_name='progress')
+    assert other.respond_decisions(builder=extra) == 0
+    second = other.swf_client.decisions[-1]
+    assert [decision['decisionType'] for decision in second[-2:]] == ['RecordMarker', 'CompleteWorkflowExecution']
+    assert len(second) == 13
+    activity_ids = set(decision['scheduleActivityTaskDecisionAttributes']['activityId']
+                       for decision in first + second if decision['decisionType'] == 'ScheduleActivityTask')
+    assert len(activity_ids) == MAX_DECISIONS + 10
+    # Decisions already restored by an earlier decision task are not made again
+    other.decision_task = {'previousStartedEventId': 4}
+    other.workflow_history = dict(other.workflow_history, events=other.workflow_history['events'] + [
+        {'eventId': 4, 'eventType': 'DecisionTaskStarted', 'decisionTaskStartedEventAttributes': {}}])
+    assert other.respond_decisions() == 0 and other.swf_client.decisions[-1] == []
+
+
+def test_decision_builder_defers_to_several_timers():
+    """Deferred decisions too long for one timer are split between timers, and restored once all have fired"""
+    builder = DecisionBuilder(activity_versions={'build': '1'})
+    for _ in range(MAX_DECISIONS * 2):
+        builder.schedule_activity(name='build', input='x' * 1000)
+    batch = builder.take_batch()
+    timers = [decision for decision in batch if decision['decisionType'] == 'StartTimer']
+    assert len(batch) == MAX_DECISIONS and len(timers) > 1 and not builder.decisions
+    assert all(len(timer['startTimerDecisionAttributes']['control']) <= MAX_CONTROL_LENGTH for timer in timers)
+    history = WorkflowHistory.from_workflow_history(get_overflow_history(decisions=batch, fired=[0]))
+    assert history.get_deferred_decisions() == []
+    history = WorkflowHistory.from_workflow_history(get_overflow_history(decisions=batch))
+    assert len(history.get_deferred_decisions()) == MAX_DECISIONS * 2 - (MAX_DECISIONS - len(timers))
+
+
+@mock_swf
+def test_foreman_schedule_activity_tasks():
+    """Activities are scheduled with the version of their type from the activity list"""
+    foreman = Foreman(configuration=config)
+    foreman.swf_client = DecisionClient()
+    foreman.task_token = 't'
+    assert foreman.schedule_activity_tasks(decisions=[Decision(
+        name=config.ACTIVITY_NAME, type=config.ACTIVITY_NAME, schedule_to_start_timeout='60',
+        start_to_close_timeout='60', schedule_to_close_timeout='120', task_list='default', input='{}')] * 2)
+    decisions = foreman.swf_client.decisions[-1]
+    assert [decision['scheduleActivityTaskDecisionAttributes']['activityType']['version']
+            for decision in decisions] == [config.ACTIVITY_VERSION] * 2
+    assert decisions[0]['scheduleActivityTaskDecisionAttributes']['taskList'] == {'name': 'default'}
+
+
+def get_fan_out_history(children=()):
+    """Build a parent workflow history in which child workflows have been started and, optionally, closed"""
+    events = [{'eventId': 1, 'eventType': 'WorkflowExecutionStarted',
+               'workflowExecutionStartedEventAttributes': {'input': '{}'}}]
+    for workflow_id, outcome in children:
+        workflow_type = {'name': 'shard', 'version': '1'}
+        execution = {'workflowId': workflow_id, 'runId': 'run-{0}'.format(len(events))}
+        initiated_id = len(events) + 1
+        events.append({'eventId': initiated_id, 'eventType': 'StartChildWorkflowExecutionInitiated',
+                       'startChildWorkflowExecutionInitiatedEventAttributes': {
+                           'workflowId': workflow_id, 'workflowType': workflow_type}})
+        events.append({'eventId': initiated_id + 1, 'eventType': 'ChildWorkflowExecutionStarted',
+                       'childWorkflowExecutionStartedEventAttributes': {
+                           'workflowExecution': execution, 'workflowType': workflow_type,
+                           'initiatedEventId': initiated_id}})
+        if outcome == 'completed':
+            events.append({'eventId': initiated_id + 2, 'eventType': 'ChildWorkflowExecutionCompleted',
+                           'childWorkflowExecutionCompletedEventAttributes': {
+                               'workflowExecution': execution, 'workflowType': workflow_type,
+                               'result': json.dumps(workflow_id)}})
+        elif outcome == 'failed':
+            events.append({'eventId': initiated_id + 2, 'eventType': 'ChildWorkflowExecutionFailed',
+                           'childWorkflowExecutionFailedEventAttributes': {
+                               'workflowExecution': execution, 'workflowType': workflow_type, 'reason': 'broken'}})
+    return dict(events=events)
+
+
+def test_plan_fan_out():
+    """Shards are started up to the in-flight limit, and failed shards are retried until out of attempts"""
+    plan = plan_fan_out(shard_count=5, statuses={0: {'status': 'started'}}, max_in_flight=3)
+    assert plan['start'] == [1, 2] and plan['running'] == 1 and not plan['complete']
+    statuses = {0: {'status': 'completed'}, 1: {'status': 'failed', 'attempts': 1},
+                2: {'status': 'timed_out', 'attempts': 2}}
+    plan = plan_fan_out(shard_count=3, statuses=statuses, max_attempts=2)
+    assert plan['start'] == [1] and plan['failed'] == [2] and not plan['complete']
+    plan = plan_fan_out(shard_count=3, statuses=statuses, max_attempts=1)
+    assert plan['start'] == [] and plan['succeeded'] == [0] and plan['failed'] == [1, 2] and plan['complete']
+
+
+@mock_swf
+def test_foreman_fan_out():
+    """A work list is sharded into child workflows whose results are gathered from the history"""
+    foreman = Foreman(configuration=config)
+    foreman.swf_client = DecisionClient()
+    foreman.workflow_id, foreman.run_id, foreman.task_token = 'job', 'run', 't'
+    foreman.workflow_history = get_fan_out_history()
+    builder = foreman.get_decision_builder()
+    plan = foreman.fan_out(builder=builder, items=list(range(25)), name='shard', version='1', shard_size=10,
+                           max_in_flight=2)
+    assert plan['start'] == [0, 1] and plan['results'] == [None, None, None]
+    with pytest.raises(TypeError):
+        foreman.fan_out(items=list(range(25)), name='shard', version='1')
+    attributes = builder.decisions[0]['startChildWorkflowExecutionDecisionAttributes']
+    assert attributes['workflowId'] == 'job-shard-0' and attributes['workflowType'] == {'name': 'shard', 'version': '1'}
+    assert json.loads(attributes['input']) == dict(items=list(range(10)), shard=0)
+    foreman.workflow_history = get_fan_out_history(children=[
+        (get_shard_workflow_id(workflow_id='job', shard=0), 'completed'),
+        (get_shard_workflow_id(workflow_id='job', shard=1), 'failed'),
+        (get_shard_workflow_id(workflow_id='job', shard=2), 'started')])
+    statuses = foreman.get_indexed_history().get_child_workflow_statuses()
+    assert statuses['job-shard-1']['reason'] == 'broken' and statuses['job-shard-1']['attempts'] == 1
+    builder = foreman.get_decision_builder()
+    plan = foreman.fan_out(builder=builder, items=list(range(25)), name='shard', version='1', shard_size=10,
+                           max_attempts=2)
+    assert plan['start'] == [1] and plan['running'] == 1 and plan['results'] == ['job-shard-0', None, None]
@@ -2,8 +2,19 @@
 """Test utils"""
 from __future__ import (absolute_import, print_function, unicode_literals)
 
+import hashlib
+import os
+import sys
+import threading
+import time
+
+import pytest
 import responses
-from taran.utils.web import url_check
+from six import text_type
+from taran.utils import files, run_command, run_commands, stream_command
+from taran.utils.cache import LRUCache
+from taran.utils.files import benchmark_hashes, get_digests, get_md5, get_md5s, hash_file
+from taran.utils.web import check_urls, url_check
 
 
 @responses.activate
@@ -13,3 +24,186 @@ def test_web_url_check():
                   body='{}', status=200,
                   content_type='text/html')
     assert url_check(url='http://example.com/test', timeout=1)
+
+
+@responses.activate
+def test_web_url_check_waits_between_unexpected_responses():
+    """Responses with unexpected status codes are retried at the interval, not in a tight loop"""
+    responses.add(responses.GET, 'http://example.com/unhealthy', body='{}', status=503)
+    assert not url_check(url='http://example.com/unhealthy', timeout=0.5, interval=0.2)
+    assert 2 <= len(responses.calls) <= 4
+
+
+@responses.activate
+def test_check_urls():
+    """Many URLs are checked concurrently, each with its own threshold"""
+    for index in range(5):
+        responses.add(responses.GET, 'http://backend-{0}.example.com/health'.format(index), body='{}', status=200)
+    responses.add(responses.HEAD, 'http://backend-5.example.com/health', status=500)
+    checks = ['http://backend-{0}.example.com/health'.format(index) for index in range(4)]
+    checks.append(dict(url='http://backend-4.example.com/health', healthy_threshold=3, interval=0.05))
+    checks.append(dict(url='http://backend-5.example.com/health', method='head', expected_codes=[200, 204],
+                       interval=0.1))
+    started = time.time()
+    results = check_urls(checks=checks, timeout=1, max_concurrency=3)
+    assert time.time() - started < 2
+    assert [results[url]['healthy'] for url in sorted(results)] == [True] * 5 + [False]
+    assert results['http://backend-4.example.com/health']['attempts'] == 3
+    assert results['http://backend-5.example.com/health']['status_code'] == 500
+    assert results['http://backend-5.example.com/health']['attempts'] > 1
+
+
+def test_lru_cache_eviction():
+    """Least recently used entries are evicted by count and by weight"""
+    cache = LRUCache(max_entries=2, max_weight=5, weigher=len)
+    cache.put('a', [1])
+    cache.put('b', [1, 2])
+    assert cache.get('a') == [1]
+    cache.put('c', [1])
+    assert 'b' not in cache and len(cache) == 2
+    cache.put('d', [1, 2, 3, 4])
+    assert 'a' not in cache and 'c' in cache and cache.weight == 5
+
+
+def test_lru_cache_expiry():
+    """Entries are not returned once their time to live has passed"""
+    cache = LRUCache(ttl=0)
+    cache.put('a', 1)
+    assert cache.get('a') is None and 'a' not in cache
+    cache = LRUCache(ttl=60)
+    cache.put('a', 1)
+    assert cache.get('a') == 1
+
+
+def test_get_md5_only_hashes_changed_files(tmpdir, monkeypatch):
+    """Files are only rehashed once their size, modification time or inode changes"""
+    hashed = list()
+    hash_file = files.hash_file
+    monkeypatch.setattr(files, 'hash_file', lambda file_path=None, **kwargs: hashed.append(file_path) or hash_file(
+        file_path=file_path, **kwargs))
+    local_file = tmpdir.join('staged.txt')
+    local_file.write('first')
+    assert get_md5(file_path=text_type(local_file)) == hashlib.md5(b'first').hexdigest()
+    assert get_md5(file_path=text_type(local_file)) == hashlib.md5(b'first').hexdigest()
+    assert len(hashed) == 1 and tmpdir.join('staged.txt.md5').read().split('\n')[0] == hashlib.md5(b'first').hexdigest()
+    files.digest_cache.clear()
+    assert get_md5(file_path=text_type(local_file)) == hashlib.md5(b'first').hexdigest()
+    assert len(hashed) == 1
+    local_file.write('second, longer')
+    assert get_md5(file_path=text_type(local_file)) == hashlib.md5(b'second, longer').hexdigest()
+    assert len(hashed) == 2
+    # A replacement with the same size and modification time, e.g. by cp -p, has a new inode
+    files.digest_cache.clear()
+    stat = os.stat(text_type(local_file))
+    tmpdir.join('replacement.txt').write('third, longer!')
+    os.rename(text_type(tmpdir.join('replacement.txt')), text_type(local_file))
+    os.utime(text_type(local_file), (stat.st_atime, stat.st_mtime))
+    assert get_md5(file_path=text_type(local_file)) == hashlib.md5(b'third, longer!').hexdigest()
+    assert len(hashed) == 3
+    # A sidecar without a stat key, e.g. written by another tool, is not trusted
+    tmpdir.join('staged.txt.md5').write(hashlib.md5(b'stale').hexdigest())
+    files.digest_cache.clear()
+    assert get_md5(file_path=text_type(local_file)) == hashlib.md5(b'third, longer!').hexdigest()
+    assert len(hashed) == 4
+
+
+def test_get_md5_of_file_changed_whilst_hashing(tmpdir, monkeypatch):
+    """A digest is not recorded for a file that changed whilst it was hashed"""
+    local_file = tmpdir.join('growing.txt')
+    local_file.write('first')
+    hash_file = files.hash_file
+
+    def append_whilst_hashing(file_path=None, **kwargs):
+        digest = hash_file(file_path=file_path, **kwargs)
+        local_file.write('first, then more')
+        return digest
+    monkeypatch.setattr(files, 'hash_file', append_whilst_hashing)
+    assert get_md5(file_path=text_type(local_file)) == hashlib.md5(b'first').hexdigest()
+    assert not tmpdir.join('growing.txt.md5').exists()
+    monkeypatch.setattr(files, 'hash_file', hash_file)
+    assert get_md5(file_path=text_type(local_file)) == hashlib.md5(b'first, then more').hexdigest()
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_get_md5s(tmpdir, executor):
+    """Many files are hashed in parallel and their sidecars written"""
+    file_paths = list()
+    for index in range(10):
+        local_file = tmpdir.join('file-{0}.txt'.format(index))
+        local_file.write('x' * index)
+        file_paths.append(text_type(local_file))
+    md5s = get_md5s(file_paths=file_paths, max_workers=2, executor=executor)
+    assert md5s == dict((file_path, hashlib.md5(b'x' * index).hexdigest())
+                        for index, file_path in enumerate(file_paths))
+    assert tmpdir.join('file-9.txt.md5').read().split('\n')[0] == hashlib.md5(b'x' * 9).hexdigest()
+
+
+@pytest.mark.parametrize('algorithm', ['sha256', 'blake2b'])
+def test_get_digests(tmpdir, algorithm):
+    """Digests of any algorithm are written to sidecars named after the algorithm"""
+    local_file = tmpdir.join('file.bin')
+    local_file.write_binary(b'x' * 3000)
+    expected = hashlib.new(algorithm, b'x' * 3000).hexdigest()
+    assert hash_file(file_path=text_type(local_file), algorithm=algorithm, buffer_size=1024) == expected
+    assert get_digests(file_paths=[text_type(local_file)], algorithm=algorithm, executor='thread') == {
+        text_type(local_file): expected}
+    assert tmpdir.join('file.bin.{0}'.format(algorithm)).read().split('\n')[0] == expected
+    with pytest.raises(ValueError):
+        hash_file(file_path=text_type(local_file), algorithm='crc16')
+
+
+def test_benchmark_hashes():
+    """The throughput of each algorithm and read size is measured"""
+    results = benchmark_hashes(size=1024 * 1024, algorithms=['md5', 'sha256'], buffer_sizes=[65536, 1048576])
+    assert sorted((result['algorithm'], result['buffer_size']) for result in results) == [
+        ('md5', 65536), ('md5', 1048576), ('sha256', 65536), ('sha256', 1048576)]
+    assert all(result['throughput'] > 0 for result in results)
+
+
+def test_stream_command():
+    """Output is passed to the callback line by line and only the last lines are kept"""
+    received = list()
+    script = 'import sys\nfor i in range(5000): print(i)\nsys.stderr.write("done\\n")\nsys.exit(3)'
+    result = stream_command(cmd=[sys.executable, '-c', script], max_lines=10,
+                            line_callback=lambda stream_name, line: received.append((stream_name, line)))
+    assert result['returncode'] == 3 and not result['timed_out']
+    assert result['stdout'] == '\n'.join(str(i) for i in range(4990, 5000)) and result['stdout_lines'] == 5000
+    assert result['stderr'] == 'done'
+    assert len(received) == 5001 and ('stderr', 'done') in received
+    assert run_command(cmd='{0} -c "print(1); print(2)"'.format(sys.executable)) == '1\n2'
+
+
+def test_stream_command_timeout_and_cancellation():
+    """Commands are terminated when they time out or are cancelled"""
+    sleep = [sys.executable, '-c', 'import time; time.sleep(30)']
+    result = stream_command(cmd=sleep, timeout=0.5)
+    assert result['timed_out'] and result['returncode'] != 0 and result['seconds'] < 10
+    cancel_event = threading.Event()
+    threading.Timer(0.5, cancel_event.set).start()
+    started = time.time()
+    result = stream_command(cmd=sleep, cancel_event=cancel_event)
+    assert result['cancelled'] and time.time() - started < 10
+
+
+def test_run_commands_concurrently():
+    """Commands run at once, with results in the order given"""
+    cmds = [[sys.executable, '-c', 'import time; time.sleep(0.5); print({0})'.format(index)] for index in range(4)]
+    started = time.time()
+    results = run_commands(cmds=cmds, max_concurrency=4)
+    assert time.time() - started < 1.9
+    assert [result['stdout'] for result in results] == ['0', '1', '2', '3']
+    assert [result['cmd'] for result in results] == cmds
+
+
+def test_run_commands_fail_fast():
+    """Once a command fails, running commands are cancelled and waiting commands are not started"""
+    cmds = [[sys.executable, '-c', 'import sys; sys.exit(1)'],
+            [sys.executable, '-c', 'import time; time.sleep(30)'],
+            [sys.executable, '-c', 'print(1)']]
+    results = run_commands(cmds=cmds, max_concurrency=2, policy='fail_fast')
+    assert [result['returncode'] for result in results][::2] == [1, None]
+    assert results[1]['cancelled'] and results[2]['cancelled']
+    results = run_commands(cmds=[cmds[0], cmds[2]], max_concurrency=1, policy='continue')
+    assert [result['returncode'] for result in results] == [1, 0]
+    with pytest.raises(ValueError):
+        run_commands(cmds=cmds, policy='retry')